@@ -0,0 +1,56 @@
+import sqlite3
+import time
+import os
+
+# Persistent cache of account resolutions, backed by SQLite
+# Address <-> account ID mappings never change once created and never expire,
+# ENS resolutions expire after `ens_ttl` seconds
+# Shared by concurrent processes (shards, daemon): each write is committed at once so that the database is never left locked,
+# and in WAL mode readers never wait for a writer, writers wait for each other up to `timeout` seconds
+class AccountCache(object):
+    path: str
+    ens_ttl: float
+    db: sqlite3.Connection
+    timeout: float = 30
+
+    def __init__(self, path: str, ens_ttl: float = 86400) -> None:
+        self.path = path
+        self.ens_ttl = ens_ttl
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, timeout=self.timeout)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")    # A cache: a commit lost on power failure is only resolved again
+        self.db.execute("CREATE TABLE IF NOT EXISTS accounts (account_id INTEGER PRIMARY KEY, address TEXT NOT NULL UNIQUE)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ens (name TEXT PRIMARY KEY, address TEXT NOT NULL, resolved_at REAL NOT NULL)")
+        self.db.commit()
+
+    def get_account_id(self, address: str) -> int:
+        row = self.db.execute("SELECT account_id FROM accounts WHERE address = ?", (address.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def get_address(self, account_id: int) -> str:
+        row = self.db.execute("SELECT address FROM accounts WHERE account_id = ?", (int(account_id),)).fetchone()
+        return row[0] if row else None
+
+    def put_account(self, account_id: int, address: str) -> None:
+        self.db.execute("INSERT OR REPLACE INTO accounts (account_id, address) VALUES (?, ?)", (int(account_id), address.lower()))
+        self.db.commit()
+
+    def get_ens(self, name: str) -> str:
+        row = self.db.execute("SELECT address FROM ens WHERE name = ? AND resolved_at >= ?", (name.lower(), time.time() - self.ens_ttl)).fetchone()
+        return row[0] if row else None
+
+    def put_ens(self, name: str, address: str) -> None:
+        self.db.execute("INSERT OR REPLACE INTO ens (name, address, resolved_at) VALUES (?, ?, ?)", (name.lower(), address.lower(), time.time()))
+        self.db.commit()
+
+    # Invalidate every cached resolution
+    def clear(self) -> None:
+        self.db.execute("DELETE FROM accounts")
+        self.db.execute("DELETE FROM ens")
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,242 @@
+import bisect
+import signal
+import json
+import os
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Latency histogram with fixed buckets, recording a value is a bisect and a few increments
+class Histogram(object):
+    buckets: tuple
+    counts: 'list[int]'
+    count: int
+    sum: float
+    min: float
+    max: float
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    # Estimate of the `q` quantile, interpolated within its bucket (narrowed to the observed min and max)
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                lower = max(self.min, self.buckets[i - 1] if i > 0 else 0.0)
+                upper = min(self.max, self.buckets[i] if i < len(self.buckets) else self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    # Add the observations of `other`, a histogram with the same buckets
+    def merge(self, other: 'Histogram') -> None:
+        assert self.buckets == other.buckets, "Error merging histograms: Different buckets"
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    # Histogram written by `to_dict`
+    @classmethod
+    def from_dict(cls, d: dict) -> 'Histogram':
+        bounds = list(d['buckets'])[:-1]    # Last one is +Inf
+        histogram = cls(tuple(json.loads(bound) for bound in bounds))
+        previous = 0
+        for i, cumulative in enumerate(d['buckets'].values()):
+            histogram.counts[i] = cumulative - previous
+            previous = cumulative
+        histogram.count = d['count']
+        histogram.sum = d['sum']
+        histogram.min = d['min']
+        histogram.max = d['max']
+        return histogram
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count,
+                'sum': round(self.sum, 6),
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': buckets}
+
+    def prometheus(self, name: str, labels: str) -> 'list[str]':
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class EndpointMetrics(object):
+    latency: Histogram
+    statuses: dict
+    retries: int
+    sent_bytes: int
+    received_bytes: int
+
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.statuses = {}  # Status code (or 'error' without response) -> count
+        self.retries = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+    def merge(self, other: 'EndpointMetrics') -> None:
+        self.latency.merge(other.latency)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.retries += other.retries
+        self.sent_bytes += other.sent_bytes
+        self.received_bytes += other.received_bytes
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'EndpointMetrics':
+        metrics = cls()
+        metrics.latency = Histogram.from_dict(d['latency'])
+        metrics.statuses = {int(status) if str(status).isdigit() else status: count for status, count in d['statuses'].items()}
+        metrics.retries = d['retries']
+        metrics.sent_bytes = d['sent_bytes']
+        metrics.received_bytes = d['received_bytes']
+        return metrics
+
+    def to_dict(self) -> dict:
+        return {'requests': sum(self.statuses.values()),
+                'statuses': dict(self.statuses),
+                'retries': self.retries,
+                'sent_bytes': self.sent_bytes,
+                'received_bytes': self.received_bytes,
+                'latency': self.latency.to_dict()}
+
+# Per-endpoint metrics of the API requests: latency histogram, responses by status, retries and bytes,
+# along with the duration of local operations (e.g. signing) to tell them apart from the API
+# Dumped as a Prometheus text file (`<path>.prom`, for the node exporter textfile collector) and as JSON (`<path>.json`)
+class ApiMetrics(object):
+    endpoints: 'dict[tuple, EndpointMetrics]'
+    operations: 'dict[str, Histogram]'
+
+    def __init__(self) -> None:
+        self.endpoints = {}
+        self.operations = {}
+
+    def endpoint(self, method: str, path: str) -> EndpointMetrics:
+        metrics = self.endpoints.get((method, path))
+        if metrics is None:
+            metrics = self.endpoints[(method, path)] = EndpointMetrics()
+        return metrics
+
+    # Record a request: `status` is None if no response was received
+    def observe(self, method: str, path: str, status: int, latency: float, sent_bytes: int = 0, received_bytes: int = 0) -> None:
+        metrics = self.endpoint(method, path)
+        key = status if status is not None else 'error'
+        metrics.statuses[key] = metrics.statuses.get(key, 0) + 1
+        metrics.latency.observe(latency)
+        metrics.sent_bytes += sent_bytes
+        metrics.received_bytes += received_bytes
+
+    def retry(self, method: str, path: str) -> None:
+        self.endpoint(method, path).retries += 1
+
+    # Record the duration of a local operation
+    def observe_operation(self, name: str, duration: float) -> None:
+        histogram = self.operations.get(name)
+        if histogram is None:
+            histogram = self.operations[name] = Histogram()
+        histogram.observe(duration)
+
+    # Add the metrics of `other` (e.g. of another process of the same run)
+    def merge(self, other: 'ApiMetrics') -> None:
+        for (method, path), metrics in other.endpoints.items():
+            self.endpoint(method, path).merge(metrics)
+        for name, histogram in other.operations.items():
+            if name in self.operations:
+                self.operations[name].merge(histogram)
+            else:
+                self.operations[name] = Histogram.from_dict(histogram.to_dict())
+
+    # Metrics written by `to_dict` (e.g. the `<path>.json` of `dump`)
+    @classmethod
+    def from_dict(cls, d: dict) -> 'ApiMetrics':
+        metrics = cls()
+        for endpoint, endpoint_metrics in d['endpoints'].items():
+            method, path = endpoint.split(' ', 1)
+            metrics.endpoints[(method, path)] = EndpointMetrics.from_dict(endpoint_metrics)
+        for name, histogram in d['operations'].items():
+            metrics.operations[name] = Histogram.from_dict(histogram)
+        return metrics
+
+    def reset(self) -> None:
+        self.endpoints = {}
+        self.operations = {}
+
+    def to_dict(self) -> dict:
+        return {'endpoints': {f"{method} {path}": metrics.to_dict() for (method, path), metrics in sorted(self.endpoints.items())},
+                'operations': {name: histogram.to_dict() for name, histogram in sorted(self.operations.items())}}
+
+    def to_prometheus(self) -> str:
+        lines = ['# HELP loopring_api_request_duration_seconds Latency of the Loopring API requests',
+                 '# TYPE loopring_api_request_duration_seconds histogram']
+        for (method, path), metrics in sorted(self.endpoints.items()):
+            lines += metrics.latency.prometheus('loopring_api_request_duration_seconds', f'method="{method}",endpoint="{path}"')
+
+        lines += ['# HELP loopring_api_requests_total Loopring API requests by response status ("error" without response)',
+                  '# TYPE loopring_api_requests_total counter']
+        for (method, path), metrics in sorted(self.endpoints.items()):
+            for status, count in sorted(metrics.statuses.items(), key=lambda item: str(item[0])):
+                lines.append(f'loopring_api_requests_total{{method="{method}",endpoint="{path}",status="{status}"}} {count}')
+
+        for name, attribute, help in [('loopring_api_retries_total', 'retries', 'Loopring API requests retried'),
+                                      ('loopring_api_sent_bytes_total', 'sent_bytes', 'Bytes of the Loopring API request bodies'),
+                                      ('loopring_api_received_bytes_total', 'received_bytes', 'Bytes of the Loopring API response bodies')]:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} counter']
+            for (method, path), metrics in sorted(self.endpoints.items()):
+                lines.append(f'{name}{{method="{method}",endpoint="{path}"}} {getattr(metrics, attribute)}')
+
+        lines += ['# HELP loopring_operation_duration_seconds Duration of local operations',
+                  '# TYPE loopring_operation_duration_seconds histogram']
+        for name, histogram in sorted(self.operations.items()):
+            lines += histogram.prometheus('loopring_operation_duration_seconds', f'operation="{name}"')
+
+        return '\n'.join(lines) + '\n'
+
+    # Write `<path>.prom` and `<path>.json`, each replaced at once so that readers never see a partial file
+    def dump(self, path: str) -> None:
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        for extension, content in [('.prom', self.to_prometheus()), ('.json', json.dumps(self.to_dict(), indent=2))]:
+            with open(path + extension + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(path + extension + '.tmp', path + extension)
+
+    # Dump to `path` whenever the process receives SIGUSR1 (where the platform has it)
+    def dump_on_signal(self, loop, path: str) -> None:
+        if hasattr(signal, 'SIGUSR1'):
+            loop.add_signal_handler(signal.SIGUSR1, self.dump, path)
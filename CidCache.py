@@ -0,0 +1,76 @@
+import hashlib
+import sqlite3
+import time
+import os
+
+# Coarsest timestamp granularity of the filesystems the files may be on (FAT: 2 seconds)
+MTIME_GRANULARITY_NS = 2 * 10 ** 9
+
+# Persistent cache of file CIDs, backed by SQLite
+# A CID is reused while the file keeps the same path, size and mtime, its content is only read (see `fingerprint`)
+# when the mtime is too recent to tell a later change within the same timestamp tick
+class CidCache(object):
+    path: str
+    db: sqlite3.Connection
+    hits: int
+    misses: int
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cids (path TEXT NOT NULL, version INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, fingerprint TEXT NOT NULL, cid TEXT NOT NULL, PRIMARY KEY (path, version))")
+        self.db.commit()
+
+    # Key of a file in the cache: (absolute path, size, mtime), from its metadata only
+    @staticmethod
+    def file_key(path: str) -> tuple:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def recent(mtime_ns: int) -> bool:
+        return time.time_ns() - mtime_ns < MTIME_GRANULARITY_NS
+
+    def get(self, key: tuple, version: int = 0) -> str:
+        path, size, mtime_ns = key
+        row = self.db.execute("SELECT cid, fingerprint FROM cids WHERE path = ? AND version = ? AND size = ? AND mtime_ns = ?",
+                              (path, version, size, mtime_ns)).fetchone()
+        if row and (not self.recent(mtime_ns) or row[1] == fingerprint(path, size)):
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    # A file modified less than a timestamp tick ago is not cached: it could change again without changing its mtime
+    def put(self, key: tuple, cid: str, version: int = 0) -> None:
+        path, size, mtime_ns = key
+        if self.recent(mtime_ns):
+            return
+        self.db.execute("INSERT OR REPLACE INTO cids (path, version, size, mtime_ns, fingerprint, cid) VALUES (?, ?, ?, ?, ?, ?)",
+                        (path, version, size, mtime_ns, fingerprint(path, size), cid))
+
+    # Invalidate every cached CID
+    def clear(self) -> None:
+        self.db.execute("DELETE FROM cids")
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+# Fast content fingerprint: the whole file if small, its first and last `sample_size` bytes otherwise
+def fingerprint(path: str, size: int, sample_size: int = 65536) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= 2 * sample_size:
+            hasher.update(f.read())
+        else:
+            hasher.update(f.read(sample_size))
+            f.seek(-sample_size, os.SEEK_END)
+            hasher.update(f.read(sample_size))
+    return hasher.hexdigest()
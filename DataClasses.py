@@ -1,5 +1,6 @@
 from typing import TypedDict
 from dataclasses import dataclass
+from array import array
 
 @dataclass
 class Struct(dict):
@@ -7,15 +8,10 @@ class Struct(dict):
         if d:
             for k,v in d.items():
                 super().__setitem__(k,v)
-    def __getattr__(self, name):
-        if super().__contains__(name):
-            return super().__getitem__(name)
-        else:
-            return None
-    def __setattr__(self, name, value):
-        return super().__setitem__(name, value)
-    def __delattr__(self, name):
-        return super().__delitem__(name)
+    # Bound to the dict methods directly, without a Python-level call on each access (None for missing keys)
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
     def __str__(self):
         return super().__str__()
     def __repr__(self):
@@ -75,6 +71,102 @@ class NftBalance(TypedDict):
     totalNum: int
     data: 'list[NftInfo]'
 
+# Per-item record stored in `__slots__` rather than in a dict, for the state kept on each of thousands of items
+# `to_dict` gives the same JSON object as the dict it replaces: slots that were never assigned are left out, like missing keys
+class Record(object):
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        missing = Record
+        return {field: value for field in self.__slots__ if (value := getattr(self, field, missing)) is not missing}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        record = cls.__new__(cls)
+        for field in cls.__slots__:
+            if field in d:
+                setattr(record, field, d[field])
+        return record
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+# Entry of an NFT balance, the fields of NftInfo as attributes
+class NftEntry(Record):
+    __slots__ = ('id', 'accountId', 'tokenId', 'nftData', 'tokenAddress', 'nftId', 'nftType', 'total', 'locked')
+    id: int
+    accountId: int
+    tokenId: int
+    nftData: str
+    tokenAddress: str
+    nftId: str
+    nftType: str
+    total: int
+    locked: int
+
+# NFT balance stored as one compact array (or list) per NftInfo field, built from an NftBalance or page by page with `extend`
+# Hex fields are indexed by their integer value for O(1) lookups, positions keep the balance order
+# An index maps a value to its position, or to the list of its positions when several entries share it (e.g. tokenAddress)
+class IndexedNftBalance(object):
+    int_fields = ('id', 'accountId', 'tokenId', 'total', 'locked')
+    str_fields = ('nftData', 'tokenAddress', 'nftId', 'nftType')
+    indexed_fields = ('nftData', 'tokenAddress', 'nftId')
+
+    def __init__(self, balance: NftBalance = None):
+        self.columns = {field: array('q') for field in self.int_fields}
+        self.columns.update({field: [] for field in self.str_fields})
+        self.indexes = {field: {} for field in self.indexed_fields}
+        self.strings = {}   # Share identical strings (e.g. nftType, tokenAddress) across entries
+        if balance is not None:
+            self.extend(balance['data'])
+
+    def extend(self, nfts: 'list[NftInfo]') -> None:
+        strings = self.strings
+        for position, nft in enumerate(nfts, len(self)):
+            for field in self.int_fields:
+                self.columns[field].append(int(nft[field]))
+            for field in self.str_fields:
+                self.columns[field].append(strings.setdefault(nft[field], nft[field]))
+            for field in self.indexed_fields:
+                index = self.indexes[field]
+                value = int(nft[field], 16)
+                found = index.setdefault(value, position)
+                if type(found) is list:
+                    found.append(position)
+                elif found != position:
+                    index[value] = [found, position]
+
+    def __len__(self) -> int:
+        return len(self.columns['id'])
+
+    def entry(self, position: int) -> NftEntry:
+        columns = self.columns
+        entry = NftEntry.__new__(NftEntry)
+        for field in NftEntry.__slots__:
+            setattr(entry, field, columns[field][position])
+        return entry
+
+    # Entries whose `key` is in `values`, in the order of `values` (then in balance order)
+    def filter_by(self, key: str, values: list) -> NftBalance:
+        assert key in self.columns, f"Error filtering NFT balance: Invalid key {key}"
+
+        if key in self.indexed_fields:  # For hex strings, compare the underlying integer
+            index = self.indexes[key]
+            values = [int(v, 16) for v in values]
+        else:   # For other types (str, int), compare directly
+            index = {}
+            for position, value in enumerate(self.columns[key]):
+                index.setdefault(value, []).append(position)
+
+        positions = []
+        for value in dict.fromkeys(values):
+            found = index.get(value)
+            if type(found) is list:
+                positions.extend(found)
+            elif found is not None:
+                positions.append(found)
+        return NftBalance(totalNum=len(positions), data=[self.entry(position) for position in positions])
+
 class NftData(TypedDict):
     nftData: str
     minter: str
@@ -90,17 +182,65 @@ class NftData(TypedDict):
     royaltyAddress: str
     originalMinter: str
 
+# State of the mint of an NFT, from its manifest entry to its result, journaled as it progresses
+# `nft_data_poseidon_hash` is kept as an integer for signing and journaled as a hex string
+class MintJob(Record):
+    __slots__ = ('id', 'cid', 'amount', 'nft_id', 'nft_data_poseidon_hash', 'storage_id', 'nft_poseidon_hash', 'eddsa_signature', 'nft_mint_response')
+    id: int
+    cid: str
+    amount: int
+    nft_id: str
+    nft_data_poseidon_hash: int
+    storage_id: int
+    nft_poseidon_hash: str
+    eddsa_signature: str
+    nft_mint_response: MintResponseData
+
+    def __init__(self, id: int, cid: str, amount: int, nft_id: str, nft_data_poseidon_hash: int) -> None:
+        self.id = id
+        self.cid = cid
+        self.amount = amount
+        self.nft_id = nft_id
+        self.nft_data_poseidon_hash = nft_data_poseidon_hash
+
+    def to_dict(self) -> dict:
+        record = super().to_dict()
+        record['nft_data_poseidon_hash'] = "0x{0:0{1}x}".format(self.nft_data_poseidon_hash, 64)
+        return record
+
+# State of the transfer to a recipient (by its position in the recipients), journaled as it progresses
+class TransferJob(Record):
+    __slots__ = ('recipient', 'to', 'to_account', 'to_address', 'index', 'nftId', 'storage_id', 'nft_poseidon_hash', 'eddsa_signature', 'nft_transfer_response')
+    recipient: int
+    to: str
+    to_account: int
+    to_address: str
+    index: int
+    nftId: str
+    storage_id: int
+    nft_poseidon_hash: str
+    eddsa_signature: str
+    nft_transfer_response: TransferResponseData
+
+    def __init__(self, recipient: int, to: str, to_account: int, to_address: str) -> None:
+        self.recipient = recipient
+        self.to = to
+        self.to_account = to_account
+        self.to_address = to_address
+
 class MintResult:
     FAILED = -1
     SUCCESS = 0
     EXISTS = 1
     FEE_INVALID = 2
+    UNKNOWN = 3     # No response, timeout or server error: the mint may have been processed
     TESTMODE = 99
 
 class TransferResult:
     FAILED = -1
     SUCCESS = 0
     FEE_INVALID = 2
+    UNKNOWN = 3     # No response, timeout or server error: the transfer may have been processed
     TESTMODE = 99
 
 class TransferMode:
@@ -0,0 +1,135 @@
+import asyncio
+
+# Watches the off-chain fee while a batch runs, against the max fee its transactions were approved and signed with
+# Submission is paused while the fee is above that max fee (the API would reject the transactions with an invalid fee)
+# and resumed when it falls back: signed transactions stay valid, so nothing is approved or signed again
+# Rejections while the polled fee is under the max fee hold submission back for longer each time, up to `max_rejections` in a row
+class FeeWatcher(object):
+    max_fee: int
+    interval: float
+    paused_interval: float
+    max_rejections: int
+    decimals: int
+    symbol: str
+    fee: int
+    rejections: int     # Fee rejections in a row that the polled fee did not explain
+    resume_at: float    # Loop time before which submission is not resumed, after a rejection
+    error: Exception    # Raised by `wait` once there were too many rejections
+    resumed: asyncio.Event
+    wakeup: asyncio.Event
+    task: asyncio.Task
+
+    # `get_fee` is a coroutine function returning the current fee (None if unavailable), polled every `interval` seconds
+    # and every `paused_interval` seconds while paused, `on_change(paused, fee)` is called when submission is paused or resumed
+    # After the n-th rejection in a row, submission is held back for `paused_interval * 2^(n-1)` seconds at least
+    # Must be created within the event loop of the batch
+    def __init__(self, get_fee, max_fee: int, interval: float = 30, paused_interval: float = 10, max_rejections: int = 5,
+                 decimals: int = 0, symbol: str = '', on_change=None) -> None:
+        self.get_fee = get_fee
+        self.max_fee = max_fee
+        self.interval = interval
+        self.paused_interval = paused_interval
+        self.max_rejections = max_rejections
+        self.decimals = decimals
+        self.symbol = symbol
+        self.on_change = on_change
+        self.fee = None
+        self.rejections = 0
+        self.resume_at = 0
+        self.error = None
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    @property
+    def is_paused(self) -> bool:
+        return not self.resumed.is_set()
+
+    # Wait until transactions can be submitted, raises once the fee was rejected too many times in a row
+    async def wait(self) -> None:
+        await self.resumed.wait()
+        if self.error is not None:
+            raise self.error
+
+    # A transaction was rejected for its fee: pause now rather than at the next poll
+    # Those rejected while already paused were sent along with it, for the same fee
+    def exceeded(self) -> None:
+        if self.is_paused:
+            return
+        self.rejections += 1
+        if self.rejections > self.max_rejections:
+            self.error = RuntimeError(f"Fee rejected by the API {self.rejections} times in a row while the polled fee is under the {self.format(self.max_fee)} limit, stopping submission")
+            print(self.error)
+            return
+        hold = self.paused_interval * 2 ** (self.rejections - 1)
+        self.resume_at = asyncio.get_running_loop().time() + hold
+        self.pause(None, hold)
+        self.wakeup.set()
+
+    # A transaction was not rejected for its fee
+    def accepted(self) -> None:
+        self.rejections = 0
+
+    def update(self, fee: int) -> None:
+        self.fee = fee
+        if fee > self.max_fee:
+            self.rejections = 0     # Rejections explained by the fee
+            if not self.is_paused:
+                self.pause(fee)
+        elif self.is_paused and asyncio.get_running_loop().time() >= self.resume_at:
+            self.resume(fee)
+
+    def pause(self, fee: int, hold: float = 0) -> None:
+        self.resumed.clear()
+        if fee is None:
+            print(f"Fee rejected by the API ({self.rejections} in a row), pausing submission for {hold:g}s at least, until it is back under {self.format(self.max_fee)}")
+        else:
+            print(f"Fee increased to {self.format(fee)} above the {self.format(self.max_fee)} limit, pausing submission")
+        if self.on_change is not None:
+            self.on_change(True, fee)
+
+    def resume(self, fee: int) -> None:
+        self.resumed.set()
+        print(f"Fee back to {self.format(fee)} under the {self.format(self.max_fee)} limit, resuming submission")
+        if self.on_change is not None:
+            self.on_change(False, fee)
+
+    def format(self, fee: int) -> str:
+        return f"{fee / 10 ** self.decimals}{self.symbol}"
+
+    async def run(self) -> None:
+        while True:
+            # Not wait_for: it may swallow the cancellation of `stop` when the wakeup comes at the same time
+            wakeup = asyncio.ensure_future(self.wakeup.wait())
+            try:
+                done, _ = await asyncio.wait([wakeup], timeout=self.paused_interval if self.is_paused else self.interval)
+            finally:
+                wakeup.cancel()
+            if done:
+                self.wakeup.clear()
+                continue    # Paused in between, poll on the paused interval
+
+            fee = await self.get_fee()
+            if fee is not None:     # Otherwise the API is unavailable, keep the current state
+                self.update(fee)
@@ -0,0 +1,76 @@
+import bisect
+import hashlib
+
+DIGEST_MASK = (1 << 64) - 1
+
+# Set of integer IDs kept as sorted ranges of consecutive IDs: its size depends on the gaps between the IDs, not on their number
+# Each range also keeps the sum of the digests of the (ID, CID) pairs added to it, to check them against a manifest without the CIDs
+class IdRanges(object):
+    starts: 'list[int]'
+    ends: 'list[int]'       # Inclusive
+    digests: 'list[int]'
+    count: int
+
+    def __init__(self) -> None:
+        self.starts = []
+        self.ends = []
+        self.digests = []
+        self.count = 0
+
+    @staticmethod
+    def digest(id: int, cid: str) -> int:
+        return int.from_bytes(hashlib.blake2b(f"{id}:{cid}".encode(), digest_size=8).digest(), 'big')
+
+    # Index of the range containing `id`, None if it is not in the set
+    def find(self, id: int) -> int:
+        i = bisect.bisect_right(self.starts, id) - 1
+        return i if i >= 0 and id <= self.ends[i] else None
+
+    def __contains__(self, id: int) -> bool:
+        return self.find(id) is not None
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Add `id` with its `cid`, an ID already in the set keeps its first CID
+    def add(self, id: int, cid: str) -> None:
+        i = bisect.bisect_right(self.starts, id) - 1     # Last range starting at or before `id`
+        if i >= 0 and id <= self.ends[i]:
+            return
+        digest = self.digest(id, cid)
+        self.count += 1
+
+        extends_previous = i >= 0 and self.ends[i] == id - 1
+        extends_next = i + 1 < len(self.starts) and self.starts[i + 1] == id + 1
+        if extends_previous and extends_next:   # Fills the gap between two ranges
+            self.ends[i] = self.ends[i + 1]
+            self.digests[i] = (self.digests[i] + self.digests[i + 1] + digest) & DIGEST_MASK
+            del self.starts[i + 1], self.ends[i + 1], self.digests[i + 1]
+        elif extends_previous:
+            self.ends[i] = id
+            self.digests[i] = (self.digests[i] + digest) & DIGEST_MASK
+        elif extends_next:
+            self.starts[i + 1] = id
+            self.digests[i + 1] = (self.digests[i + 1] + digest) & DIGEST_MASK
+        else:
+            self.starts.insert(i + 1, id)
+            self.ends.insert(i + 1, id)
+            self.digests.insert(i + 1, digest)
+
+    # Keep only the ranges whose (ID, CID) pairs are all those of `entries` ({'ID', 'CID'} of a manifest), in one pass over them
+    # Returns the number of IDs dropped, e.g. when the CID of an ID changed in the manifest
+    def verify(self, entries) -> int:
+        sums = [0] * len(self.starts)
+        for entry in entries:
+            i = self.find(entry['ID'])
+            if i is not None:
+                sums[i] = (sums[i] + self.digest(entry['ID'], entry['CID'])) & DIGEST_MASK
+
+        kept = [i for i in range(len(self.starts)) if sums[i] == self.digests[i]]
+        count = sum(self.ends[i] - self.starts[i] + 1 for i in kept)
+        dropped = self.count - count
+        self.starts = [self.starts[i] for i in kept]
+        self.ends = [self.ends[i] for i in kept]
+        self.digests = [self.digests[i] for i in kept]
+        self.count = count
+        return dropped
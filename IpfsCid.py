@@ -0,0 +1,84 @@
+import hashlib
+import base58
+
+# CIDv0 of files, identical to `ipfs add` / ipfs-only-hash with their default options:
+# UnixFS files in dag-pb nodes, chunks of 262144 bytes in "file" leaves (no raw leaves),
+# balanced DAG of at most 174 links per node, a file of a single chunk is its own root
+CHUNK_SIZE = 262144
+MAX_CHILDREN = 174
+
+UNIXFS_FILE = 2
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def length_delimited(field: int, value: bytes) -> bytes:
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+def unsigned(field: int, value: int) -> bytes:
+    return varint(field << 3) + varint(value)
+
+# UnixFS Data message (proto2: blocksizes are not packed, Data is omitted when empty)
+def unixfs_file(data: bytes, filesize: int, blocksizes: 'list[int]') -> bytes:
+    message = unsigned(1, UNIXFS_FILE)
+    if data:
+        message += length_delimited(2, data)
+    message += unsigned(3, filesize)
+    for blocksize in blocksizes:
+        message += unsigned(4, blocksize)
+    return message
+
+# PBNode with its Links (Hash, Name, Tsize) before its Data, as serialized by dag-pb
+def pb_node(links: list, data: bytes) -> bytes:
+    node = b''
+    for hash, tsize in links:
+        node += length_delimited(2, length_delimited(1, hash) + length_delimited(2, b'') + unsigned(3, tsize))
+    return node + length_delimited(1, data)
+
+def sha256_multihash(block: bytes) -> bytes:
+    return b'\x12\x20' + hashlib.sha256(block).digest()
+
+# A node of the DAG as linked from its parent: (multihash, cumulative block size, file bytes below it)
+def leaf(chunk: bytes) -> tuple:
+    block = pb_node([], unixfs_file(chunk, len(chunk), []))
+    return sha256_multihash(block), len(block), len(chunk)
+
+def parent(children: list) -> tuple:
+    filesize = sum(child[2] for child in children)
+    block = pb_node([(hash, tsize) for hash, tsize, _ in children], unixfs_file(b'', filesize, [child[2] for child in children]))
+    return sha256_multihash(block), len(block) + sum(child[1] for child in children), filesize
+
+def file_multihash(path: str) -> bytes:
+    nodes = []
+    with open(path, 'rb', buffering=0) as f:
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            # Fill a whole chunk, short reads only end the file
+            size = 0
+            while size < CHUNK_SIZE and (read := f.readinto(view[size:])):
+                size += read
+            if size == 0 and len(nodes) > 0:
+                break
+            nodes.append(leaf(bytes(view[:size])))
+            if size < CHUNK_SIZE:
+                break
+
+    if len(nodes) == 1:
+        return nodes[0][0]
+
+    # Balanced layout: group nodes by MAX_CHILDREN until a single root is left
+    while True:
+        nodes = [parent(nodes[i:i + MAX_CHILDREN]) for i in range(0, len(nodes), MAX_CHILDREN)]
+        if len(nodes) == 1:
+            return nodes[0][0]
+
+def file_cid(path: str, version: int=0) -> str:
+    if version != 0:
+        raise ValueError(f'Unsupported CID version: {version} (only CIDv0 is supported)')
+    return base58.b58encode(file_multihash(path)).decode()
@@ -0,0 +1,59 @@
+import json
+import time
+import os
+
+# Values of a record that JSON cannot encode: per-item records (see DataClasses.Record) are encoded as their dict,
+# one at a time as the record is written
+def encode(value):
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Append-only JSON lines journal
+# Records are flushed as they are appended and fsynced at most every `fsync_interval` seconds,
+# so a crash loses at most the last interval (an OS crash) and nothing on a process kill
+class Journal(object):
+    path: str
+    fsync_interval: float
+    last_fsync: float
+
+    def __init__(self, path: str, append: bool = False, fsync_interval: float = 1.0) -> None:
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.monotonic()
+        self.file = open(path, 'a' if append else 'w')
+
+    # `sync` forces the record to disk, for records that must survive an OS crash (e.g. before sending a transaction)
+    def append(self, record: dict, sync: bool = False) -> None:
+        self.file.write(json.dumps(record, default=encode) + '\n')
+        self.file.flush()
+        if sync or time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    # Iterate over the records of a journal, a last line truncated by a crash is ignored
+    @staticmethod
+    def read(path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def __enter__(self) -> 'Journal':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
@@ -1,21 +1,44 @@
 import aiohttp
+import asyncio
 import urllib
 from typing import cast
 from pprint import pprint
+import collections
+import functools
+import itertools
+import heapq
+import json
 import os
+import time
 
 from DataClasses import *
+from AccountCache import AccountCache
+from StorageIdLeases import StorageIdLeases
+from RetryPolicy import RetryPolicy, CircuitBreaker
+from RateLimiter import RateLimiter
+from ApiMetrics import ApiMetrics
+from Profiler import profiler
 
 from hello_loopring.sdk.ethsnarks.field import SNARK_SCALAR_FIELD
 from hello_loopring.sdk.ethsnarks.poseidon import poseidon_params
 from hello_loopring.sdk.sig_utils.eddsa_utils import *
 
+# Poseidon round constants and MDS matrix only depend on these parameters, generate each set once per process
+@functools.lru_cache(maxsize=None)
+def cached_poseidon_params(t: int, nRoundsF: int, nRoundsP: int, seed: bytes):
+    return poseidon_params(SNARK_SCALAR_FIELD, t, nRoundsF, nRoundsP, seed, 5, security_target=128)
+
+# Signers hold no state besides their parameters and key, reuse one instance per (helper class, key, ...)
+@functools.lru_cache(maxsize=None)
+def get_signer(helper_class: type, *args) -> EddsaSignHelper:
+    return helper_class(*args)
+
 class NFTDataEddsaSignHelper(EddsaSignHelper):
     MAX_INPUTS: int = 6
 
     def __init__(self, private_key="0x1"):
         super(NFTDataEddsaSignHelper, self).__init__(
-            poseidon_params = poseidon_params(SNARK_SCALAR_FIELD, self.MAX_INPUTS+1, 6, 52, b'poseidon', 5, security_target=128),
+            poseidon_params = cached_poseidon_params(self.MAX_INPUTS+1, 6, 52, b'poseidon'),
             private_key = private_key
         )
 
@@ -27,7 +50,7 @@ class NFTTransferEddsaSignHelper(EddsaSignHelper):
 
     def __init__(self, private_key="0x1"):
         super(NFTTransferEddsaSignHelper, self).__init__(
-            poseidon_params = poseidon_params(SNARK_SCALAR_FIELD, self.MAX_INPUTS+1, 6, 53, b'poseidon', 5, security_target=128),
+            poseidon_params = cached_poseidon_params(self.MAX_INPUTS+1, 6, 53, b'poseidon'),
             private_key = private_key
         )
 
@@ -39,7 +62,7 @@ class NFTEddsaSignHelper(EddsaSignHelper):
 
     def __init__(self, private_key="0x1"):
         super(NFTEddsaSignHelper, self).__init__(
-            poseidon_params = poseidon_params(SNARK_SCALAR_FIELD, self.MAX_INPUTS+1, 6, 53, b'poseidon', 5, security_target=128),
+            poseidon_params = cached_poseidon_params(self.MAX_INPUTS+1, 6, 53, b'poseidon'),
             private_key = private_key
         )
 
@@ -50,7 +73,7 @@ class UrlEddsaSignHelper(EddsaSignHelper):
     def __init__(self, private_key, host=""):
         self.host = host
         super(UrlEddsaSignHelper, self).__init__(
-            poseidon_params = poseidon_params(SNARK_SCALAR_FIELD, 2, 6, 53, b'poseidon', 5, security_target=128),
+            poseidon_params = cached_poseidon_params(2, 6, 53, b'poseidon'),
             private_key = private_key
         )
     
@@ -75,84 +98,191 @@ class UrlEddsaSignHelper(EddsaSignHelper):
 
 class LoopringMintService(object):
     base_url: str = "https://api3.loopring.io"
+    shared_session: aiohttp.ClientSession = None    # Long-lived pooled session, see `open_shared_session`
+    account_cache: AccountCache = None              # Persistent cache of ENS and account resolutions, if set
+    retry_policy: RetryPolicy = RetryPolicy()
+    circuit_breaker: CircuitBreaker = CircuitBreaker()  # Shared by all requests, to pause the whole batch during an outage
+    read_limiter: RateLimiter = RateLimiter(rate=20, max_rate=200, window=8, max_window=64)    # Budget of GET requests
+    write_limiter: RateLimiter = RateLimiter(rate=5, max_rate=100, window=4, max_window=32)    # Budget of mints and transfers
+    metrics: ApiMetrics = ApiMetrics()              # Latency, statuses, retries and bytes of every request by endpoint
     session: aiohttp.ClientSession
+    owns_session: bool
     last_status: int
     last_error: dict
 
     def __init__(self, timeout = None) -> None:
-        if timeout:
+        self.last_status = None
+        self.last_error = None
+
+        # Reuse the pooled connections of the shared session when one is open
+        self.owns_session = timeout is not None or LoopringMintService.shared_session is None
+        if not self.owns_session:
+            self.session = LoopringMintService.shared_session
+        elif timeout:
             self.session = aiohttp.ClientSession(base_url=self.base_url, timeout=timeout)
         else:
             self.session = aiohttp.ClientSession(base_url=self.base_url)
 
+    # Open the session shared by all `LoopringMintService` instances until `close_shared_session`
+    # Connections are kept alive for `keepalive_timeout` seconds and DNS lookups cached for `dns_cache_ttl` seconds
+    @classmethod
+    async def open_shared_session(cls, keepalive_timeout: float = 30, limit_per_host: int = 16, dns_cache_ttl: int = 300, warmup: int = 0) -> None:
+        await cls.close_shared_session()
+        connector = aiohttp.TCPConnector(keepalive_timeout=keepalive_timeout,
+                                         limit_per_host=limit_per_host,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=dns_cache_ttl)
+        cls.shared_session = aiohttp.ClientSession(base_url=cls.base_url, connector=connector)
+        if warmup > 0:
+            await cls.warm_up(warmup)
+
+    # Establish `connections` TCP/TLS connections ahead of the batch
+    @classmethod
+    async def warm_up(cls, connections: int) -> None:
+        async def ping():
+            try:
+                async with cls.shared_session.get("/api/v3/timestamp") as response:
+                    await response.read()
+            except aiohttp.ClientError as client_err:
+                print(f"Error warming up connection: {client_err}")
+
+        await asyncio.gather(*[ping() for _ in range(connections)])
+
+    @classmethod
+    async def close_shared_session(cls) -> None:
+        if cls.shared_session is not None:
+            await cls.shared_session.close()
+            cls.shared_session = None
+
+    # Send a request with the retry policy, circuit breaker and rate limiter, returns the parsed response or None on failure
+    # `what` describes the request in error messages, the error response is kept in `last_error`
+    async def _request(self, method: str, path: str, what: str, params: dict = None, data: dict = None, headers: dict = None):
+        policy = self.retry_policy
+        breaker = self.circuit_breaker
+        idempotent = method == "GET"
+        limiter = self.read_limiter if idempotent else self.write_limiter
+        attempt = 0
+
+        # JSON body serialized once, for all attempts
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers = dict(headers or {}, **{"Content-Type": "application/json"})
+
+        while True:
+            probe = await breaker.wait()
+            try:
+                with profiler.phase('rate_limiter_wait', cpu=False):
+                    await limiter.acquire()
+            except asyncio.CancelledError:
+                breaker.cancelled(probe)
+                raise
+            parsed = None
+            retry_after = None
+            status = None
+            received = 0
+            started = time.monotonic()
+            try:
+                async with self.session.request(method, path, params=params, data=body, headers=headers, timeout=aiohttp.ClientTimeout(total=policy.timeout)) as response:
+                    self.last_status = status = response.status
+                    retry_after = response.headers.get("Retry-After")
+                    content = await response.read()
+                    received = len(content)
+                    try:
+                        parsed = json.loads(content) if content.strip() else None
+                    except ValueError:
+                        parsed = None
+
+                if response.status >= 500:
+                    breaker.failure(probe)
+                else:
+                    breaker.success()
+                if response.status < 400:
+                    return parsed
+
+                error = f"{response.status} {response.reason}"
+                retryable = policy.retry_status(response.status, idempotent)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                self.last_status = None     # No complete response, even if its status was received
+                breaker.failure(probe)
+                error = repr(err)
+                retryable = policy.retry_exception(err, idempotent)
+            except asyncio.CancelledError:
+                breaker.cancelled(probe)
+                raise
+            finally:
+                latency = time.monotonic() - started
+                limiter.release(status, latency)
+                self.metrics.observe(method, path, status, latency, len(body) if body else 0, received)
+
+            if retryable and attempt < policy.retries:
+                self.metrics.retry(method, path)
+                # Failures during an outage wait for the circuit to close instead of using up the retries
+                if not breaker.is_open:
+                    attempt += 1
+                await asyncio.sleep(policy.delay(attempt, retry_after))
+                continue
+
+            print(f"Error {what}: {error}")
+            pprint(parsed)
+            self.last_error = parsed
+            return None
+
     async def resolveENS(self, ens: str) -> str:
         params = {"fullName": ens}
-        headers = {}
         address_resp = None
+
+        if self.account_cache is not None:
+            address_resp = self.account_cache.get_ens(ens)
+            if address_resp is not None:
+                return address_resp
+
         print(f"Resolving ENS {ens}... ", end='')
 
-        try:
-            response = await self.session.get("/api/wallet/v3/resolveEns", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            address_resp = parsed["data"]
-        except aiohttp.ClientError as client_err:
-            print(f"Error resolving ENS: {client_err}")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred resolving ENS: {err}")
-            pprint(parsed)
-            self.last_error = parsed
+        parsed = await self._request("GET", "/api/wallet/v3/resolveEns", "resolving ENS", params=params)
+        if parsed is not None:
+            address_resp = parsed.get("data")
+            if self.account_cache is not None and address_resp:
+                self.account_cache.put_ens(ens, address_resp)
 
         print(f"done!")
         return address_resp
 
     async def getAccountId(self, address: str) -> str:
         params = {"owner": address}
-        headers = {}
         account_id = None
 
-        try:
-            response = await self.session.get("/api/v3/account", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            account_id = parsed["accountId"]
-        except aiohttp.ClientError as client_err:
-            print(f"Error getting account ID: {client_err}")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred getting account ID: {err}")
-            pprint(parsed)
-            self.last_error = parsed
+        if not address:     # E.g. an ENS that did not resolve
+            print("Error getting account ID: missing address")
+            return account_id
+
+        if self.account_cache is not None:
+            account_id = self.account_cache.get_account_id(address)
+            if account_id is not None:
+                return account_id
+
+        parsed = await self._request("GET", "/api/v3/account", "getting account ID", params=params)
+        if parsed is not None:
+            account_id = parsed.get("accountId")
+            if self.account_cache is not None and account_id is not None:
+                self.account_cache.put_account(account_id, address)
 
         return account_id
 
     async def getAccountAddress(self, account_id: int) -> str:
         params = {"accountId": account_id}
-        headers = {}
         address_resp = None
 
-        try:
-            response = await self.session.get("/api/v3/account", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            address_resp = parsed["owner"]
-        except aiohttp.ClientError as client_err:
-            print(f"Error getting user api key: {client_err}")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred getting user api key: {err}")
-            pprint(parsed)
-            self.last_error = parsed
+        if self.account_cache is not None:
+            address_resp = self.account_cache.get_address(account_id)
+            if address_resp is not None:
+                return address_resp
+
+        parsed = await self._request("GET", "/api/v3/account", "getting account address", params=params)
+        if parsed is not None:
+            address_resp = parsed.get("owner")
+            if self.account_cache is not None and address_resp:
+                self.account_cache.put_account(account_id, address_resp)
 
         return address_resp
 
@@ -165,67 +295,52 @@ class LoopringMintService(object):
             "data": {}
         }
 
-        signer = UrlEddsaSignHelper(privateKey, self.base_url)
+        signer = get_signer(UrlEddsaSignHelper, privateKey, self.base_url)
         eddsaSignature = signer.sign(request)
 
         headers = {"x-api-sig": eddsaSignature}
-        api_key_resp = None
 
-        try:
-            response = await self.session.get(request["path"], params=request["params"], headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            api_key_resp = cast(ApiKeyResponse, parsed)
-        except aiohttp.ClientError as client_err:
-            print(f"Error getting user api key: {client_err}")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred getting user api key: {err}")
-            pprint(parsed)
-            self.last_error = parsed
-
-        return api_key_resp
+        parsed = await self._request(request["method"], request["path"], "getting user api key", params=request["params"], headers=headers)
+        return cast(ApiKeyResponse, parsed)
 
-    async def getUserNftBalance(self, apiKey: str, accountId: int) -> NftBalance:
-
-        end_reached = False
-        offset = 0
-        limit = 50
+    async def getUserNftBalancePage(self, apiKey: str, accountId: int, offset: int, limit: int) -> NftBalance:
+        params = {"accountId": accountId,
+                  "limit": limit,
+                  "offset": offset}
+        headers = {"x-api-key": apiKey}
 
+        parsed = await self._request("GET", "/api/v3/user/nft/balances", f"getting nft balance (offset {offset})", params=params, headers=headers)
+        return cast(NftBalance, parsed)
+
+    # Pages of the balance in order: the first page gives `totalNum`, the next `concurrency` pages are then fetched ahead
+    # so that only those are held at once while the caller consumes them
+    # On failure (after the retries of the retry policy), the pages stop at the last contiguous page fetched
+    async def iterUserNftBalancePages(self, apiKey: str, accountId: int, limit: int = 50, concurrency: int = 8):
+        first_page = await self.getUserNftBalancePage(apiKey, accountId, 0, limit)
+        if first_page is None:
+            return
+        yield first_page
+
+        offsets = iter(range(limit, first_page['totalNum'], limit))
+        pending = collections.deque(asyncio.ensure_future(self.getUserNftBalancePage(apiKey, accountId, offset, limit))
+                                    for offset in itertools.islice(offsets, concurrency))
+        try:
+            while pending:
+                page = await pending.popleft()
+                if page is None:
+                    return
+                for offset in itertools.islice(offsets, 1):
+                    pending.append(asyncio.ensure_future(self.getUserNftBalancePage(apiKey, accountId, offset, limit)))
+                yield page
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def getUserNftBalance(self, apiKey: str, accountId: int, limit: int = 50, concurrency: int = 8) -> NftBalance:
         nft_balance = NftBalance({'totalNum': 0, 'data': []})
-        while not end_reached:
-            params = {"accountId": accountId,
-                    "limit": limit,
-                    "offset": offset}
-            headers = {"x-api-key": apiKey}
-            nft_balance_limit = NftBalance({'totalNum': 0, 'data': []})
-
-            try:
-                response = await self.session.get("/api/v3/user/nft/balances", params=params, headers=headers)
-                parsed = await response.json()
-                self.last_status = response.status
-
-                response.raise_for_status()
-                nft_balance_limit = cast(NftBalance, parsed)
-
-                end_reached = (limit + offset) >= nft_balance_limit['totalNum']
-
-                offset = offset + limit
-                nft_balance['data'].extend(nft_balance_limit['data'])
-                nft_balance['totalNum'] += len(nft_balance_limit['data'])
-            except aiohttp.ClientError as client_err:
-                print(f"Error getting storage id: {client_err}")
-                pprint(parsed)
-                self.last_error = parsed
-                break
-            except Exception as err:
-                print(f"An error ocurred getting storage id: {err}")
-                pprint(parsed)
-                self.last_error = parsed
-                break
+        async for nft_balance_page in self.iterUserNftBalancePages(apiKey, accountId, limit, concurrency):
+            nft_balance['data'].extend(nft_balance_page['data'])
+            nft_balance['totalNum'] += len(nft_balance_page['data'])
 
         return nft_balance
 
@@ -234,99 +349,33 @@ class LoopringMintService(object):
                   "sellTokenId": sellTokenId,
                   "maxNext": 1}
         headers = {"x-api-key": apiKey}
-        storage_id = None
 
-        try:
-            response = await self.session.get("/api/v3/storageId", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            storage_id = cast(StorageId, parsed)
-        except aiohttp.ClientError as client_err:
-            print(f"Error getting storage id: ")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred getting storage id: {err}")
-            pprint(parsed)
-            self.last_error = parsed
-
-        return storage_id
+        parsed = await self._request("GET", "/api/v3/storageId", "getting storage id", params=params, headers=headers)
+        return cast(StorageId, parsed)
 
     async def computeTokenAddress(self, apiKey: str, counterFactualNftInfo: CounterFactualNftInfo) -> CounterFactualNft:
         params = {"nftFactory": counterFactualNftInfo['nftFactory'],
                   "nftOwner": counterFactualNftInfo['nftOwner'],
                   "nftBaseUri": counterFactualNftInfo['nftBaseUri']}
         headers = {"x-api-key": apiKey}
-        counterfactual_nft = None
 
-        try:
-            response = await self.session.request("get", "/api/v3/nft/info/computeTokenAddress", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            counterfactual_nft = cast(CounterFactualNft, parsed)
-        except aiohttp.ClientError as client_err:
-            print(f"Error computing token address: ")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred computing token address: {err}")
-            pprint(parsed)
-            self.last_error = parsed
-
-        return counterfactual_nft
+        parsed = await self._request("GET", "/api/v3/nft/info/computeTokenAddress", "computing token address", params=params, headers=headers)
+        return cast(CounterFactualNft, parsed)
 
     async def getOffChainFee(self, apiKey: str, accountId: int, requestType: int, tokenAddress: str) -> OffchainFee:
         params = {"accountId": accountId,
                   "requestType": requestType,
                   "tokenAddress": tokenAddress}
         headers = {"x-api-key": apiKey}
-        off_chain_fee = None
-
-        try:
-            response = await self.session.request("get", "/api/v3/user/nft/offchainFee", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            off_chain_fee = cast(OffchainFee, parsed)
-        except aiohttp.ClientError as client_err:
-            print(f"Error getting off chain fee: ")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred getting off chain fee: {err}")
-            pprint(parsed)
-            self.last_error = parsed
 
-        return off_chain_fee
+        parsed = await self._request("GET", "/api/v3/user/nft/offchainFee", "getting off chain fee", params=params, headers=headers)
+        return cast(OffchainFee, parsed)
 
     async def getNftData(self, nftDatas: str) -> 'list[NftData]':
         params = {"nftDatas": nftDatas}
-        headers = {}
-        nft_data = None
-
-        try:
-            response = await self.session.request("get", "/api/v3/nft/info/nfts", params=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-            
-            response.raise_for_status()
-            nft_data = cast('list[NftData]', parsed)
-        except aiohttp.ClientError as client_err:
-            print(f"Error getting nft datas: {client_err}")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print(f"An error ocurred getting nft datas: {err}")
-            pprint(parsed)
-            self.last_error = parsed
-
-        return nft_data
 
+        parsed = await self._request("GET", "/api/v3/nft/info/nfts", "getting nft datas", params=params)
+        return cast('list[NftData]', parsed)
 
     async def mintNft(
             self,
@@ -377,26 +426,9 @@ class LoopringMintService(object):
             params["royaltyAddress"] = royaltyAddress
         
         headers = {"x-api-key": apiKey}
-        nft_mint_data = None
 
-        try:
-            response = await self.session.post("/api/v3/nft/mint", json=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            nft_mint_data = cast(MintResponseData, parsed)
-        except aiohttp.ClientError as client_err:
-            print("Error minting nft: ")
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print("An error ocurred minting nft: ")
-            pprint(err)
-            pprint(parsed)
-            self.last_error = parsed
-
-        return nft_mint_data
+        parsed = await self._request("POST", "/api/v3/nft/mint", "minting nft", data=params, headers=headers)
+        return cast(MintResponseData, parsed)
 
 
     async def transferNft(
@@ -445,30 +477,83 @@ class LoopringMintService(object):
             "x-api-key": apiKey,
             "x-api-sig": ecdsaSignature
         }
-        transfer_data = None
-
-        try:
-            response = await self.session.post("/api/v3/nft/transfer", json=params, headers=headers)
-            parsed = await response.json()
-            self.last_status = response.status
-
-            response.raise_for_status()
-            transfer_data = cast(TransferResponseData, parsed)
-        except aiohttp.ClientError as client_err:
-            print("Error transferring nft: ")
-            pprint(client_err)
-            pprint(parsed)
-            self.last_error = parsed
-        except Exception as err:
-            print("An error ocurred transferring nft: ")
-            pprint(err)
-            pprint(parsed)
-            self.last_error = parsed
 
-        return transfer_data
+        parsed = await self._request("POST", "/api/v3/nft/transfer", "transferring nft", data=params, headers=headers)
+        return cast(TransferResponseData, parsed)
 
     async def __aenter__(self) -> 'LoopringMintService':
         return self
 
     async def __aexit__(self, exc_type, exc, tb) -> None:
-        await self.session.close()
+        if self.owns_session:
+            await self.session.close()
+
+# Hands out offchain storage IDs locally for each sell token, stepping by 2 like the API does
+# The first ID of a token is fetched once from the API, IDs given back with `release` (rejected submits) are reused first
+# With `leases`, IDs are taken from ranges of `lease_size` IDs leased from the processes sharing the account
+class StorageIdAllocator(object):
+    apiKey: str
+    accountId: int
+    next_ids: 'dict[int, int]'
+    limits: 'dict[int, int]'
+    released: 'dict[int, list[int]]'
+    locks: 'dict[int, asyncio.Lock]'
+    leases: StorageIdLeases
+    lease_size: int
+
+    def __init__(self, apiKey: str, accountId: int, leases: StorageIdLeases = None, lease_size: int = 100) -> None:
+        self.apiKey = apiKey
+        self.accountId = accountId
+        self.next_ids = {}
+        self.limits = {}    # End of the leased range of each token
+        self.released = {}
+        self.locks = {}
+        self.leases = leases
+        self.lease_size = lease_size
+
+    # Start the IDs of `sellTokenId` from a storage id already obtained from the API
+    def seed(self, sellTokenId: int, offchain_id: int) -> None:
+        if self.leases is not None:     # The next range is leased from there at least
+            self.leases.seed(self.accountId, sellTokenId, offchain_id)
+            self.next_ids.setdefault(sellTokenId, 0)
+        else:
+            self.next_ids[sellTokenId] = max(offchain_id, self.next_ids.get(sellTokenId, offchain_id))
+        self.released.setdefault(sellTokenId, [])
+
+    async def fetch(self, sellTokenId: int) -> int:
+        async with LoopringMintService() as lms:
+            storage_id = await lms.getNextStorageId(apiKey=self.apiKey, accountId=self.accountId, sellTokenId=sellTokenId)
+        if storage_id is None:
+            raise RuntimeError(f"Failed to obtain storage id for token {sellTokenId}")
+        return storage_id['offchainId']
+
+    # Waits for the first fetch of `sellTokenId` and for a reconcile in flight, no ID is handed out before the API was checked
+    async def next(self, sellTokenId: int) -> int:
+        async with self.locks.setdefault(sellTokenId, asyncio.Lock()):
+            if sellTokenId not in self.next_ids:
+                self.seed(sellTokenId, await self.fetch(sellTokenId))
+
+            if self.released[sellTokenId]:
+                return heapq.heappop(self.released[sellTokenId])
+            if self.leases is not None and self.next_ids[sellTokenId] >= self.limits.get(sellTokenId, 0):
+                self.next_ids[sellTokenId] = self.leases.lease(self.accountId, sellTokenId, self.lease_size)
+                self.limits[sellTokenId] = self.next_ids[sellTokenId] + 2 * self.lease_size
+            offchain_id = self.next_ids[sellTokenId]
+            self.next_ids[sellTokenId] += 2
+            return offchain_id
+
+    def release(self, sellTokenId: int, offchain_id: int) -> None:
+        heapq.heappush(self.released[sellTokenId], offchain_id)
+
+    # Re-sync with the API after a failure: IDs used elsewhere are dropped and the next ID is never behind the API
+    async def reconcile(self, sellTokenId: int) -> None:
+        async with self.locks.setdefault(sellTokenId, asyncio.Lock()):
+            api_next_id = await self.fetch(sellTokenId)
+            self.seed(sellTokenId, api_next_id)
+            if self.leases is not None:
+                # The API is ahead of the leased range whenever another process used a later range: the range is kept,
+                # only the released IDs (which may have been consumed) are dropped
+                self.released[sellTokenId] = []
+                return
+            self.released[sellTokenId] = [offchain_id for offchain_id in self.released[sellTokenId] if offchain_id >= api_next_id]
+            heapq.heapify(self.released[sellTokenId])
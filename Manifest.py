@@ -0,0 +1,96 @@
+import json
+import csv
+import os
+import re
+
+# Streaming reader of collection manifests, lists of NFT IDs and CIDs in one of these formats:
+#  - JSON array: [{"ID": 1, "CID": "Qm..."}, ...] (metadata-cids.json)
+#  - JSON lines: {"ID": 1, "CID": "Qm..."} on each line
+#  - CSV: ID,CID on each line, with an optional header naming the ID and CID columns
+# Entries are read lazily, so memory does not depend on the size of the collection
+
+SEPARATORS = re.compile(r'[\s,]*')
+
+def manifest_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.jsonl', '.ndjson']:
+        return 'jsonl'
+    elif extension == '.csv':
+        return 'csv'
+
+    # Otherwise a JSON array or JSON lines, from the first character
+    with open(path, 'r') as f:
+        while (c := f.read(1)) and c.isspace():
+            pass
+    return 'json' if c == '[' else 'jsonl'
+
+# Items of a JSON array, decoded one at a time from chunks of the file
+def read_json_array(f, chunk_size: int = 1 << 16):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    index = 0
+    eof = False
+    opened = False
+
+    while True:
+        index = SEPARATORS.match(buffer, index).end()
+        if index < len(buffer):
+            if not opened:
+                if buffer[index] != '[':
+                    raise ValueError(f"Expected a JSON array, found '{buffer[index]}'")
+                opened = True
+                index += 1
+                continue
+            if buffer[index] == ']':
+                return
+
+            try:
+                item, index = decoder.raw_decode(buffer, index)
+                yield item
+                continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("Unterminated JSON array")
+
+        # Item incomplete or buffer exhausted, read the next chunk
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[index:] + chunk
+        index = 0
+
+def read_json_lines(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+def read_csv(f):
+    columns = None
+    for row in csv.reader(f):
+        if len(row) == 0:
+            continue
+        if columns is None:
+            names = [name.strip().lower() for name in row]
+            if 'id' in names and 'cid' in names:   # Header
+                columns = names.index('id'), names.index('cid')
+                continue
+            columns = 0, 1
+        yield {'ID': row[columns[0]], 'CID': row[columns[1]]}
+
+# Yield the {'ID', 'CID'} entries of a manifest with start <= ID <= end (no upper bound if `end` is None)
+def read_manifest(path: str, start: int = 1, end: int = None):
+    format = manifest_format(path)
+    with open(path, 'r', newline='' if format == 'csv' else None) as f:
+        if format == 'json':
+            entries = read_json_array(f)
+        elif format == 'jsonl':
+            entries = read_json_lines(f)
+        else:
+            entries = read_csv(f)
+
+        for entry in entries:
+            id = int(entry['ID'])
+            if id < start or (end is not None and id > end):
+                continue
+            yield {'ID': id, 'CID': str(entry['CID']).strip()}
@@ -0,0 +1,143 @@
+import contextlib
+import tracemalloc
+import cProfile
+import pstats
+import json
+import time
+import os
+
+# Totals of a profiled phase
+class PhaseStats(object):
+    calls: int
+    items: int
+    wall: float
+    cpu: float
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.items = 0
+        self.wall = 0.0
+        self.cpu = None
+
+    def add(self, items: int, wall: float, cpu: float) -> None:
+        self.calls += 1
+        self.items += items
+        self.wall += wall
+        if cpu is not None:
+            self.cpu = (self.cpu or 0.0) + cpu
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls,
+                'items': self.items,
+                'wall': round(self.wall, 6),
+                'cpu': round(self.cpu, 6) if self.cpu is not None else None,
+                'wall_per_item': round(self.wall / self.items, 6) if self.items else None,
+                'cpu_per_item': round(self.cpu / self.items, 6) if self.items and self.cpu is not None else None}
+
+def cpu_time() -> float:
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+# Wall and CPU time of the phases of a run (e.g. signing, API calls), enabled with --profile
+# Phases wrapping awaits overlap with the other tasks of the event loop: their wall time is the time each item waited,
+# their CPU time is not recorded (`cpu=False`) as it would include the other tasks
+# CPU time includes the child processes that exited during the phase, and the time reported by signing workers
+class Profiler(object):
+    enabled: bool
+    mode: str
+    phases: 'dict[str, PhaseStats]'
+    started: float
+    started_cpu: float
+    cprofile: cProfile.Profile
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.mode = None
+        self.phases = {}
+        self.cprofile = None
+
+    # `mode` is 'time' (phases only), 'cprofile' (phases and function profile) or 'tracemalloc' (phases and allocations)
+    def start(self, mode: str = 'time') -> None:
+        self.enabled = True
+        self.mode = mode
+        self.phases = {}
+        self.started = time.perf_counter()
+        self.started_cpu = cpu_time()
+        if mode == 'cprofile':
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif mode == 'tracemalloc':
+            tracemalloc.start()
+
+    def record(self, name: str, wall: float, cpu: float = None, items: int = 1) -> None:
+        if not self.enabled:
+            return
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats()
+        stats.add(items, wall, cpu)
+
+    @contextlib.contextmanager
+    def phase(self, name: str, items: int = 1, cpu: bool = True):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        started_cpu = cpu_time() if cpu else None
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, cpu_time() - started_cpu if cpu else None, items)
+
+    # Stop profiling, print the ranked summary and write it to `<path>.json` (and the cProfile stats to `<path>.pstats`)
+    def stop(self, path: str) -> None:
+        if not self.enabled:
+            return
+        self.enabled = False
+        wall = time.perf_counter() - self.started
+        cpu = cpu_time() - self.started_cpu
+
+        report = {'mode': self.mode,
+                  'wall': round(wall, 6),
+                  'cpu': round(cpu, 6),
+                  'phases': {name: stats.to_dict() for name, stats in sorted(self.phases.items(), key=lambda item: -item[1].wall)}}
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(path + '.pstats')
+        if self.mode == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report['memory'] = {'current': current,
+                                'peak': peak,
+                                'top': [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                                        for stat in snapshot.statistics('lineno')[:10]]}
+
+        with open(path + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.print_summary(report)
+        if self.cprofile is not None:
+            print("Top functions by cumulative time:")
+            pstats.Stats(self.cprofile).sort_stats('cumulative').print_stats(15)
+            self.cprofile = None
+        print(f"Profile written to {path}.json" + (f" and {path}.pstats" if self.mode == 'cprofile' else ""))
+
+    def print_summary(self, report: dict) -> None:
+        print(f"Profile: {report['wall']:.3f}s wall, {report['cpu']:.3f}s CPU")
+        print(f"  {'Phase':<24} {'Calls':>7} {'Items':>7} {'Wall (s)':>10} {'% wall':>7} {'Wall/item (ms)':>15} {'CPU (s)':>9} {'CPU/item (ms)':>14}")
+        for name, stats in report['phases'].items():
+            cpu = f"{stats['cpu']:.3f}" if stats['cpu'] is not None else '-'
+            cpu_per_item = f"{stats['cpu_per_item'] * 1000:.2f}" if stats['cpu_per_item'] is not None else '-'
+            wall_per_item = f"{stats['wall_per_item'] * 1000:.2f}" if stats['wall_per_item'] is not None else '-'
+            # Concurrent phases (without CPU time) overlap, their share of the run is meaningless
+            share = f"{100 * stats['wall'] / report['wall']:.1f}%" if report['wall'] and stats['cpu'] is not None else '-'
+            print(f"  {name:<24} {stats['calls']:>7} {stats['items']:>7} {stats['wall']:>10.3f} {share:>7} {wall_per_item:>15} {cpu:>9} {cpu_per_item:>14}")
+        if 'memory' in report:
+            print(f"Memory: {report['memory']['peak'] / 2 ** 20:.1f} MiB peak, top allocations:")
+            for stat in report['memory']['top']:
+                print(f"  {stat['size'] / 2 ** 10:>10.1f} KiB {stat['count']:>8} blocks  {stat['location']}")
+
+# Profiler of the process, disabled unless started
+profiler = Profiler()
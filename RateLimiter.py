@@ -0,0 +1,106 @@
+import collections
+import asyncio
+import time
+
+# Client side limit of the requests sent to the API: a token bucket caps the request rate
+# and an AIMD window caps the requests in flight
+# Both grow additively while responses are healthy and are halved on 429, timeouts, connection errors or latency spikes
+# (at most once per cooldown, so a burst of errors from the same congestion only halves them once)
+class RateLimiter(object):
+    rate: float
+    min_rate: float
+    max_rate: float
+    rate_increase: float
+    window: float
+    max_window: float
+    spike_factor: float
+    in_flight: int
+    tokens: float
+    updated: float
+    latency: float
+    samples: int
+    last_decrease: float
+    waiters: 'collections.deque[asyncio.Future]'
+
+    def __init__(self, rate: float = 10, max_rate: float = 100, window: float = 4, max_window: float = 32,
+                 min_rate: float = 1, rate_increase: float = 0.5, spike_factor: float = 3) -> None:
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.window = window
+        self.max_window = max_window
+        self.spike_factor = spike_factor
+        self.in_flight = 0
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.latency = None     # Moving average of healthy latencies
+        self.samples = 0
+        self.last_decrease = 0
+        self.waiters = collections.deque()  # Futures of the requests waiting for room in the window
+
+    # Wait for room in the window, then for a token
+    async def acquire(self) -> None:
+        while self.in_flight >= int(self.window):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Woken up but cancelled before taking the room, which goes to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self.wake_up()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+
+        try:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(max(1, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        except asyncio.CancelledError:
+            # Cancelled while waiting for a token (e.g. a cancelled job of daemon.py): its room in the window is given back
+            self.in_flight -= 1
+            self.wake_up()
+            raise
+
+    # Account for the response of an acquired request: its status (None if no response) and latency in seconds
+    def release(self, status: int, latency: float) -> None:
+        self.in_flight -= 1
+
+        spike = self.latency is not None and self.samples >= 10 and latency > self.spike_factor * self.latency
+        if status is None or status == 429 or spike:
+            self.decrease()
+        elif status < 500:  # Server errors are left to the retry policy and circuit breaker
+            self.increase(latency)
+        self.wake_up()
+
+    # Wake up as many waiters as there is room in the window
+    def wake_up(self) -> None:
+        for _ in range(max(0, int(self.window) - self.in_flight)):
+            if not self.waiters:
+                break
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def increase(self, latency: float) -> None:
+        self.window = min(self.max_window, self.window + 1 / self.window)   # About +1 per window of responses
+        self.rate = min(self.max_rate, self.rate + self.rate_increase)
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        self.samples += 1
+
+    def decrease(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < max(0.5, self.latency or 0):
+            return
+        self.window = max(1, self.window / 2)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.last_decrease = now
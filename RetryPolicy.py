@@ -0,0 +1,122 @@
+import email.utils
+import aiohttp
+import asyncio
+import random
+import time
+
+# When and how long to wait before retrying a request to the API
+# GET requests are retried on any transient error (timeouts, connection errors, 429 and 5xx responses)
+# POST requests (mints and transfers) are only retried when they were certainly not processed:
+# the connection could not be established, or the API answered 429 Too Many Requests or 503 Service Unavailable
+class RetryPolicy(object):
+    retries: int
+    base_delay: float
+    max_delay: float
+    timeout: float
+    idempotent_statuses: 'set[int]' = {429, 500, 502, 503, 504}
+    non_idempotent_statuses: 'set[int]' = {429, 503}
+
+    def __init__(self, retries: int = 4, base_delay: float = 0.5, max_delay: float = 30, timeout: float = 30) -> None:
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    def retry_status(self, status: int, idempotent: bool) -> bool:
+        return status in (self.idempotent_statuses if idempotent else self.non_idempotent_statuses)
+
+    # Whether a POST that failed with `status` (None without a complete response) may still have been processed by the API
+    def maybe_processed(self, status: int) -> bool:
+        return status is None or (status >= 500 and status not in self.non_idempotent_statuses)
+
+    # Whether a request that ended with `status` got a definite answer of the API, not an outage or throttling
+    def answered(self, status: int) -> bool:
+        return status is not None and status < 500 and status != 429
+
+    def retry_exception(self, err: Exception, idempotent: bool) -> bool:
+        if idempotent:
+            return isinstance(err, (aiohttp.ClientError, asyncio.TimeoutError))
+        return isinstance(err, aiohttp.ClientConnectorError)
+
+    # Exponential backoff with full jitter, never shorter than the Retry-After header of the response if any
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after_delay = parse_retry_after(retry_after)
+        if retry_after_delay is not None:
+            delay = max(delay, retry_after_delay)
+        return delay
+
+# Seconds to wait from a Retry-After header, given as a number of seconds or an HTTP date
+def parse_retry_after(retry_after: str) -> float:
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Pauses every request while the API is down, instead of letting each request fail on its own
+# The circuit opens after `failure_threshold` consecutive failures (5xx responses, timeouts, connection errors),
+# requests then wait until a single trial request goes through after `reset_timeout` seconds (doubled after each failed trial)
+class CircuitBreaker(object):
+    failure_threshold: int
+    reset_timeout: float
+    max_reset_timeout: float
+    failures: int
+    opened_at: float
+    open_timeout: float
+    probing: bool
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10, max_reset_timeout: float = 300) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.open_timeout = reset_timeout
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    # Wait until a request can be sent, returns True if the request is the trial of an open circuit
+    async def wait(self) -> bool:
+        while self.opened_at is not None:
+            remaining = self.opened_at + self.open_timeout - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif not self.probing:
+                self.probing = True
+                return True
+            else:
+                await asyncio.sleep(min(1, self.open_timeout))  # Trial in flight
+        return False
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            print("API available again, resuming requests")
+        self.failures = 0
+        self.opened_at = None
+        self.open_timeout = self.reset_timeout
+        self.probing = False
+
+    # The request was cancelled before its outcome was known: if it was the trial, another request makes it
+    def cancelled(self, probe: bool) -> None:
+        if probe:
+            self.probing = False
+
+    def failure(self, probe: bool = False) -> None:
+        self.failures += 1
+        if probe:
+            self.open_timeout = min(self.max_reset_timeout, self.open_timeout * 2)
+            self.opened_at = time.monotonic()
+            self.probing = False
+            print(f"API still unavailable, pausing requests for {self.open_timeout:.0f}s")
+        elif self.opened_at is None and self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            print(f"API unavailable ({self.failures} consecutive failures), pausing requests for {self.open_timeout:.0f}s")
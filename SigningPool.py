@@ -0,0 +1,99 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import asyncio
+import math
+import time
+
+from DataClasses import Struct
+from Profiler import profiler
+from LoopringMintService import LoopringMintService, NFTDataEddsaSignHelper, NFTEddsaSignHelper, NFTTransferEddsaSignHelper, get_signer
+
+from hello_loopring.sdk.sig_utils.ecdsa_utils import EIP712, generateTransferEIP712Hash
+from py_eth_sig_utils import utils as sig_utils
+from py_eth_sig_utils.signing import v_r_s_to_signature
+
+# Keys of the signing process, set once by `init_signer`
+signing_keys = Struct()
+
+def init_signer(keys: dict):
+    signing_keys.update(keys)
+
+    EIP712.init_env(name="Loopring Protocol",
+                    version="3.6.0",
+                    chainId=1,
+                    verifyingContract="0x0BABA1Ad5bE3a5C0a66E7ac838a129Bf948f1eA4")
+
+# Poseidon hashes of NFT data inputs (no key involved)
+def hash_nft_datas(inputs_list: list) -> list:
+    hasher = get_signer(NFTDataEddsaSignHelper)
+    return [hasher.hash(inputs) for inputs in inputs_list]
+
+# Poseidon hashes and EdDSA signatures of mint inputs
+def sign_mints(inputs_list: list) -> list:
+    signer = get_signer(NFTEddsaSignHelper, signing_keys.loopringPrivateKey)
+    return [(signer.hash(inputs), signer.sign(inputs)) for inputs in inputs_list]
+
+# Poseidon hashes, EdDSA and ECDSA signatures of transfers, from (eddsa inputs, EIP712 request) pairs
+def sign_transfers(items: list) -> list:
+    signer = get_signer(NFTTransferEddsaSignHelper, signing_keys.loopringPrivateKey)
+    eth_pkey = int(signing_keys.metamaskPrivateKey, 16).to_bytes(32, byteorder='big')
+
+    results = []
+    for inputs, eip712_request in items:
+        message = generateTransferEIP712Hash(req=eip712_request)
+        v, r, s = sig_utils.ecsign(message, eth_pkey)
+        ecdsa_signature = "0x" + bytes.hex(v_r_s_to_signature(v, r, s)) + "02"
+        results.append((signer.hash(inputs), signer.sign(inputs), ecdsa_signature))
+
+    return results
+
+# Result of `func(items)` along with the CPU time it took in the signing process
+def timed_call(func, items: list) -> tuple:
+    started = time.process_time()
+    results = func(items)
+    return results, time.process_time() - started
+
+# Runs the signing functions above on a pool of `workers` processes (or in this process if 0)
+# so that big-integer work neither blocks the event loop nor stays on one core
+class SigningPool(object):
+    workers: int
+    executor: ProcessPoolExecutor
+
+    def __init__(self, workers: int, keys: dict) -> None:
+        self.workers = workers
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_signer, initargs=(dict(keys),))
+        else:
+            self.executor = None
+            init_signer(keys)
+
+    # Apply `func` to `items`, split in chunks spread across the workers, results are in order
+    # The duration of each call is recorded in the API metrics and the profile, under the name of `func`
+    async def map(self, func, items: list, chunksize: int = None) -> list:
+        if len(items) == 0:
+            return []
+        started = time.monotonic()
+        if self.executor is None:
+            results, cpu = timed_call(func, items)
+        else:
+            if chunksize is None:
+                chunksize = math.ceil(len(items) / self.workers)
+            loop = asyncio.get_running_loop()
+            chunk_results = await asyncio.gather(*[loop.run_in_executor(self.executor, functools.partial(timed_call, func, items[i:i + chunksize]))
+                                                   for i in range(0, len(items), chunksize)])
+            results = [result for chunk, _ in chunk_results for result in chunk]
+            cpu = sum(chunk_cpu for _, chunk_cpu in chunk_results)
+        wall = time.monotonic() - started
+        LoopringMintService.metrics.observe_operation(func.__name__, wall)
+        profiler.record(func.__name__, wall, cpu, items=len(items))
+        return results
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self) -> 'SigningPool':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
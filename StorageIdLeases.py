@@ -0,0 +1,43 @@
+import sqlite3
+import os
+
+# Ranges of storage IDs leased to the processes sharing an account (e.g. the shards of sharded.py), backed by SQLite
+# Each (account, token) keeps the next storage ID not leased yet: a lease moves it past the range it returns,
+# within one write transaction, so that concurrent processes never get overlapping ranges
+class StorageIdLeases(object):
+    path: str
+    db: sqlite3.Connection
+
+    # `timeout` is how long a process waits for the others to release the database lock
+    def __init__(self, path: str, timeout: float = 30) -> None:
+        self.path = path
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)    # Transactions are explicit
+        self.db.execute("CREATE TABLE IF NOT EXISTS leases (account_id INTEGER NOT NULL, token_id INTEGER NOT NULL, next_id INTEGER NOT NULL, "
+                        "PRIMARY KEY (account_id, token_id))")
+
+    # Never lease storage IDs below `offchain_id` (e.g. the next storage ID given by the API)
+    def seed(self, account_id: int, token_id: int, offchain_id: int) -> None:
+        self.db.execute("INSERT INTO leases (account_id, token_id, next_id) VALUES (?, ?, ?) "
+                        "ON CONFLICT (account_id, token_id) DO UPDATE SET next_id = MAX(next_id, excluded.next_id)",
+                        (account_id, token_id, offchain_id))
+
+    # Lease `count` storage IDs of a seeded (account, token), returns the first one
+    # Storage IDs go by 2: the range is [first, first + 2 * count)
+    def lease(self, account_id: int, token_id: int, count: int) -> int:
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT next_id FROM leases WHERE account_id = ? AND token_id = ?", (account_id, token_id)).fetchone()
+            if row is None:
+                raise KeyError(f"Storage IDs of account {account_id} and token {token_id} are not seeded")
+            self.db.execute("UPDATE leases SET next_id = ? WHERE account_id = ? AND token_id = ?", (row[0] + 2 * count, account_id, token_id))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return row[0]
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Test vectors of IpfsCid.file_cid: CIDv0 of files of one chunk, a few chunks and more than MAX_CHILDREN chunks (two levels of parents)
+# Exits with 1 when a CID differs from its vector, or from pure-ipfs-only-hash with `--node` or kubo with `--ipfs`
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import subprocess
+import argparse
+import shutil
+import hashlib
+import tempfile
+import time
+
+from IpfsCid import CHUNK_SIZE, MAX_CHILDREN, file_cid
+
+SEED = b"loopring-minter-cid-vectors"
+
+# (name, content, CID): contents are literal or the first `size` bytes of SHAKE-256 of SEED
+# The CIDs were generated by kubo v0.22.0 (`ipfs add --only-hash` with its defaults: CIDv0, size-262144 chunks, balanced layout
+# of 174 links), not by file_cid
+VECTORS = [
+    ("empty", b'', "QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH"),
+    ("hello world", b'hello world\n', "QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o"),
+    ("1 chunk", CHUNK_SIZE, "QmWjdNkUtuTJkw1EfpY8aZXUN7AH1zcVyBkkjajw5cJyW9"),
+    ("3 chunks and a partial one", 3 * CHUNK_SIZE + 1000, "QmejWAGrzDDpXjGvMrhMHxwToWJpp9dviNknt6BPhNg3GM"),
+    (f"{MAX_CHILDREN} chunks", MAX_CHILDREN * CHUNK_SIZE, "QmU5McrqxF26vHDdcXvfDTK498DLJ9euQALw5iMLtZ73hh"),
+    (f"{MAX_CHILDREN} chunks and a byte", MAX_CHILDREN * CHUNK_SIZE + 1, "Qmat1VsFbBmQszwSBgxhfgaRNFe98tr3s3X122K8qxEsBu"),
+    (f"{MAX_CHILDREN + 3} chunks and a partial one", (MAX_CHILDREN + 3) * CHUNK_SIZE + 12345, "QmakNTwqVfPjH3jYKRXqTg1p8KphJRZJGW4qgPoPu6mDsV"),
+]
+
+NODE_HASH = "const fs = require('fs'); require('pure-ipfs-only-hash').of(fs.readFileSync(process.argv[1])).then(cid => console.log(cid))"
+
+def content(spec) -> bytes:
+    return spec if isinstance(spec, bytes) else hashlib.shake_256(SEED).digest(spec)
+
+def node_cid(path: str) -> str:
+    return subprocess.run(["node", "-e", NODE_HASH, path], capture_output=True, text=True, check=True).stdout.strip()
+
+def ipfs_cid(path: str) -> str:
+    return subprocess.run(["ipfs", "add", "--only-hash", "--cid-version", "0", "--quiet", path], capture_output=True, text=True, check=True).stdout.strip()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--node", help="Also check the vectors against pure-ipfs-only-hash (npm install pure-ipfs-only-hash)", action='store_true')
+    parser.add_argument("--ipfs", help="Also check the vectors against the ipfs command of kubo", action='store_true')
+    args = parser.parse_args()
+
+    if args.node and subprocess.run(["node", "-e", "require.resolve('pure-ipfs-only-hash')"], capture_output=True).returncode != 0:
+        sys.exit("pure-ipfs-only-hash is not installed for Node.js (npm install pure-ipfs-only-hash)")
+    if args.ipfs and shutil.which("ipfs") is None:
+        sys.exit("ipfs is not installed (https://docs.ipfs.tech/install/command-line/)")
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, spec, expected in VECTORS:
+            path = os.path.join(workdir, "vector")
+            with open(path, 'wb') as f:
+                f.write(content(spec))
+
+            started = time.monotonic()
+            cid = file_cid(path)
+            elapsed = time.monotonic() - started
+            checks = {'vector': expected}
+            if args.node:
+                checks['pure-ipfs-only-hash'] = node_cid(path)
+            if args.ipfs:
+                checks['ipfs'] = ipfs_cid(path)
+
+            mismatches = [f"{source} {other}" for source, other in checks.items() if other != cid]
+            failed += len(mismatches) > 0
+            print(f"{'FAILED' if mismatches else 'ok':6} {name} ({os.path.getsize(path)} bytes, {elapsed:.3f}s): {cid}" + (f", expected {', '.join(mismatches)}" if mismatches else ""))
+
+    if failed > 0:
+        sys.exit(f"{failed} vectors FAILED")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Local stand-in for the Loopring API endpoints used by LoopringMintService, to measure mints and transfers without fees
+# Latency, server errors, throttling (429) and fee changes are configurable, see --help
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+
+from aiohttp import web
+
+FEE_INVALID = 114002
+
+class MockLoopringApi(object):
+    latency: float
+    jitter: float
+    error_rate: float
+    throttle_rate: float
+    rate_limit: float
+    fees: 'list[int]'
+    fee_schedule: 'list[tuple]'
+    nfts: int
+    started: float
+
+    # `fee_schedule` is a list of (seconds since start, fee multiplier), applied from that time on
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 rate_limit: float = 0, fees: 'list[int]' = None, fee_schedule: 'list[tuple]' = None, nfts: int = 1000) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.fees = fees or [10 ** 14, 10 ** 16]     # ETH, LRC
+        self.fee_schedule = sorted(fee_schedule or [])
+        self.nfts = nfts
+        self.started = time.monotonic()
+        self.tokens = rate_limit
+        self.updated = self.started
+        self.next_storage_ids = {}  # (account, token) -> next offchain storage id
+        self.used_storage_ids = set()
+        self.minted = set()
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'fee_rejected': 0, 'storage_rejected': 0, 'mints': 0, 'transfers': 0}
+
+    def fee_multiplier(self) -> float:
+        multiplier = 1
+        elapsed = time.monotonic() - self.started
+        for at, value in self.fee_schedule:
+            if elapsed >= at:
+                multiplier = value
+        return multiplier
+
+    def fee(self, token_id: int) -> int:
+        return int(self.fees[token_id] * self.fee_multiplier())
+
+    # Token bucket of `rate_limit` requests per second, like the API's own limit
+    def over_rate_limit(self) -> bool:
+        if self.rate_limit <= 0:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+        self.updated = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    @web.middleware
+    async def chaos(self, request, handler):
+        if request.path == '/stats':
+            return await handler(request)
+        self.stats['requests'] += 1
+        await asyncio.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if self.over_rate_limit() or random.random() < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.json_response({'resultInfo': {'code': 100001, 'message': 'Too many requests'}}, status=429, headers={'Retry-After': '1'})
+        if random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable')
+        return await handler(request)
+
+    async def timestamp(self, request):
+        return web.json_response({'timestamp': int(time.time() * 1000)})
+
+    async def account(self, request):
+        if 'owner' in request.query:
+            owner = request.query['owner'].lower()
+            return web.json_response({'accountId': 10000 + int(owner, 16) % 1000000, 'owner': owner})
+        account_id = int(request.query['accountId'])
+        return web.json_response({'accountId': account_id, 'owner': '0x%040x' % account_id})
+
+    async def resolve_ens(self, request):
+        return web.json_response({'data': '0x' + hashlib.sha256(request.query['fullName'].encode()).hexdigest()[:40]})
+
+    async def api_key(self, request):
+        return web.json_response({'apiKey': 'mock-api-key'})
+
+    async def storage_id(self, request):
+        key = (request.query['accountId'], int(request.query['sellTokenId']))
+        return web.json_response({'orderId': 0, 'offchainId': self.next_storage_ids.get(key, 1001)})
+
+    async def compute_token_address(self, request):
+        return web.json_response({'tokenAddress': '0x' + hashlib.sha256(request.query['nftOwner'].encode()).hexdigest()[:40]})
+
+    async def offchain_fee(self, request):
+        return web.json_response({'gasPrice': '1000000000',
+                                  'fees': [{'token': 'ETH', 'fee': str(self.fee(0)), 'discount': 1},
+                                           {'token': 'LRC', 'fee': str(self.fee(1)), 'discount': 1}]})
+
+    async def nft_datas(self, request):
+        return web.json_response([])    # NFT data hashes are not computed by the mock: no NFT exists yet
+
+    async def balances(self, request):
+        offset = int(request.query['offset'])
+        limit = int(request.query['limit'])
+        account_id = int(request.query['accountId'])
+        data = [{'id': i, 'accountId': account_id, 'tokenId': 32768 + i, 'nftData': '0x%064x' % (i + 1),
+                 'tokenAddress': '0x' + 'ab' * 20, 'nftId': '0x%064x' % (i + 1), 'nftType': 'ERC1155', 'total': '1000000', 'locked': '0'}
+                for i in range(offset, min(offset + limit, self.nfts))]
+        return web.json_response({'totalNum': self.nfts, 'data': data})
+
+    # Checks of a mint or transfer: fee and storage id, returns an error response or None
+    def check_transaction(self, body: dict, account_id: int, token_id: int):
+        if int(body['maxFee']['amount']) < self.fee(body['maxFee']['tokenId']):
+            self.stats['fee_rejected'] += 1
+            return web.json_response({'resultInfo': {'code': FEE_INVALID, 'message': 'Invalid fee amount'}}, status=400)
+
+        key = (str(account_id), token_id)
+        storage_id = int(body['storageId'])
+        if (key, storage_id) in self.used_storage_ids:
+            self.stats['storage_rejected'] += 1
+            return web.json_response({'resultInfo': {'code': 102026, 'message': 'Invalid storage id'}}, status=400)
+        self.used_storage_ids.add((key, storage_id))
+        self.next_storage_ids[key] = max(self.next_storage_ids.get(key, 1001), storage_id + 2)
+        return None
+
+    async def mint(self, request):
+        body = await request.json()
+        error = self.check_transaction(body, body['minterId'], body['maxFee']['tokenId'])
+        if error is not None:
+            return error
+        self.minted.add(body['nftId'])
+        self.stats['mints'] += 1
+        return web.json_response({'hash': '0x%064x' % random.getrandbits(256), 'nftTokenId': 32768 + len(self.minted), 'nftData': '0x' + '00' * 32,
+                                  'status': 'processing', 'isIdempotent': False, 'accountId': body['minterId'], 'storageId': body['storageId']})
+
+    async def transfer(self, request):
+        body = await request.json()
+        error = self.check_transaction(body, body['fromAccountId'], body['token']['tokenId'])
+        if error is not None:
+            return error
+        self.stats['transfers'] += 1
+        return web.json_response({'hash': '0x%064x' % random.getrandbits(256), 'status': 'processing', 'isIdempotent': False})
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats, fee_multiplier=self.fee_multiplier()))
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.chaos])
+        app.add_routes([web.get('/api/v3/timestamp', self.timestamp),
+                        web.get('/api/v3/account', self.account),
+                        web.get('/api/wallet/v3/resolveEns', self.resolve_ens),
+                        web.get('/api/v3/apiKey', self.api_key),
+                        web.get('/api/v3/storageId', self.storage_id),
+                        web.get('/api/v3/nft/info/computeTokenAddress', self.compute_token_address),
+                        web.get('/api/v3/user/nft/offchainFee', self.offchain_fee),
+                        web.get('/api/v3/nft/info/nfts', self.nft_datas),
+                        web.get('/api/v3/user/nft/balances', self.balances),
+                        web.post('/api/v3/nft/mint', self.mint),
+                        web.post('/api/v3/nft/transfer', self.transfer),
+                        web.get('/stats', self.get_stats)])
+        return app
+
+# "10:3,30:1" -> [(10.0, 3.0), (30.0, 1.0)]
+def parse_fee_schedule(schedule: str) -> 'list[tuple]':
+    if not schedule:
+        return []
+    return [tuple(float(value) for value in change.split(':')) for change in schedule.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Loopring API")
+    parser.add_argument("--host", help="Host to listen on", type=str, default="127.0.0.1")
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("--latency", help="Seconds added to every response", type=float, default=0.05)
+    parser.add_argument("--jitter", help="Random +/- seconds around the latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", help="Fraction of requests answered with 503", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", help="Fraction of requests answered with 429", type=float, default=0.0)
+    parser.add_argument("--rate-limit", help="Requests per second above which requests are answered with 429 (0 for no limit)", type=float, default=0)
+    parser.add_argument("--fee-schedule", help="Fee changes as seconds:multiplier pairs, e.g. 10:3,30:1", type=str)
+    parser.add_argument("--nfts", help="Number of NFTs in the balance of every account", type=int, default=1000)
+    args = parser.parse_args()
+
+    api = MockLoopringApi(latency=args.latency,
+                          jitter=args.jitter,
+                          error_rate=args.error_rate,
+                          throttle_rate=args.throttle_rate,
+                          rate_limit=args.rate_limit,
+                          fee_schedule=parse_fee_schedule(args.fee_schedule),
+                          nfts=args.nfts)
+    web.run_app(api.app(), host=args.host, port=args.port, print=None)
+
+if __name__ == '__main__':
+    main()
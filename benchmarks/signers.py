@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Measures the CPU time saved per NFT by reusing Poseidon parameters and signers
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "hello_loopring")))
+
+import argparse
+import time
+
+from LoopringMintService import NFTDataEddsaSignHelper, NFTEddsaSignHelper, NFTTransferEddsaSignHelper, cached_poseidon_params, get_signer
+
+PRIVATE_KEY = "0x1"
+
+def mint_inputs(i: int):
+    nft_data_inputs = [0xb22308e257df6c4de2577694d34c0eef3da4c49a, 0, 0xc852ac7aae4b0f0a0deb9e8a391eba2047d80026, i, i, 10]
+    nft_inputs = [0x0baba1ad5be3a5c0a66e7ac838a129bf948f1ea4, 12345, 12345, i, 1, 1, 1000, 1700000000, 2 * i + 1]
+    return nft_data_inputs, nft_inputs
+
+def transfer_inputs(i: int):
+    return [0x0baba1ad5be3a5c0a66e7ac838a129bf948f1ea4, 12345, 54321, 32768 + i, 1, 1, 1000, 0xb22308e257df6c4de2577694d34c0eef3da4c49a, 0, 0, 1700000000, 2 * i + 1]
+
+# Signing as done before: every helper (and its Poseidon parameters) is rebuilt per NFT
+def sign_uncached(i: int):
+    nft_data_inputs, nft_inputs = mint_inputs(i)
+    cached_poseidon_params.cache_clear()
+    NFTDataEddsaSignHelper().hash(nft_data_inputs)
+    cached_poseidon_params.cache_clear()
+    NFTEddsaSignHelper(private_key=PRIVATE_KEY).sign(nft_inputs)
+    cached_poseidon_params.cache_clear()
+    NFTTransferEddsaSignHelper(private_key=PRIVATE_KEY).sign(transfer_inputs(i))
+
+def sign_cached(i: int):
+    nft_data_inputs, nft_inputs = mint_inputs(i)
+    get_signer(NFTDataEddsaSignHelper).hash(nft_data_inputs)
+    get_signer(NFTEddsaSignHelper, PRIVATE_KEY).sign(nft_inputs)
+    get_signer(NFTTransferEddsaSignHelper, PRIVATE_KEY).sign(transfer_inputs(i))
+
+def measure(sign, count: int) -> float:
+    start = time.process_time()
+    for i in range(count):
+        sign(i)
+    return (time.process_time() - start) / count
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", help="Number of items to sign for each measurement", type=int, default=50)
+    args = parser.parse_args()
+
+    uncached = measure(sign_uncached, args.count)
+    get_signer.cache_clear()
+    cached_poseidon_params.cache_clear()
+    cached = measure(sign_cached, args.count)
+
+    print(f"Per item CPU time (mint hashes + mint signature + transfer signature), {args.count} items:")
+    print(f"  Rebuilt signers: {uncached * 1000:.2f} ms")
+    print(f"  Cached signers:  {cached * 1000:.2f} ms")
+    print(f"  Saved:           {(uncached - cached) * 1000:.2f} ms ({(1 - cached / uncached) * 100:.1f}%)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# End-to-end throughput of minter.py and transfer.py against the mock Loopring API (benchmarks/mock_api.py)
+# Reports NFTs/sec and the p50/p99 latency of the mint and transfer requests, and flags regressions against a stored baseline
+# (exits with 1 without a baseline measured with the same settings: record one on the machine with --save-baseline)
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import subprocess
+import argparse
+import hashlib
+import tempfile
+import socket
+import base58
+import json
+import time
+import urllib.request
+
+from DataClasses import MintResult, TransferResult
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+MOCK_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_api.py")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Throwaway keys and accounts, only ever sent to the mock
+ENV = {
+    'LOOPRING_PRIVATE_KEY': "0x1",
+    'L1_PRIVATE_KEY': "0x" + "11" * 32,
+    'MINTER': "0x" + "0a" * 20,
+    'FROM': "0x" + "0a" * 20,
+    'NFT_TYPE': "0",
+    'ROYALTY_PERCENTAGE': "0",
+    'FEE_TOKEN_ID': "1",
+    'FEE_POLL_INTERVAL': "1",
+}
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def cid(i: int) -> str:
+    return base58.b58encode(b'\x12\x20' + hashlib.sha256(str(i).encode()).digest()).decode()
+
+# Scripts of the repo linked into `workdir`, so that their journals, metrics and caches are written there
+def link_scripts(workdir: str) -> None:
+    for name in os.listdir(ROOT):
+        if name.endswith('.py') or name == 'hello_loopring':
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+
+def start_mock(port: int, args) -> subprocess.Popen:
+    command = [sys.executable, MOCK_API, "--port", str(port),
+               "--latency", str(args.latency),
+               "--jitter", str(args.jitter),
+               "--error-rate", str(args.error_rate),
+               "--throttle-rate", str(args.throttle_rate),
+               "--rate-limit", str(args.rate_limit),
+               "--nfts", "1"]
+    if args.fee_schedule:
+        command += ["--fee-schedule", args.fee_schedule]
+    mock = subprocess.Popen(command)
+
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return mock
+        except OSError:
+            time.sleep(0.1)
+    mock.terminate()
+    sys.exit("Mock API did not start")
+
+def mint_command(workdir: str, args) -> 'list[str]':
+    manifest = os.path.join(workdir, "manifest.jsonl")
+    with open(manifest, 'w') as f:
+        for i in range(1, args.count + 1):
+            f.write(json.dumps({'ID': i, 'CID': cid(i)}) + '\n')
+    return [sys.executable, os.path.join(workdir, "minter.py"), "--json", manifest, "--noprompt",
+            "--concurrency", str(args.concurrency), "--workers", str(args.workers)]
+
+def transfer_command(workdir: str, args) -> 'list[str]':
+    tolist = os.path.join(workdir, "tolist.txt")
+    with open(tolist, 'w') as f:
+        for i in range(1, args.count + 1):
+            f.write("0x%040x\n" % (0x1000 + i))
+    return [sys.executable, os.path.join(workdir, "transfer.py"), "--single", "0x%064x" % 1, "--tolist", tolist, "--noprompt",
+            "--concurrency", str(args.concurrency), "--workers", str(args.workers)]
+
+def run_scenario(scenario: str, args) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        link_scripts(workdir)
+        command = mint_command(workdir, args) if scenario == 'mint' else transfer_command(workdir, args)
+        journal = os.path.join(workdir, "mint-info.jsonl" if scenario == 'mint' else "transfer-info.jsonl")
+        endpoint = "POST /api/v3/nft/mint" if scenario == 'mint' else "POST /api/v3/nft/transfer"
+        success = MintResult.SUCCESS if scenario == 'mint' else TransferResult.SUCCESS
+
+        port = free_port()
+        mock = start_mock(port, args)
+        try:
+            env = dict(os.environ, LOOPRING_API_URL=f"http://127.0.0.1:{port}", **ENV)
+            started = time.monotonic()
+            with open(os.path.join(workdir, "output.log"), 'w') as output:
+                returncode = subprocess.call(command, cwd=workdir, env=env, stdout=output, stderr=subprocess.STDOUT)
+            elapsed = time.monotonic() - started
+        finally:
+            mock.terminate()
+            mock.wait()
+
+        if returncode != 0:
+            with open(os.path.join(workdir, "output.log")) as f:
+                print(f.read()[-2000:])
+            sys.exit(f"{scenario} failed with exit code {returncode}")
+
+        with open(journal) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        completed = sum(1 for record in records if record.get('event') == 'result' and record.get('result') == success)
+        with open(os.path.join(workdir, "api-metrics.json")) as f:
+            metrics = json.load(f)['endpoints'].get(endpoint, {})
+        latency = metrics.get('latency', {})
+
+        return {'nfts': completed,
+                'seconds': round(elapsed, 3),
+                'nfts_per_sec': round(completed / elapsed, 2),
+                'p50_ms': round(latency['p50'] * 1000, 1) if latency.get('p50') is not None else None,
+                'p99_ms': round(latency['p99'] * 1000, 1) if latency.get('p99') is not None else None,
+                'requests': metrics.get('requests', 0),
+                'retries': metrics.get('retries', 0)}
+
+# Regressions of `result` against `baseline`: throughput lower or p99 latency higher by more than `tolerance`
+def regressions(result: dict, baseline: dict, tolerance: float) -> 'list[str]':
+    found = []
+    if result['nfts_per_sec'] < baseline['nfts_per_sec'] * (1 - tolerance):
+        found.append(f"throughput {result['nfts_per_sec']} NFTs/sec < baseline {baseline['nfts_per_sec']}")
+    if result['p99_ms'] is not None and baseline.get('p99_ms') is not None and result['p99_ms'] > baseline['p99_ms'] * (1 + tolerance):
+        found.append(f"p99 latency {result['p99_ms']} ms > baseline {baseline['p99_ms']}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", help="Scenarios to run", choices=['mint', 'transfer', 'all'], default='all')
+    parser.add_argument("-n", "--count", help="Number of NFTs minted or transferred by each scenario", type=int, default=500)
+    parser.add_argument("--concurrency", help="--concurrency of minter.py and transfer.py", type=int, default=16)
+    parser.add_argument("--workers", help="--workers of minter.py and transfer.py", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--latency", help="Mock API latency in seconds", type=float, default=0.05)
+    parser.add_argument("--jitter", help="Mock API latency jitter in seconds", type=float, default=0.01)
+    parser.add_argument("--error-rate", help="Fraction of mock API requests answered with 503", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", help="Fraction of mock API requests answered with 429", type=float, default=0.0)
+    parser.add_argument("--rate-limit", help="Mock API requests per second above which it answers 429 (0 for no limit)", type=float, default=0)
+    parser.add_argument("--fee-schedule", help="Mock API fee changes as seconds:multiplier pairs, e.g. 5:3,10:1", type=str)
+    parser.add_argument("--baseline", help="Baseline file to compare with", type=str, default=BASELINE)
+    parser.add_argument("--save-baseline", help="Store the results as the new baseline", action='store_true')
+    parser.add_argument("--tolerance", help="Fraction of throughput or p99 latency lost before flagging a regression", type=float, default=0.15)
+    args = parser.parse_args()
+
+    # Results are only compared with a baseline measured with the same settings, without one there is nothing to check
+    settings = {key: value for key, value in vars(args).items() if key not in ['scenario', 'baseline', 'save_baseline', 'tolerance']}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        sys.exit(f"No baseline in {args.baseline}, record one on this machine with --save-baseline")
+    if baseline.get('settings') != settings:
+        if not args.save_baseline:
+            differences = ', '.join(f"{key} {baseline.get('settings', {}).get(key)} instead of {value}" for key, value in settings.items() if baseline.get('settings', {}).get(key) != value)
+            sys.exit(f"Baseline {args.baseline} was measured with other settings ({differences}), record one with these settings with --save-baseline")
+        baseline = {'settings': settings, 'results': {}}
+
+    failed = False
+    scenarios = ['mint', 'transfer'] if args.scenario == 'all' else [args.scenario]
+    for scenario in scenarios:
+        result = run_scenario(scenario, args)
+        print(f"{scenario}: {result['nfts']} NFTs in {result['seconds']}s, {result['nfts_per_sec']} NFTs/sec, "
+              f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, {result['retries']} retries")
+
+        previous = baseline['results'].get(scenario)
+        if previous is None and not args.save_baseline:
+            print(f"  NO BASELINE: {scenario} is not in {args.baseline}, record it with --save-baseline")
+            failed = True
+        elif previous is not None and not args.save_baseline:
+            for regression in regressions(result, previous, args.tolerance):
+                print(f"  REGRESSION: {regression}")
+                failed = True
+        baseline['results'][scenario] = result
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "hello_loopring")))
+
+from dotenv import load_dotenv
+from aiohttp import web
+import argparse
+import asyncio
+import signal
+import hmac
+import json
+import time
+
+from DataClasses import *
+from AccountCache import AccountCache
+from Journal import Journal
+from FeeWatcher import FeeWatcher
+from Manifest import read_manifest
+from LoopringMintService import LoopringMintService, StorageIdAllocator
+from StorageIdLeases import StorageIdLeases
+from SigningPool import SigningPool, hash_nft_datas, sign_mints
+import minter
+import transfer
+
+class JobStatus:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+# Journal of each job type, as written by minter.py and transfer.py
+JOURNALS = {'mint': "mint-info.jsonl",
+            'transfer': "transfer-info.jsonl"}
+RESULT_NAMES = {'mint': {value: name for name, value in vars(MintResult).items() if not name.startswith('_')},
+                'transfer': {value: name for name, value in vars(TransferResult).items() if not name.startswith('_')}}
+
+# Invalid job submitted to the API, answered with a 400
+class JobError(Exception):
+    pass
+
+# A mint or transfer job of the daemon, `results` counts the results of its NFTs by name as they are journaled
+# `fee` is the offchain fee of a mint or transfer when the job started, then as polled while its submission was paused
+class Job(object):
+    id: int
+    type: str
+    priority: int
+    params: dict
+    status: str
+    error: str
+    results: 'dict[str, int]'
+    total: int
+    fee: float
+    fee_symbol: str
+    fee_paused: bool
+    journal: str
+    submitted: float
+    started: float
+    finished: float
+    task: asyncio.Task
+
+    def __init__(self, id: int, type: str, priority: int, params: dict, journal: str) -> None:
+        self.id = id
+        self.type = type
+        self.priority = priority
+        self.params = params
+        self.status = JobStatus.QUEUED
+        self.error = None
+        self.results = {}
+        self.total = None
+        self.fee = None
+        self.fee_symbol = None
+        self.fee_paused = False
+        self.journal = journal
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.task = None
+
+    def count(self, result: int) -> None:
+        name = RESULT_NAMES[self.type].get(result, str(result))
+        self.results[name] = self.results.get(name, 0) + 1
+
+    def to_dict(self) -> dict:
+        return {'id': self.id,
+                'type': self.type,
+                'priority': self.priority,
+                'status': self.status,
+                'params': self.params,
+                'total': self.total,
+                'results': self.results,
+                'fee': self.fee,
+                'max_fee': self.params['max_fee'],
+                'fee_symbol': self.fee_symbol,
+                'fee_paused': self.fee_paused,
+                'error': self.error,
+                'journal': self.journal,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                'queued_ms': round((self.started - self.submitted) * 1000, 1) if self.started is not None else None}
+
+# Journal of a job, counting the results on the job as they are appended
+class JobJournal(Journal):
+    job: Job
+
+    def __init__(self, path: str, job: Job) -> None:
+        super().__init__(path)
+        self.job = job
+
+    def append(self, record: dict, sync: bool = False) -> None:
+        super().append(record, sync)
+        if record.get('event') in ['result', 'unknown']:
+            self.job.count(record['result'])
+
+# Parse CLI arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run mints and transfers submitted over a local HTTP API, with the session, API keys, accounts and signing processes kept warm between jobs")
+    parser.add_argument("--socket", help="Unix socket to listen on (default: daemon.sock in the output directory)", type=str)
+    parser.add_argument("--port", help="Listen on this TCP port of --host instead of a Unix socket, requests need the bearer token DAEMON_TOKEN", type=int)
+    parser.add_argument("--host", help="Address to listen on with --port (default: 127.0.0.1)", type=str, default="127.0.0.1")
+    parser.add_argument("--jobs", help="Number of jobs run at once (default: 1)", type=int, default=1)
+    parser.add_argument("--concurrency", help="Specify the number of mints submitted concurrently by a job", type=int)
+    parser.add_argument("--workers", help="Specify the number of signing processes (0 to sign in the main process)", type=int)
+    parser.add_argument("--max-fee", help="Max offchain fee of a mint or transfer in the fee token, jobs are rejected above it and paused while the fee exceeds it (default: MAX_FEE)", type=float)
+    parser.add_argument("--output-dir", help="Directory of the job journals and API metrics (default: daemon next to the script)", type=str)
+    parser.add_argument("--storage-leases", metavar="PATH", help="SQLite file to lease storage ID ranges from, shared by the processes running on the same account (see sharded.py)", type=str)
+    parser.add_argument("--refresh-accounts", help="Clear the cached ENS and account ID resolutions", action='store_true')
+    parser.add_argument("-V", "--verbose", help="Verbose output", action='store_true')
+    args = parser.parse_args()
+
+    assert args.jobs > 0, f"Invalid argument --jobs ({args.jobs}), should be > 0"
+
+    # Mints in flight
+    if not args.concurrency:
+        args.concurrency = int(os.getenv("CONCURRENCY") or 16)
+    assert args.concurrency > 0, f"Invalid argument --concurrency ({args.concurrency}), should be > 0"
+
+    # Signing processes
+    if args.workers is None:
+        args.workers = int(os.getenv("SIGNING_WORKERS") or os.cpu_count() or 1)
+    assert args.workers >= 0, f"Invalid argument --workers ({args.workers}), should be >= 0"
+
+    # Jobs run without fee prompts, their fees are approved up to this one
+    if args.max_fee is None:
+        args.max_fee = float(os.getenv("MAX_FEE") or 0)
+    assert args.max_fee > 0, f"Missing or invalid max fee of a mint or transfer (--max-fee or MAX_FEE): {args.max_fee}, should be > 0"
+
+    if not args.output_dir:
+        args.output_dir = os.path.join(os.path.dirname(__file__), "daemon")
+    if not args.socket:
+        args.socket = os.path.join(args.output_dir, "daemon.sock")
+
+    # Jobs spend fees: the Unix socket is only accessible to its owner, requests over TCP need a bearer token
+    args.token = None
+    if args.port:
+        args.token = os.getenv("DAEMON_TOKEN")
+        assert args.token, "Missing DAEMON_TOKEN, the bearer token of the requests over --port"
+
+    minter.VERBOSE = transfer.VERBOSE = args.verbose
+
+    return args
+
+# Mint entries of a job: `cid` (a single CID), `cids` (list of {"ID", "CID"}) or `json` (manifest on the daemon host, within `start`/`end`)
+# A manifest is read as the job mints it, the other entries are checked as a list
+def job_cids(params: dict):
+    if params.get('json'):
+        if not os.path.exists(params['json']):
+            raise JobError(f"Manifest not found: {params['json']}")
+        return read_manifest(params['json'], start=params.get('start') or 1, end=params.get('end'))
+
+    if params.get('cid'):
+        cids = [{'ID': 1, 'CID': params['cid']}]
+    elif params.get('cids'):
+        try:
+            cids = [{'ID': cid['ID'], 'CID': cid['CID']} for cid in params['cids']]
+        except (KeyError, TypeError):
+            raise JobError("Invalid cids, should be a list of {\"ID\", \"CID\"}")
+    else:
+        raise JobError("Missing cid, cids or json")
+
+    for cid in cids:
+        if str(cid['CID'])[:2] != "Qm":     # Support CIDv0 only
+            raise JobError(f"Invalid cid: {cid['CID']}")
+    return cids
+
+# Recipients of a transfer job: `to` (an address, ENS or account ID, or a list of them)
+def job_tos(params: dict) -> 'list[str]':
+    tos = params.get('to')
+    if not tos:
+        raise JobError("Missing to")
+    return [str(to).strip() for to in (tos if isinstance(tos, list) else [tos]) if str(to).strip()]
+
+# Mints and transfers of the jobs submitted to the API, run in priority order (highest first, then by submission)
+# The minter and sender are resolved, their API keys fetched and the signing processes started once for every job,
+# storage IDs are allocated locally across jobs and the offchain parameters are reused while their fee is recent
+class Daemon(object):
+    args: argparse.Namespace
+    jobs: 'dict[int, Job]'
+    queue: asyncio.PriorityQueue
+    next_id: int
+    configs: 'dict[str, tuple]'
+    offchain_parameters: 'dict[tuple, dict]'
+    fees_updated: 'dict[tuple, float]'
+    fee_ttl: float
+    signing_pool: SigningPool
+    storage_leases: StorageIdLeases
+    storage_ids: 'dict[int, StorageIdAllocator]'
+    nfts: 'dict[str, NftEntry]'
+    nfts_available: 'dict[str, int]'
+    runners: 'list[asyncio.Task]'
+    stopping: bool
+    started: float
+
+    def __init__(self, args) -> None:
+        self.args = args
+        self.jobs = {}
+        self.queue = asyncio.PriorityQueue()
+        self.configs = {}   # Job type -> (cfg, secret) of its account
+        self.offchain_parameters = {}   # (job type, token ID) -> offchain parameters of its jobs
+        self.fees_updated = {}
+        self.fee_ttl = float(os.getenv("FEE_POLL_INTERVAL") or 30)
+        self.signing_pool = None
+        self.storage_leases = None
+        self.storage_ids = {}   # Account ID -> allocator, shared by the jobs of the account
+        self.nfts = {}      # NFT ID -> balance entry of the sender, looked up by the transfers
+        self.nfts_available = {}    # NFT ID -> amount left for the next transfers
+        self.runners = []
+        self.stopping = False
+        self.started = time.time()
+
+        # Jobs are numbered after those of the previous runs, whose journals are kept
+        jobs_dir = os.path.join(args.output_dir, "jobs")
+        ids = [int(name) for name in os.listdir(jobs_dir) if name.isdigit()] if os.path.exists(jobs_dir) else []
+        self.next_id = max(ids, default=0) + 1
+
+    # Load the accounts of the mint and transfer jobs, their API keys and the offchain parameters of the mints, and start the signing processes
+    async def start(self) -> None:
+        try:
+            cfg, secret = await minter.load_config(Struct({'loopygen': False}), Struct())
+            await minter.get_user_api_key(cfg, secret)
+            self.configs['mint'] = cfg, secret
+            print(f"Mint jobs enabled for minter {cfg.minterAddress} (account ID {cfg.minterAccount})")
+        except Exception as err:
+            print(f"Mint jobs disabled: {err}")
+
+        try:
+            cfg, secret = await transfer.load_config(Struct({'loopygen': False}), Struct())
+            if 'mint' in self.configs and self.configs['mint'][0].minterAccount == cfg.fromAccount:
+                secret.loopringApiKey = self.configs['mint'][1].loopringApiKey    # Same account, same key
+            else:
+                await transfer.get_user_api_key(cfg, secret)
+            self.configs['transfer'] = cfg, secret
+            print(f"Transfer jobs enabled from {cfg.fromAddress} (account ID {cfg.fromAccount})")
+        except Exception as err:
+            print(f"Transfer jobs disabled: {err}")
+
+        if len(self.configs) == 0:
+            sys.exit("Neither mint nor transfer jobs can run, check the configuration")
+
+        if self.args.storage_leases:
+            self.storage_leases = StorageIdLeases(self.args.storage_leases)
+        for job_type, (cfg, secret) in self.configs.items():
+            account = cfg.minterAccount if job_type == 'mint' else cfg.fromAccount
+            if account not in self.storage_ids:
+                self.storage_ids[account] = StorageIdAllocator(secret.loopringApiKey, account, leases=self.storage_leases, lease_size=int(os.getenv("STORAGE_ID_LEASE_SIZE") or 100))
+
+        # Storage ID of the fee token and token address of the minter, used by every mint job
+        # Those of the transfers depend on the NFT token, they are fetched by its first job
+        if 'mint' in self.configs:
+            await self.get_offchain_parameters('mint', self.configs['mint'][0].maxFeeTokenId)
+
+        # Signing processes are spawned, with their keys loaded, before the first job
+        keys = {'loopringPrivateKey': next(iter(self.configs.values()))[1].loopringPrivateKey}
+        if 'transfer' in self.configs:
+            keys['metamaskPrivateKey'] = self.configs['transfer'][1].metamaskPrivateKey
+        self.signing_pool = SigningPool(self.args.workers, keys=keys)
+        await self.signing_pool.map(hash_nft_datas, [[0] * 6] * max(1, self.args.workers), chunksize=1)
+        if 'mint' in self.configs:
+            await self.signing_pool.map(sign_mints, [[0] * 9] * max(1, self.args.workers), chunksize=1)
+
+        self.runners = [asyncio.ensure_future(self.run_jobs()) for _ in range(self.args.jobs)]
+
+    async def stop(self) -> None:
+        self.stopping = True
+        for runner in self.runners:
+            runner.cancel()
+        await asyncio.gather(*self.runners, return_exceptions=True)
+        if self.signing_pool is not None:
+            self.signing_pool.close()
+        if self.storage_leases is not None:
+            self.storage_leases.close()
+
+    def submit(self, request: dict) -> Job:
+        job_type = request.get('type')
+        if job_type not in JOURNALS:
+            raise JobError(f"Invalid type: {job_type}, should be mint or transfer")
+        if job_type not in self.configs:
+            raise JobError(f"{job_type.capitalize()} jobs are disabled, see the daemon output")
+        try:
+            priority = int(request.get('priority') or 0)
+            amount = int(request.get('amount') or os.getenv("AMOUNT") or 1)
+            max_fee = float(request.get('max_fee') or self.args.max_fee)
+        except (TypeError, ValueError) as err:
+            raise JobError(f"Invalid priority, amount or max_fee: {err}")
+        if amount <= 0:
+            raise JobError(f"Invalid amount ({amount}), should be > 0")
+        if not 0 < max_fee <= self.args.max_fee:
+            raise JobError(f"Invalid max_fee ({max_fee}), should be > 0 and at most the max fee of the daemon ({self.args.max_fee})")
+        params = {key: value for key, value in request.items() if key not in ['type', 'priority']}
+        params['amount'] = amount
+        params['max_fee'] = max_fee
+        params['test'] = bool(request.get('test'))
+
+        # Checked now rather than when the job runs
+        if job_type == 'mint':
+            job_cids(params)
+        else:
+            job_tos(params)
+            if not params.get('nft_id'):
+                raise JobError("Missing nft_id")
+
+        id = self.next_id
+        self.next_id += 1
+        job_dir = os.path.join(self.args.output_dir, "jobs", str(id))
+        job = Job(id, job_type, priority, params, os.path.join(job_dir, JOURNALS[job_type]))
+        self.jobs[id] = job
+        self.queue.put_nowait((-priority, id))
+        return job
+
+    def cancel(self, job: Job) -> None:
+        if job.status == JobStatus.QUEUED:
+            job.status = JobStatus.CANCELLED    # Dropped when it comes out of the queue
+            job.finished = time.time()
+        elif job.status == JobStatus.RUNNING and job.task is not None:
+            job.task.cancel()
+
+    async def run_jobs(self) -> None:
+        while True:
+            _, id = await self.queue.get()
+            job = self.jobs[id]
+            if job.status != JobStatus.QUEUED:
+                continue
+
+            job.status = JobStatus.RUNNING
+            job.started = time.time()
+            print(f"Job {job.id}: running {job.type} (priority {job.priority})")
+            os.makedirs(os.path.dirname(job.journal), exist_ok=True)
+            with JobJournal(job.journal, job) as journal:
+                journal.append({'event': 'start', 'job': job.to_dict()})
+                job.task = asyncio.ensure_future(self.run_mint(job, journal) if job.type == 'mint' else self.run_transfer(job, journal))
+                try:
+                    await job.task
+                    job.status = JobStatus.DONE
+                except asyncio.CancelledError:
+                    job.status = JobStatus.CANCELLED
+                    if self.stopping:   # The job was cancelled along with its runner
+                        raise
+                except Exception as err:
+                    job.status = JobStatus.FAILED
+                    job.error = str(err) or type(err).__name__
+                finally:
+                    job.finished = time.time()
+                    job.task = None
+                    journal.append({'event': 'end', 'job': job.to_dict()})
+            print(f"Job {job.id}: {job.status} in {job.finished - job.started:.3f}s, results: {job.results}" + (f", error: {job.error}" if job.error else ""))
+
+    # Offchain parameters of the jobs of a type on a token (the fee token of mints, the NFT token of transfers),
+    # with an offchain fee at most `fee_ttl` seconds old
+    # Those of a token are fetched in full by its first job, the storage IDs of the token are seeded with them
+    async def get_offchain_parameters(self, job_type: str, token_id: int) -> dict:
+        key = (job_type, token_id)
+        cfg, secret = self.configs[job_type]
+        if key not in self.offchain_parameters:
+            try:
+                if job_type == 'mint':
+                    parameters = await minter.get_offchain_parameters(cfg, secret)
+                else:
+                    parameters = await transfer.get_offchain_parameters(cfg, secret, token_id)
+            except SystemExit as err:   # Exit of the scripts when the API fails, only the job fails
+                raise RuntimeError(str(err))
+            self.storage_ids[cfg.minterAccount if job_type == 'mint' else cfg.fromAccount].seed(token_id, parameters['storage_id']['offchainId'])
+            self.offchain_parameters[key] = parameters
+            self.fees_updated[key] = time.monotonic()
+            return parameters
+
+        parameters = self.offchain_parameters[key]
+        if time.monotonic() - self.fees_updated[key] < self.fee_ttl:
+            return parameters
+
+        async with LoopringMintService() as lms:
+            off_chain_fee = await lms.getOffChainFee(apiKey=secret.loopringApiKey,
+                                                     accountId=cfg.minterAccount if job_type == 'mint' else cfg.fromAccount,
+                                                     requestType=9 if job_type == 'mint' else 11,     # NFT_MINT or NFT_TRANSFER
+                                                     tokenAddress=parameters['counterfactual_nft']['tokenAddress'])
+        if off_chain_fee is None:
+            raise RuntimeError("Failed to obtain offchain fee")
+
+        # New parameters, running jobs keep the fee they were signed with
+        parameters = dict(parameters, off_chain_fee=off_chain_fee)
+        self.offchain_parameters[key] = parameters
+        self.fees_updated[key] = time.monotonic()
+        return parameters
+
+    # The fee of a job is approved when it is at most its max fee, the job is rejected otherwise
+    def approve_fee(self, job: Job, offchain_parameters: dict, journal: Journal) -> None:
+        cfg, _ = self.configs[job.type]
+        approved_fee = offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]
+        job.fee = int(approved_fee['fee']) / 10 ** token_decimals[approved_fee['token']]
+        job.fee_symbol = approved_fee['token']
+        approved = job.fee <= job.params['max_fee']
+        journal.append({'event': 'fee_approval', 'fee_approval': approved, 'fee': job.fee, 'maxFee': job.params['max_fee'], 'feeSymbol': job.fee_symbol})
+        if not approved:
+            raise JobError(f"Offchain fee of {job.fee}{job.fee_symbol} above the max fee of the job ({job.params['max_fee']}{job.fee_symbol})")
+
+    # Submission of a job is paused while the offchain fee is above the max fee it is signed with, or above the max fee of the job
+    def fee_watcher(self, job: Job, offchain_parameters: dict, journal: Journal) -> FeeWatcher:
+        cfg, secret = self.configs[job.type]
+        get_offchain_fee = minter.get_offchain_fee if job.type == 'mint' else transfer.get_offchain_fee
+        approved_fee = offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]
+        decimals = token_decimals[approved_fee['token']]
+
+        def on_change(paused: bool, fee: int) -> None:
+            job.fee_paused = paused
+            if fee is not None:
+                job.fee = fee / 10 ** decimals
+            journal.append({'event': 'fee_paused' if paused else 'fee_resumed', 'fee': fee})
+
+        return FeeWatcher(lambda: get_offchain_fee(cfg, secret, offchain_parameters['counterfactual_nft']['tokenAddress']),
+                          max_fee=min(int( (1 + cfg.feeSlippage) * int(approved_fee['fee']) ), int(job.params['max_fee'] * 10 ** decimals)),
+                          interval=self.fee_ttl,
+                          decimals=decimals,
+                          symbol=approved_fee['token'],
+                          on_change=on_change)
+
+    async def run_mint(self, job: Job, journal: Journal) -> None:
+        cfg, secret = self.configs['mint']
+        cids = job_cids(job.params)
+        job.total = len(cids) if isinstance(cids, list) else None
+        offchain_parameters = await self.get_offchain_parameters('mint', cfg.maxFeeTokenId)
+        journal.append({'event': 'offchain_parameters', 'offchain_parameters': offchain_parameters})
+        self.approve_fee(job, offchain_parameters, journal)
+
+        stats = Struct({'checked': 0, 'existing': 0})
+        batches = minter.iter_cids_to_mint(cfg,
+                                           self.signing_pool,
+                                           cids=iter(cids),
+                                           amount=job.params['amount'],
+                                           offchain_parameters=offchain_parameters,
+                                           concurrency=self.args.concurrency,
+                                           journal=journal,
+                                           stats=stats,
+                                           batch_size=self.args.concurrency * 100)
+        async with self.fee_watcher(job, offchain_parameters, journal) as fee_watcher:
+            await minter.mint_batch(cfg,
+                                    secret,
+                                    self.signing_pool,
+                                    self.storage_ids[cfg.minterAccount],
+                                    batches=batches,
+                                    amount=job.params['amount'],
+                                    offchain_parameters=offchain_parameters,
+                                    test_mode=job.params['test'],
+                                    concurrency=self.args.concurrency,
+                                    journal=journal,
+                                    fee_watcher=fee_watcher,
+                                    total=job.total)
+
+    # Balance entry of an NFT of the sender with at least `amount` left, the balance is only scanned again when
+    # the NFT was not looked up yet or the transfers of the daemon may have used it up
+    async def get_nft(self, nft_id: str, amount: int) -> NftEntry:
+        if nft_id not in self.nfts or self.nfts_available[nft_id] < amount:
+            cfg, secret = self.configs['transfer']
+            nft_balance = await transfer.get_nft_balance(cfg, secret, self.args.concurrency)
+            nfts = transfer.filter_nft_balance_by(nft_balance, 'nftId', nft_id)
+            if len(nfts['data']) == 0:
+                raise JobError(f"NFT {nft_id} not found in balance of account {cfg.fromAccount}")
+            self.nfts[nft_id] = nfts['data'][0]
+            self.nfts_available[nft_id] = self.nfts[nft_id].total
+
+        if self.nfts_available[nft_id] < amount:
+            raise JobError(f"Not enough of NFT {nft_id} in balance of account {self.configs['transfer'][0].fromAccount} ({self.nfts_available[nft_id]}, but expected {amount} or more)")
+        return self.nfts[nft_id]
+
+    # One-to-many transfer of a single NFT, as transfer.py --single (its journal can be resumed by transfer.py --resume --output-dir)
+    async def run_transfer(self, job: Job, journal: Journal) -> None:
+        cfg, secret = self.configs['transfer']
+        tos = job_tos(job.params)
+        amount = job.params['amount']
+
+        resolved_tos = await transfer.resolve_accounts(tos, self.args.concurrency)
+        recipients = []
+        skipped_tos = []
+        for to in tos:
+            to_account, to_address = resolved_tos[transfer.normalize_account(to)]
+            if to_account and to_address:
+                recipients.append((to, to_account, to_address))
+            else:
+                skipped_tos.append(to)
+        if len(recipients) == 0:
+            raise JobError("No valid to address found, no one to transfer to")
+        job.total = len(recipients)
+
+        # Reserved for this job until it ends, the transfers that did not succeed give it back
+        nft_info = await self.get_nft(job.params['nft_id'], len(recipients) * amount)
+        self.nfts_available[nft_info.nftId] -= len(recipients) * amount
+        try:
+            nfts = {'totalNum': 1, 'data': [nft_info]}
+            weights = [nft_info.total]
+            journal.append({'event': 'recipients', 'nfts': nfts, 'weights': weights, 'total_amount': nft_info.total, 'recipients': recipients, 'invalid_tos': skipped_tos, 'mode': TransferMode.SINGLE, 'amount': amount}, sync=True)
+
+            offchain_parameters = await self.get_offchain_parameters('transfer', nft_info.tokenId)
+            journal.append({'event': 'offchain_parameters', 'offchain_parameters': offchain_parameters})
+            self.approve_fee(job, offchain_parameters, journal)
+
+            async with self.fee_watcher(job, offchain_parameters, journal) as fee_watcher:
+                await transfer.transfer_batch(cfg,
+                                              secret,
+                                              self.signing_pool,
+                                              self.storage_ids[cfg.fromAccount],
+                                              recipients=recipients,
+                                              positions=list(range(len(recipients))),
+                                              nfts=nfts,
+                                              weights=weights,
+                                              pending={},
+                                              mode=TransferMode.SINGLE,
+                                              amount=amount,
+                                              offchain_parameters=offchain_parameters,
+                                              test_mode=job.params['test'],
+                                              journal=journal,
+                                              fee_watcher=fee_watcher)
+        finally:
+            transferred = (job.results.get('SUCCESS', 0) + job.results.get('UNKNOWN', 0)) * amount     # Unknown ones may have been sent
+            self.nfts_available[nft_info.nftId] += len(recipients) * amount - transferred
+
+        if len(skipped_tos) > 0:
+            print(f"Job {job.id}: skipped {len(skipped_tos)} invalid to addresses: {', '.join(skipped_tos)}")
+
+    def to_dict(self) -> dict:
+        return {'uptime': round(time.time() - self.started, 3),
+                'job_types': list(self.configs),
+                'accounts': {job_type: cfg.minterAccount if job_type == 'mint' else cfg.fromAccount for job_type, (cfg, _) in self.configs.items()},
+                'workers': self.args.workers,
+                'jobs': len(self.jobs),
+                'queued': sum(1 for job in self.jobs.values() if job.status == JobStatus.QUEUED),
+                'running': sum(1 for job in self.jobs.values() if job.status == JobStatus.RUNNING)}
+
+# Local HTTP API of the daemon:
+#  - POST /jobs: submit a job, {"type": "mint", "cid"|"cids"|"json", ...} or {"type": "transfer", "nft_id", "to", ...}
+#    with the optional "priority" (higher first, default 0), "amount", "max_fee" (at most --max-fee) and "test", answers the job
+#  - GET /jobs, GET /jobs/{id}: status and results of the jobs
+#  - DELETE /jobs/{id}: cancel a queued or running job
+#  - GET /status: the daemon and its queue, GET /metrics: API metrics in the Prometheus text format
+# With a `token`, every request needs the header `Authorization: Bearer <token>`
+def make_app(daemon: Daemon, token: str = None) -> web.Application:
+    @web.middleware
+    async def check_token(request, handler):
+        if token is not None and not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+            return web.json_response({'error': "Missing or invalid bearer token"}, status=401)
+        return await handler(request)
+
+    def get_job(request) -> Job:
+        job = daemon.jobs.get(int(request.match_info['id']))
+        if job is None:
+            raise web.HTTPNotFound(text=json.dumps({'error': f"No job {request.match_info['id']}"}), content_type='application/json')
+        return job
+
+    async def submit_job(request):
+        try:
+            body = await request.json()
+            if not isinstance(body, dict):
+                raise JobError("Expected a JSON object")
+            job = daemon.submit(body)
+        except (JobError, ValueError) as err:
+            return web.json_response({'error': str(err)}, status=400)
+        print(f"Job {job.id}: {job.type} queued (priority {job.priority})")
+        return web.json_response(job.to_dict(), status=202)
+
+    async def list_jobs(request):
+        status = request.query.get('status')
+        return web.json_response([job.to_dict() for job in daemon.jobs.values() if status is None or job.status == status])
+
+    async def show_job(request):
+        return web.json_response(get_job(request).to_dict())
+
+    async def cancel_job(request):
+        job = get_job(request)
+        daemon.cancel(job)
+        return web.json_response(job.to_dict())
+
+    async def status(request):
+        return web.json_response(daemon.to_dict())
+
+    async def metrics(request):
+        return web.Response(text=LoopringMintService.metrics.to_prometheus(), content_type='text/plain')
+
+    app = web.Application(middlewares=[check_token])
+    app.add_routes([web.post('/jobs', submit_job),
+                    web.get('/jobs', list_jobs),
+                    web.get(r'/jobs/{id:\d+}', show_job),
+                    web.delete(r'/jobs/{id:\d+}', cancel_job),
+                    web.get('/status', status),
+                    web.get('/metrics', metrics)])
+    return app
+
+async def main():
+    load_dotenv()
+
+    # API endpoint, overridden to run against a local mock (see benchmarks/mock_api.py)
+    LoopringMintService.base_url = os.getenv("LOOPRING_API_URL") or LoopringMintService.base_url
+
+    # check for command line arguments
+    try:
+        args = parse_args()
+    except Exception as err:
+        sys.exit(f"Failed to initialize the daemon: {err}")
+
+    # Generate paths
+    paths = Struct()
+    paths.account_cache = os.path.join(os.path.dirname(__file__), ".cache", "accounts.sqlite")
+    paths.metrics = os.path.join(args.output_dir, "api-metrics")  # .prom and .json
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, stopping.set)
+
+    # API metrics are written on exit, and on demand with `kill -USR1 <pid>`
+    LoopringMintService.metrics.dump_on_signal(loop, paths.metrics)
+
+    daemon = None
+    runner = None
+    try:
+        # One pooled session for every request of every job
+        await LoopringMintService.open_shared_session(keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE") or 30),
+                                                      limit_per_host=args.concurrency * 2,
+                                                      dns_cache_ttl=int(os.getenv("DNS_CACHE_TTL") or 300),
+                                                      warmup=args.concurrency)
+
+        # Persistent cache of ENS and account ID resolutions
+        LoopringMintService.account_cache = AccountCache(paths.account_cache, ens_ttl=float(os.getenv("ENS_CACHE_TTL") or 86400))
+        if args.refresh_accounts:
+            LoopringMintService.account_cache.clear()
+
+        print("Loading accounts, API keys and signers...")
+        daemon = Daemon(args)
+        await daemon.start()
+
+        runner = web.AppRunner(make_app(daemon, args.token))
+        await runner.setup()
+        if args.port:
+            site = web.TCPSite(runner, args.host, args.port)
+            address = f"http://{args.host}:{args.port}"
+        else:
+            if os.path.exists(args.socket):     # Left by a previous run
+                os.remove(args.socket)
+            site = web.UnixSite(runner, args.socket)
+            address = f"unix:{args.socket}"
+        await site.start()
+        if not args.port:
+            os.chmod(args.socket, 0o600)    # Jobs spend fees: only the owner may submit them
+        print(f"Listening on {address}")
+
+        await stopping.wait()
+        print("Stopping, running jobs are cancelled")
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+            if not args.port and os.path.exists(args.socket):
+                os.remove(args.socket)
+        if daemon is not None:
+            await daemon.stop()
+        await LoopringMintService.close_shared_session()
+        LoopringMintService.metrics.dump(paths.metrics)
+        if LoopringMintService.account_cache is not None:
+            LoopringMintService.account_cache.close()
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
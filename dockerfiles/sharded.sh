@@ -0,0 +1,4 @@
+#!/bin/sh
+
+cd /loopyminty
+python3 sharded.py $@
@@ -9,10 +9,18 @@ import argparse
 import asyncio
 import json
 import base58
-import re
+import itertools
 
 from DataClasses import *
-from LoopringMintService import LoopringMintService, NFTDataEddsaSignHelper, NFTEddsaSignHelper
+from AccountCache import AccountCache
+from Journal import Journal
+from IdRanges import IdRanges
+from FeeWatcher import FeeWatcher
+from Profiler import profiler
+from Manifest import read_manifest
+from LoopringMintService import LoopringMintService, StorageIdAllocator
+from StorageIdLeases import StorageIdLeases
+from SigningPool import SigningPool, hash_nft_datas, sign_mints
 
 # Verbose output
 VERBOSE = False
@@ -37,13 +45,6 @@ async def get_account_info(account: str):
             address = await lms.getAccountAddress(id)
     return id, address
 
-async def retry_async(coro, *args, timeout: float=3, retries: int=3, **kwds):
-    for attempts in range(retries):
-        try:
-            return await asyncio.wait_for(coro(*args, **kwds), timeout=timeout)
-        except asyncio.TimeoutError:
-            print("Retrying... " + str(attempts))
-
 async def eternity(s: float):
     await asyncio.sleep(s)
 
@@ -89,10 +90,10 @@ async def load_config(args, paths: Struct):
     cfg.exchange              = "0x0BABA1Ad5bE3a5C0a66E7ac838a129Bf948f1eA4"
     
     # Resolve ENS, get account_id and ETH address
-    cfg.minterAccount, cfg.minterAddress = await retry_async(get_account_info, cfg.minter, retries=3)
+    cfg.minterAccount, cfg.minterAddress = await get_account_info(cfg.minter)
     assert cfg.minterAddress and cfg.minterAccount, f"Invalid minter: {cfg.minter} aka {cfg.minterAddress} (account ID {cfg.minterAccount})"
     if cfg.royalty:
-        cfg.royaltyAccount, cfg.royaltyAddress = await retry_async(get_account_info, cfg.royalty, retries=3)
+        cfg.royaltyAccount, cfg.royaltyAddress = await get_account_info(cfg.royalty)
         assert cfg.royaltyAddress and cfg.royaltyAccount, f"Invalid royalty account: {cfg.royalty} aka {cfg.royaltyAddress} (account ID {cfg.royaltyAddress})"
 
     assert secret.loopringPrivateKey, "Missing private key (LOOPRING_PRIVATE_KEY)"
@@ -114,6 +115,13 @@ def parse_args():
     parser.add_argument("--testmint", help="Skips the mint step", action='store_true')
     parser.add_argument("-V", "--verbose", help="Verbose output", action='store_true')
     parser.add_argument("--noprompt", help="Skip all user prompts", action='store_true')
+    parser.add_argument("--resume", help="Resume the previous mint, skipping the NFTs it already minted", action='store_true')
+    parser.add_argument("--refresh-accounts", help="Clear the cached ENS and account ID resolutions", action='store_true')
+    parser.add_argument("--concurrency", help="Specify the number of mints submitted concurrently", type=int)
+    parser.add_argument("--workers", help="Specify the number of signing processes (0 to sign in the main process)", type=int)
+    parser.add_argument("--profile", help="Print the time spent in each phase at exit, with a function profile (cprofile) or the memory allocations (tracemalloc)", nargs='?', const='time', choices=['time', 'cprofile', 'tracemalloc'])
+    parser.add_argument("--output-dir", help="Directory of the journal, API metrics and profile (default: next to the script)", type=str)
+    parser.add_argument("--storage-leases", metavar="PATH", help="SQLite file to lease storage ID ranges from, shared by the processes running on the same account (see sharded.py)", type=str)
     parser.add_argument("--loopygen", help=argparse.SUPPRESS, action='store_true')
     parser.add_argument("--name", help=argparse.SUPPRESS, type=str)
 
@@ -121,14 +129,11 @@ def parse_args():
     single_group.add_argument("-c", "--cid", help="Specify the CIDv0 hash for the metadata to mint", type=str)
 
     batch_group = parser.add_argument_group(title="Batch mint", description="Use these options to batch mint multiple NFTs:")
-    batch_group.add_argument("-j", "--json", help="Specify a json file containing a list of CIDv0 hash to batch mint", type=str)
+    batch_group.add_argument("-j", "--json", help="Specify a manifest of IDs and CIDv0 hashes to batch mint (JSON array, JSON lines or CSV)", type=str)
     batch_group.add_argument("-s", "--start", help="Specify the the starting ID to batch mint", type=int)
     batch_group.add_argument("-e", "--end", help="Specify the last ID to batch mint", type=int)
     args = parser.parse_args()
 
-    # Rebuild command
-    args.command = "./docker.sh mint " + " ".join(sys.argv[1:])
-
     # CID sources
     assert args.json or args.cid or (args.loopygen and args.name), "Missing --cid or --json argument, please provide one"
 
@@ -146,6 +151,16 @@ def parse_args():
     # Mint amount
     if not args.amount:
         args.amount = int(os.getenv("AMOUNT") or 1)
+
+    # Mints in flight
+    if not args.concurrency:
+        args.concurrency = int(os.getenv("CONCURRENCY") or 16)
+    assert args.concurrency > 0, f"Invalid argument --concurrency ({args.concurrency}), should be > 0"
+
+    # Signing processes
+    if args.workers is None:
+        args.workers = int(os.getenv("SIGNING_WORKERS") or os.cpu_count() or 1)
+    assert args.workers >= 0, f"Invalid argument --workers ({args.workers}), should be >= 0"
     
     # ID selection (start/end)
     if not args.start:
@@ -242,68 +257,104 @@ async def get_offchain_parameters(cfg, secret):
 
     return parameters
 
-async def get_hashes_and_sign(cfg, secret, cid: str, amount: int, offchain_parameters: dict, info: dict):
-    # Generate the nft id here
-    nft_id = "0x" + base58.b58decode(cid).hex()[4:]    # Base58 to hex and drop first 2 bytes
-    log(f"Generated NFT ID: {nft_id}")
-    info['nft_id'] = nft_id
-
-    # Generate the poseidon hash for the nft data
-    # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L704
-    ntf_id_hi = int(nft_id[2:34], 16)   # Skip "0x" prefix
-    nft_id_lo = int(nft_id[34:66], 16)
-    inputs = [
-        int(cfg.minterAddress, 16),
-        cfg.nftType,
-        int(offchain_parameters['counterfactual_nft']['tokenAddress'], 16),
-        nft_id_lo,
-        ntf_id_hi,
-        cfg.royaltyPercentage
-    ]
-    hasher = NFTDataEddsaSignHelper()
-    nft_data_poseidon_hash = hasher.hash(inputs)
-    # plog(inputs)
-    log("Hashed NFT data: 0x{0:0{1}x}".format(nft_data_poseidon_hash, 64))
-    info['nft_data_poseidon_hash'] = "0x{0:0{1}x}".format(nft_data_poseidon_hash, 64)
-
-    # Generate the poseidon hash for the remaining data
-    # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L899
-    inputs = [
-        int(cfg.exchange, 16),
-        cfg.minterAccount,   # minterId
-        cfg.minterAccount,   # toAccountId
-        nft_data_poseidon_hash,
-        amount,
-        cfg.maxFeeTokenId,
-        int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']) ),
-        # int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']),
-        cfg.validUntil,
-        offchain_parameters['storage_id']['offchainId']
-    ]
-    hasher = NFTEddsaSignHelper(private_key=secret.loopringPrivateKey)
-    nft_poseidon_hash = hasher.hash(inputs)
-    # plog(inputs)
-    log("Hashed NFT payload: 0x{0:0{1}x}".format(nft_poseidon_hash, 64))
-    info['nft_poseidon_hash'] = "0x{0:0{1}x}".format(nft_poseidon_hash, 64)
-
-    eddsa_signature = hasher.sign(inputs)
-    log(f"Signed NFT payload hash: {eddsa_signature}")
-    info['eddsa_signature'] = eddsa_signature
-
-    return nft_id, nft_data_poseidon_hash, eddsa_signature
-
-async def mint_nft(cfg, secret, nft_data_poseidon_hash: str, nft_id: str, amount: int,
-                   eddsa_signature: str, offchain_parameters: dict, test_mode: bool, info: dict):
+# Current offchain fee of a mint in the fee token, None if it could not be obtained
+async def get_offchain_fee(cfg, secret, token_address: str):
     async with LoopringMintService() as lms:
-        # Check if NFT exists (get the token nft data)
-        nft_data = await lms.getNftData(nftDatas="0x{0:0{1}x}".format(nft_data_poseidon_hash, 64))
-        log(f"Nft data: {json.dumps(nft_data, indent=2)}")
-        info['nft_data'] = nft_data
-        nft_exists = (lms.last_status == 200) and (nft_data is not None) and (len(nft_data) > 0)
-
-        if nft_exists:
-            return MintResult.EXISTS
-
+        off_chain_fee = await lms.getOffChainFee(apiKey=secret.loopringApiKey, accountId=cfg.minterAccount, requestType=9, tokenAddress=token_address)
+    if off_chain_fee is None:
+        return None
+    return int(off_chain_fee['fees'][cfg.maxFeeTokenId]['fee'])
+
+# Generate the nft ids and the poseidon hashes of the nft data of CIDs on the signing pool
+async def get_nft_data_hashes(cfg, signing_pool: SigningPool, cids: 'list[str]', token_address: str):
+    nft_ids = []
+    nft_data_inputs = []
+    for cid in cids:
+        # Generate the nft id here
+        nft_id = "0x" + base58.b58decode(cid).hex()[4:]    # Base58 to hex and drop first 2 bytes
+        log(f"Generated NFT ID: {nft_id}")
+        nft_ids.append(nft_id)
+
+        # Inputs of the poseidon hash for the nft data
+        # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L704
+        ntf_id_hi = int(nft_id[2:34], 16)   # Skip "0x" prefix
+        nft_id_lo = int(nft_id[34:66], 16)
+        nft_data_inputs.append([
+            int(cfg.minterAddress, 16),
+            cfg.nftType,
+            int(token_address, 16),
+            nft_id_lo,
+            ntf_id_hi,
+            cfg.royaltyPercentage
+        ])
+    nft_data_poseidon_hashes = await signing_pool.map(hash_nft_datas, nft_data_inputs)
+
+    return nft_ids, nft_data_poseidon_hashes
+
+# Hash and sign a chunk of mints (with their storage id assigned) on the signing pool, the signatures are set on the jobs
+async def get_hashes_and_sign(cfg, signing_pool: SigningPool, jobs: 'list[MintJob]', offchain_parameters: dict):
+    # Same for every mint of the run
+    exchange = int(cfg.exchange, 16)
+    minter_account = cfg.minterAccount
+    max_fee_token_id = cfg.maxFeeTokenId
+    max_fee_amount = int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][max_fee_token_id]['fee']) )
+    valid_until = cfg.validUntil
+
+    nft_inputs = []
+    for job in jobs:
+        # Inputs of the poseidon hash for the remaining data
+        # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L899
+        nft_inputs.append([
+            exchange,
+            minter_account,   # minterId
+            minter_account,   # toAccountId
+            job.nft_data_poseidon_hash,
+            job.amount,
+            max_fee_token_id,
+            max_fee_amount,
+            valid_until,
+            job.storage_id
+        ])
+    nft_signatures = await signing_pool.map(sign_mints, nft_inputs)
+
+    for job, (nft_poseidon_hash, eddsa_signature) in zip(jobs, nft_signatures):
+        log("Hashed NFT payload: 0x{0:0{1}x}".format(nft_poseidon_hash, 64))
+        job.nft_poseidon_hash = "0x{0:0{1}x}".format(nft_poseidon_hash, 64)
+        log(f"Signed NFT payload hash: {eddsa_signature}")
+        job.eddsa_signature = eddsa_signature
+
+# Pre-flight check of the NFTs that already exist, with `nft_datas_per_request` nft datas per getNftData request
+# Returns the mint jobs of the CIDs left to mint, with their nft id and nft data hash
+async def filter_existing_nfts(cfg, signing_pool: SigningPool, cids: list, amount: int, offchain_parameters: dict, concurrency: int, journal: Journal, nft_datas_per_request: int=100):
+    nft_ids, nft_data_poseidon_hashes = await get_nft_data_hashes(cfg, signing_pool, [cid['CID'] for cid in cids], offchain_parameters['counterfactual_nft']['tokenAddress'])
+    nft_datas = ["0x{0:0{1}x}".format(nft_data_poseidon_hash, 64) for nft_data_poseidon_hash in nft_data_poseidon_hashes]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    async def get_nft_datas(chunk: 'list[str]'):
+        async with semaphore:
+            async with LoopringMintService() as lms:
+                with profiler.phase('get_nft_datas', items=len(chunk), cpu=False):
+                    return await lms.getNftData(nftDatas=",".join(chunk))
+
+    existing_nft_datas = await asyncio.gather(*[get_nft_datas(nft_datas[i:i + nft_datas_per_request]) for i in range(0, len(nft_datas), nft_datas_per_request)])
+    if any(nft_data is None for nft_data in existing_nft_datas):
+        raise RuntimeError("Failed to check for existing NFTs")
+    existing = set(int(nft_data['nftData'], 16) for chunk in existing_nft_datas for nft_data in chunk)
+
+    jobs = []
+    for cid, nft_id, nft_data_poseidon_hash, nft_data in zip(cids, nft_ids, nft_data_poseidon_hashes, nft_datas):
+        if nft_data_poseidon_hash in existing:
+            log(f"NFT {cid['ID']}: Skipping mint (nft already exists) ({amount}x {cid['CID']})")
+            journal.append({'event': 'result', 'id': cid['ID'], 'cid': cid['CID'], 'amount': amount, 'nft_id': nft_id, 'nft_data_poseidon_hash': nft_data, 'result': MintResult.EXISTS})
+            continue
+
+        jobs.append(MintJob(cid['ID'], cid['CID'], amount, nft_id, nft_data_poseidon_hash))
+
+    return jobs
+
+async def mint_nft(cfg, secret, job: MintJob, offchain_parameters: dict, test_mode: bool):
+    async with LoopringMintService() as lms:
+        # NFTs that already exist have been filtered out by `filter_existing_nfts`
         if test_mode:
             return MintResult.TESTMODE
         
@@ -317,32 +368,235 @@ async def mint_nft(cfg, secret, nft_data_poseidon_hash: str, nft_id: str, amount
             royaltyAddress=cfg.royaltyAddress,
             nftType=cfg.nftType,
             tokenAddress=offchain_parameters['counterfactual_nft']['tokenAddress'],
-            nftId=nft_id,
-            amount=str(amount),
+            nftId=job.nft_id,
+            amount=str(job.amount),
             validUntil=cfg.validUntil,
             royaltyPercentage=cfg.royaltyPercentage,
-            storageId=offchain_parameters['storage_id']['offchainId'],
+            storageId=job.storage_id,
             maxFeeTokenId=cfg.maxFeeTokenId,
             maxFeeAmount=int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']) ),
             forceToMint=False,
             counterFactualNftInfo=offchain_parameters['counterfactual_nft_info'],
-            eddsaSignature=eddsa_signature
+            eddsaSignature=job.eddsa_signature
         )
         log(f"Nft Mint reponse: {nft_mint_response}")
-        info['nft_mint_response'] = nft_mint_response
+        job.nft_mint_response = nft_mint_response
 
         if nft_mint_response is None:   # Something failed
-            mint_code = lms.last_error['resultInfo']['code']
+            mint_code = (lms.last_error or {}).get('resultInfo', {}).get('code')
             if mint_code == 114002: # Invalid fee amount
                 return MintResult.FEE_INVALID
+            if lms.retry_policy.maybe_processed(lms.last_status):
+                return MintResult.UNKNOWN
         elif lms.last_status == 200:    # Mint succeeded
             return MintResult.SUCCESS
         
+        # Rejected by the API (4xx): not processed
         return MintResult.FAILED
 
+# CIDs of the manifest (or --cid) within start/end
+def read_cids(args):
+    if args.json:
+        return read_manifest(args.json, start=args.start, end=args.end)
+    return [{'ID': 1, 'CID': args.cid}]
+
+# CIDs of the manifest (or --cid) within start/end, without the IDs completed by the previous run
+def iter_cids(args, completed: IdRanges):
+    for cid in read_cids(args):
+        if cid['ID'] not in completed:
+            yield cid
+
+# Read `cids` by batches of `batch_size` and yield the mint jobs of the CIDs left to mint of each batch (see `filter_existing_nfts`)
+# The next batch is checked while the current one is minted, `stats.checked` and `stats.existing` count the CIDs checked and skipped
+async def iter_cids_to_mint(cfg, signing_pool: SigningPool, cids, amount: int, offchain_parameters: dict, concurrency: int, journal: Journal, stats: Struct, batch_size: int):
+    def check(batch: list):
+        stats.checked += len(batch)
+        return asyncio.ensure_future(filter_existing_nfts(cfg,
+                                                          signing_pool,
+                                                          cids=batch,
+                                                          amount=amount,
+                                                          offchain_parameters=offchain_parameters,
+                                                          concurrency=concurrency,
+                                                          journal=journal))
+
+    next_check = None
+    if batch := list(itertools.islice(cids, batch_size)):
+        next_check = check(batch)
+    while next_check is not None:
+        jobs = await next_check
+        stats.existing += len(batch) - len(jobs)
+
+        next_check = None
+        if batch := list(itertools.islice(cids, batch_size)):
+            next_check = check(batch)
+        yield jobs
+
+# Rebuild the state of the previous mints from their journal: the IDs completed (minted or found to exist)
+# and the mints submitted without a result (ID -> signed record, with the offchain parameters it was signed with)
+def read_mint_journal(path: str) -> Struct:
+    state = Struct({'completed': IdRanges(), 'pending': {}})
+    offchain_parameters = None  # Parameters the following mints were signed with
+    signed = {}                 # Signed records of the mints without a result yet
+
+    for record in Journal.read(path):
+        event = record.get('event')
+        if event == 'offchain_parameters':
+            offchain_parameters = record['offchain_parameters']
+        elif event == 'signed':
+            signed[record['id']] = dict(record, offchain_parameters=offchain_parameters)
+        elif event == 'submitted':
+            if record['id'] in signed and signed[record['id']]['storage_id'] == record['storage_id']:
+                state.pending[record['id']] = signed[record['id']]
+        elif event == 'result':
+            signed.pop(record['id'], None)
+            state.pending.pop(record['id'], None)
+            if record['result'] in [MintResult.SUCCESS, MintResult.EXISTS]:
+                state.completed.add(record['id'], record['cid'])
+
+    return state
+
+# Pipelined batch mint of the job batches from `iter_cids_to_mint`: NFTs are signed ahead in chunks with storage IDs from `storage_ids`
+# and up to `concurrency` mints are submitted at once
+# Submission waits while `fee_watcher` is paused, mints rejected for their fee are submitted again as signed once it resumes
+# Mints in `pending` (ID -> signed record, see `read_mint_journal`) are sent again as signed, with the storage id of the previous run:
+# if that mint went through, this one is rejected instead of minting the NFT twice
+# Mints without a known outcome stay pending the same way: their storage id is never handed to another NFT
+async def mint_batch(cfg, secret, signing_pool: SigningPool, storage_ids: StorageIdAllocator, batches, amount: int, offchain_parameters: dict, test_mode: bool, concurrency: int, journal: Journal, fee_watcher: FeeWatcher, total: int=None, pending: dict=None):
+    chunk_size = concurrency * max(1, signing_pool.workers)  # NFTs signed at once across the signing processes
+    signed_jobs = asyncio.Queue(maxsize=concurrency)    # (job, offchain parameters it is signed with) signed ahead, waiting for a free submit slot
+    max_fee_token_id = cfg.maxFeeTokenId
+    pending = pending or {}
+    done_count = 0
+    unknown = 0
+
+    # Signed record of the previous run to send `job` again with, if any
+    def pending_record(job: MintJob) -> dict:
+        record = pending.get(job.id)
+        if record is not None and record['cid'] == job.cid and record['amount'] == job.amount and record['offchain_parameters'] is not None:
+            return record
+        return None
+
+    async def sign_chunk(chunk: 'list[MintJob]'):
+        new_jobs = []
+        for job in chunk:
+            if (record := pending_record(job)) is not None:
+                job.storage_id = record['storage_id']
+                job.nft_poseidon_hash = record['nft_poseidon_hash']
+                job.eddsa_signature = record['eddsa_signature']
+            else:
+                new_jobs.append(job)
+
+        # Pre-assign the storage id of each mint
+        for job in new_jobs:
+            job.storage_id = await storage_ids.next(max_fee_token_id)
+
+        # Generate Eddsa Signatures
+        await get_hashes_and_sign(cfg, signing_pool, new_jobs, offchain_parameters)
+        for job in new_jobs:
+            journal.append(dict(job.to_dict(), event='signed'))
+        return [(job, pending[job.id]['offchain_parameters'] if pending_record(job) is not None else offchain_parameters) for job in chunk]
+
+    async def sign_jobs():
+        pending_chunk = None    # Signed while the previous chunk is being submitted
+        try:
+            async for jobs in batches:
+                for i in range(0, len(jobs), chunk_size):
+                    signed_chunk, pending_chunk = pending_chunk, asyncio.ensure_future(sign_chunk(jobs[i:i + chunk_size]))
+                    if signed_chunk is not None:
+                        for signed_job in await signed_chunk:
+                            await signed_jobs.put(signed_job)
+
+            if pending_chunk is not None:
+                for signed_job in await pending_chunk:
+                    await signed_jobs.put(signed_job)
+        finally:
+            if pending_chunk is not None:   # Not left signing when signing or submission failed
+                pending_chunk.cancel()
+                await asyncio.gather(pending_chunk, return_exceptions=True)
+
+        for _ in range(concurrency):
+            await signed_jobs.put(None)     # Stop the submitters
+
+    async def submit_jobs():
+        nonlocal done_count, unknown
+        while (signed_job := await signed_jobs.get()) is not None:
+            job, job_parameters = signed_job
+            id = job.id
+            cid_hash = job.cid
+            resent = job_parameters is not offchain_parameters    # Signed by the previous run, with its storage id
+
+            # Submit the nft mint, again with the same storage id and signature while it is rejected for its fee
+            while True:
+                await fee_watcher.wait()
+                # On disk before the mint is sent, to never sign this NFT again with another storage id
+                with profiler.phase('journal_sync'):
+                    journal.append({'event': 'submitted', 'id': id, 'cid': cid_hash, 'storage_id': job.storage_id}, sync=True)
+                with profiler.phase('mint_nft', cpu=False):
+                    mint_result = await mint_nft(cfg,
+                                                 secret,
+                                                 job,
+                                                 offchain_parameters=job_parameters,
+                                                 test_mode=test_mode)
+                if mint_result != MintResult.FEE_INVALID:
+                    break
+                if job_parameters is not offchain_parameters:
+                    # Signed for the fee of the previous run: signed again for the current one, with the same storage id
+                    print(f"NFT {id}: Mint sent again rejected due to invalid fee, signing it again with the current fee ({amount}x {cid_hash})")
+                    job_parameters = offchain_parameters
+                    await get_hashes_and_sign(cfg, signing_pool, [job], offchain_parameters)
+                    journal.append(dict(job.to_dict(), event='signed'))
+                    continue
+                print(f"NFT {id}: Mint rejected due to invalid fee, retrying when fees are lower ({amount}x {cid_hash})")
+                fee_watcher.exceeded()
+            fee_watcher.accepted()
+            done_count += 1
+            progress = f"{done_count}/{total} NFT {id}:" if total is not None else f"{done_count} NFT {id}:"
+
+            if mint_result == MintResult.UNKNOWN:
+                # May have been processed: its storage id is kept and no result is journaled, so that `--resume` sends it again unchanged
+                # (the storage id ensures that it is minted at most once), the next storage ids are checked against the API
+                print(f"{progress} Mint outcome UNKNOWN, left pending to be sent again unchanged with --resume ({amount}x {cid_hash}, storage id: {job.storage_id})")
+                unknown += 1
+                journal.append(dict(job.to_dict(), event='unknown', result=mint_result), sync=True)
+                await storage_ids.reconcile(max_fee_token_id)
+                continue
+
+            journal.append(dict(job.to_dict(), event='result', result=mint_result))
+
+            if mint_result == MintResult.SUCCESS:
+                print(f"{progress} Successful Mint! ({amount}x {cid_hash})")
+            elif mint_result == MintResult.FAILED:
+                print(f"{progress} Mint FAILED... ({amount}x {cid_hash})")
+                # Storage id was rejected with the mint, re-sync with the API
+                # (one of the previous run may have been consumed by the mint it was first sent with)
+                if not resent:
+                    storage_ids.release(max_fee_token_id, job.storage_id)
+                await storage_ids.reconcile(max_fee_token_id)
+            elif mint_result == MintResult.TESTMODE:
+                print(f"{progress} Skipping mint (test mint mode) ({amount}x {cid_hash})")
+                if not resent:
+                    storage_ids.release(max_fee_token_id, job.storage_id)
+
+    # Signing stops when a submission fails and submission when signing fails
+    tasks = [asyncio.ensure_future(sign_jobs())] + [asyncio.ensure_future(submit_jobs()) for _ in range(concurrency)]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()   # Raises the failure, if any
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if unknown > 0:
+        print(f"{unknown} mints have no known outcome, run again with --resume to send them again unchanged")
+
 async def main():
     load_dotenv()
 
+    # API endpoint, overridden to run against a local mock (see benchmarks/mock_api.py)
+    LoopringMintService.base_url = os.getenv("LOOPRING_API_URL") or LoopringMintService.base_url
+
     # check for command line arguments
     try:
         args = parse_args()
@@ -351,121 +605,160 @@ async def main():
     
     # Generate paths
     paths = Struct()
-    paths.mint_info = os.path.join(os.path.dirname(__file__), "mint-info.json")
+    output_dir = args.output_dir or os.path.dirname(__file__)
+    paths.mint_info = os.path.join(output_dir, "mint-info.jsonl")
+    paths.account_cache = os.path.join(os.path.dirname(__file__), ".cache", "accounts.sqlite")
+    paths.metrics = os.path.join(output_dir, "api-metrics")  # .prom and .json
+    paths.profile = os.path.join(output_dir, "mint-profile")  # .json and .pstats
     paths.config = "./config.json"
     if args.loopygen and args.name:
         paths.traits = os.path.join("./images", args.name, "traits.json")
 
-    # Parse all cids from JSON or command line
-    if args.json:
-        with open(args.json, 'r') as f:
-            all_cids = json.load(f)
-    elif args.cid:
-        all_cids = [{"ID": 1, "CID": args.cid}]
-
     if not os.path.exists(os.path.dirname(paths.mint_info)):
         os.makedirs(os.path.dirname(paths.mint_info))
 
-    mint_info = []
-    mint_info.append({'args': vars(args)})
+    # IDs minted (or found to exist) by the previous run, as ranges of IDs checked against the CIDs of the manifest,
+    # and its mints submitted without a result, sent again as signed
+    completed = IdRanges()
+    pending = {}
+    if args.resume:
+        state = read_mint_journal(paths.mint_info)
+        completed, pending = state.completed, state.pending
+
+    journal = Journal(paths.mint_info, append=args.resume)
+    journal.append({'event': 'start', 'args': vars(args)})
 
     approved_fees_prompt = args.noprompt
+    signing_pool = None
+    storage_leases = None
 
-    try:
-        filtered_cids = []  # CIDs filtered based on start/end
+    if args.profile:
+        profiler.start(args.profile)
+
+    # API metrics are written on exit, and on demand with `kill -USR1 <pid>`
+    LoopringMintService.metrics.dump_on_signal(asyncio.get_running_loop(), paths.metrics)
 
-        cfg, secret = await load_config(args, paths)
+    try:
+        # One pooled session for every request of the run
+        await LoopringMintService.open_shared_session(keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE") or 30),
+                                                      limit_per_host=args.concurrency * 2,
+                                                      dns_cache_ttl=int(os.getenv("DNS_CACHE_TTL") or 300),
+                                                      warmup=args.concurrency)
+
+        # Persistent cache of ENS and account ID resolutions
+        LoopringMintService.account_cache = AccountCache(paths.account_cache, ens_ttl=float(os.getenv("ENS_CACHE_TTL") or 86400))
+        if args.refresh_accounts:
+            LoopringMintService.account_cache.clear()
+
+        with profiler.phase('load_config'):
+            cfg, secret = await load_config(args, paths)
         log("config dump:")
         plog(cfg)
-        mint_info.append({'cfg': cfg})
-
-        # Filter NFT by IDs and get off chain parameters
-        for cid in all_cids:
-            id = cid['ID']
-            cid_hash = cid['CID']
-
-            info = {'id': id, 'cid': cid_hash, 'amount': args.amount, 'skipped': True}
-
-            # Filter NFT based on IDs
-            if id < args.start or (args.end is not None and id > args.end):
-                mint_info.append(info)
-                continue
-
-            filtered_cids.append(cid)
-            info['skipped'] = False
-
-            mint_info.append(info)
-
-        if len(filtered_cids) == 0:
-            print(f"Collection does not contain NFT IDs within start/end arguments provided, nothing to mint ({args.start}/{args.end})")
+        journal.append({'event': 'config', 'cfg': cfg})
+
+        # CIDs are read from the manifest as they are minted, filtered on start/end and on the previous run
+        if len(completed) > 0:
+            # Ranges of IDs whose CIDs changed since the previous run are minted again, the NFTs that exist are skipped by the pre-flight check
+            # The whole manifest is read: the previous run may have had other start/end arguments
+            with profiler.phase('verify_completed'):
+                changed = completed.verify(read_manifest(args.json) if args.json else read_cids(args))
+            if changed > 0:
+                print(f"Resuming: the CIDs of the manifest changed since the previous run, checking again {changed} NFTs it completed")
+            print(f"Resuming: skipping the {len(completed)} NFTs completed by the previous run")
+        if len(pending) > 0:
+            print(f"Resuming: sending again the {len(pending)} mints submitted by the previous run without a result, with the same storage ids (unless they exist)")
+        cids = iter_cids(args, completed)
+        first_cid = next(cids, None)
+        if first_cid is None:
+            print(f"Collection does not contain NFT IDs left to mint within start/end arguments provided, nothing to mint ({args.start}/{args.end})")
             sys.exit(0)
+        cids = itertools.chain([first_cid], cids)
 
         # Get user API key
         print("Getting user API key... ", end='')
-        await get_user_api_key(cfg, secret)
+        with profiler.phase('get_user_api_key'):
+            await get_user_api_key(cfg, secret)
         print("done!")
 
         # Get storage id, token address and offchain fee
         print("Getting offchain parameters... ", end='')
-        offchain_parameters = await get_offchain_parameters(cfg, secret)
-        info['offchain_parameters'] = offchain_parameters
+        with profiler.phase('get_offchain_parameters'):
+            offchain_parameters = await get_offchain_parameters(cfg, secret)
+        journal.append({'event': 'offchain_parameters', 'offchain_parameters': offchain_parameters})
         print("done!")
 
-        # Estimate fees and get user approval
+        # Estimate fees and get user approval, NFTs are counted with a first pass over the manifest
+        cids_count = None
         if not approved_fees_prompt:
-            cfg.feeEstimate, cfg.feeLimit, cfg.feeSymbol = estimate_batch_fees(cfg, offchain_parameters['off_chain_fee'], len(filtered_cids))
+            with profiler.phase('count_nfts'):
+                cids_count = sum(1 for _ in iter_cids(args, completed))
+            cfg.feeEstimate, cfg.feeLimit, cfg.feeSymbol = estimate_batch_fees(cfg, offchain_parameters['off_chain_fee'], cids_count)
             log("--------")
-            approved_fees_prompt = prompt_yes_no(f"Estimated L2 fees for minting {args.amount} copies of {len(filtered_cids)} NFTs: {cfg.feeEstimate}-{cfg.feeLimit}{cfg.feeSymbol}, continue?", default="no")
-            mint_info.append({'fee_approval': approved_fees_prompt, 'feeEstimate': cfg.feeEstimate, 'feeLimit': cfg.feeLimit, 'feeSymbol': cfg.feeSymbol})
+            approved_fees_prompt = prompt_yes_no(f"Estimated L2 fees for minting {args.amount} copies of up to {cids_count} NFTs (existing NFTs are skipped): {cfg.feeEstimate}-{cfg.feeLimit}{cfg.feeSymbol}, continue?", default="no")
+            journal.append({'event': 'fee_approval', 'fee_approval': approved_fees_prompt, 'feeEstimate': cfg.feeEstimate, 'feeLimit': cfg.feeLimit, 'feeSymbol': cfg.feeSymbol})
             if not approved_fees_prompt: 
                 sys.exit("Aborted by user")
-        
-        # NFT Mint sequence
-        for i, cid in enumerate(filtered_cids):
-            id = cid['ID']
-            cid_hash = cid['CID']
 
-            info = {'id': id, 'cid': cid_hash, 'amount': args.amount}
+        signing_pool = SigningPool(args.workers, keys={'loopringPrivateKey': secret.loopringPrivateKey})
+
+        # Storage ids are allocated locally for the whole run, in ranges leased with the other processes of the account if shared
+        if args.storage_leases:
+            storage_leases = StorageIdLeases(args.storage_leases)
+        storage_ids = StorageIdAllocator(secret.loopringApiKey, cfg.minterAccount, leases=storage_leases, lease_size=int(os.getenv("STORAGE_ID_LEASE_SIZE") or 100))
+        storage_ids.seed(cfg.maxFeeTokenId, offchain_parameters['storage_id']['offchainId'])
+
+        # NFTs that were already minted are dropped batch by batch, ahead of the mints
+        stats = Struct({'checked': 0, 'existing': 0})
+        batches = iter_cids_to_mint(cfg,
+                                    signing_pool,
+                                    cids=cids,
+                                    amount=args.amount,
+                                    offchain_parameters=offchain_parameters,
+                                    concurrency=args.concurrency,
+                                    journal=journal,
+                                    stats=stats,
+                                    batch_size=args.concurrency * 100)
+
+        # Mints are paused while the offchain fee is above the approved max fee they are signed with
+        approved_fee = offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]
+        fee_watcher = FeeWatcher(lambda: get_offchain_fee(cfg, secret, offchain_parameters['counterfactual_nft']['tokenAddress']),
+                                 max_fee=int( (1 + cfg.feeSlippage) * int(approved_fee['fee']) ),
+                                 interval=float(os.getenv("FEE_POLL_INTERVAL") or 30),
+                                 decimals=token_decimals[approved_fee['token']],
+                                 symbol=approved_fee['token'],
+                                 on_change=lambda paused, fee: journal.append({'event': 'fee_paused' if paused else 'fee_resumed', 'fee': fee}))
 
-            # Generate Eddsa Signature
-            nft_id, nft_data_poseidon_hash, eddsa_signature = await get_hashes_and_sign(cfg, secret, cid=cid_hash, amount=args.amount, offchain_parameters=offchain_parameters, info=info)
-            
-            # Submit the nft mint
-            mint_result = await mint_nft(cfg,
-                                         secret,
-                                         nft_data_poseidon_hash=nft_data_poseidon_hash,
-                                         nft_id=nft_id,
-                                         amount=args.amount,
-                                         eddsa_signature=eddsa_signature,
-                                         offchain_parameters=offchain_parameters,
-                                         test_mode=args.testmint,
-                                         info=info)
-            
-            if mint_result == MintResult.SUCCESS:
-                print(f"{i+1}/{len(filtered_cids)} NFT {id}: Successful Mint! ({args.amount}x {cid_hash})")
-                offchain_parameters['storage_id']['offchainId'] += 2
-            elif mint_result == MintResult.FAILED:
-                print(f"{i+1}/{len(filtered_cids)} NFT {id}: Mint FAILED... ({args.amount}x {cid_hash})")
-            elif mint_result == MintResult.FEE_INVALID: # Invalid fees, exit cleanly
-                print(f"{i+1}/{len(filtered_cids)} NFT {id}: Mint FAILED due to invalid fee... ({args.amount}x {cid_hash})")
-                print(f"Fees increased above {cfg.feeLimit}{cfg.feeSymbol} limit, aborting...")
-                # Display command to restart mint where it stopped
-                restart_command = ""
-                if "--start " in args.command or "-s " in args.command:
-                    restart_command = re.sub(r'(?:-s)|(?:--start) \d+', f"--start {id}", args.command)
-                else:
-                    restart_command = args.command + f" --start {id}"
-                print(f"To restart when fees are lower use: \n{restart_command}")
-                sys.exit(1)
-            elif mint_result == MintResult.EXISTS:
-                print(f"{i+1}/{len(filtered_cids)} NFT {id}: Skipping mint (nft already exists) ({args.amount}x {cid_hash})")
-            elif mint_result == MintResult.TESTMODE:
-                print(f"{i+1}/{len(filtered_cids)} NFT {id}: Skipping mint (test mint mode) ({args.amount}x {cid_hash})")
-
-            mint_info.append(info)
+        # NFT Mint sequence
+        async with fee_watcher:
+            await mint_batch(cfg,
+                             secret,
+                             signing_pool,
+                             storage_ids,
+                             batches=batches,
+                             amount=args.amount,
+                             offchain_parameters=offchain_parameters,
+                             test_mode=args.testmint,
+                             concurrency=args.concurrency,
+                             journal=journal,
+                             fee_watcher=fee_watcher,
+                             total=cids_count,
+                             pending=pending)
+
+        if stats.existing > 0:
+            print(f"Skipped {stats.existing} NFTs that already exist")
+        if stats.existing == stats.checked:
+            print(f"All NFTs within start/end arguments already exist, nothing to mint ({args.start}/{args.end})")
     finally:
-        with open(paths.mint_info, 'w+') as f:
-            json.dump(mint_info, f, indent=4)
+        if signing_pool is not None:
+            signing_pool.close()
+        await LoopringMintService.close_shared_session()
+        LoopringMintService.metrics.dump(paths.metrics)
+        profiler.stop(paths.profile)
+        if LoopringMintService.account_cache is not None:
+            LoopringMintService.account_cache.close()
+        if storage_leases is not None:
+            storage_leases.close()
+        journal.close()
 
 if __name__ == '__main__':
     loop = asyncio.new_event_loop()
@@ -3,13 +3,17 @@
 from dotenv import load_dotenv
 import os
 from shutil import copy2
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import asyncio
 import yaspin
 import json
-from glob import glob
+from fnmatch import fnmatch
 
 from DataClasses import Struct
+from IpfsCid import file_cid
+from CidCache import CidCache
+from Profiler import profiler
 
 # Parse CLI arguments
 def parse_args():
@@ -20,6 +24,8 @@ def parse_args():
     input_grp.add_argument('--idir', help='Specify an input directory', type=str)
     parser.add_argument('--metadata', help='Generate metadata templates instead of the CIDs list', action='store_true')
     parser.add_argument('--overwrite', help='Overwrite the metadata files and all metadata fields', action='store_true')
+    parser.add_argument('--refresh-cache', help='Clear the cached CIDs and recalculate the CID of every file', action='store_true')
+    parser.add_argument('--profile', help='Print the time spent in each phase at exit, with a function profile (cprofile) or the memory allocations (tracemalloc)', nargs='?', const='time', choices=['time', 'cprofile', 'tracemalloc'])
     parser.add_argument('--loopygen', help=argparse.SUPPRESS, action='store_true')
 
     return parser.parse_args()
@@ -51,6 +57,8 @@ def make_directories(args):
     # END LooPyGen specifics
     paths.metadata = os.path.join(paths.output, 'metadata')
     paths.metadata_cids = os.path.join(paths.output, 'metadata-cids.json')
+    paths.cid_cache = os.path.join(os.path.dirname(__file__), '.cache', 'cids.sqlite')
+    paths.profile = os.path.join(os.path.dirname(__file__), 'prepare-profile')   # .json and .pstats
 
     # Make directories if they don't exist
     if not os.path.exists(paths.output):
@@ -61,35 +69,99 @@ def make_directories(args):
     return paths
 
 # CID pre-calc helper functions
-async def get_file_cid(path: str, version: int=0):
-    proc = await asyncio.create_subprocess_shell(
-        f'cid --cid-version={version} "{path}"',
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await proc.communicate()
-    if proc.returncode > 0:
-        raise RuntimeError(f'Could not get CIDv{version} of file {path}:\n\t{stderr.decode()}')
-    return stdout.decode().strip()
-
-async def get_files_cids(paths: 'list[str]', version: int=0): 
-    semaphore = asyncio.Semaphore(16)   # Limit to 16 files open at once
-    async def sem_task(task):
-        async with semaphore:
-            return await task
-
-    task_ids = list(range(len(paths)))
-    results = []
+def get_file_cid(path: str, version: int=0):
+    try:
+        return file_cid(path, version)
+    except OSError as err:
+        raise RuntimeError(f'Could not get CIDv{version} of file {path}:\n\t{err}')
+
+# CIDs of files, only the files changed since they were cached are hashed
+async def get_files_cids(paths: 'list[str]', cid_cache: CidCache, version: int=0): 
+    with profiler.phase('cid_cache_lookup', items=len(paths)):
+        keys = [CidCache.file_key(path) for path in paths]
+        results = [cid_cache.get(key, version) for key in keys]
+    misses = [i for i, cid in enumerate(results) if cid is None]
+    if len(misses) == 0:
+        return results
+
+    workers = max(1, min(os.cpu_count() or 1, len(misses)))  # One process per core
+    chunksize = max(1, len(misses) // (workers * 4))
+    missed_paths = [paths[i] for i in misses]
+
+    task_ids = misses
 
     with yaspin.kbi_safe_yaspin().line as spinner:
         if len(task_ids) > 10:
             spinner.text = f"Calculating CID for {' '.join( [f'#{id:03}' for id in task_ids[:10]] )} (+ {len(task_ids) - 10} others)"
         else:
             spinner.text = f"Calculating CID for {' '.join( [f'#{id:03}' for id in task_ids] )}"
-        results = await asyncio.gather( *[sem_task(get_file_cid(file, version)) for  file in paths] )
+        with profiler.phase('calculate_cids', items=len(missed_paths)), ProcessPoolExecutor(max_workers=workers) as executor:
+            loop = asyncio.get_running_loop()
+            cids = await loop.run_in_executor(None, lambda: list(executor.map(get_file_cid, missed_paths, [version] * len(missed_paths), chunksize=chunksize)))
+
+    for i, cid in zip(misses, cids):
+        results[i] = cid
+        cid_cache.put(keys[i], cid, version)
 
     return results
 
+# Names of the files of `directory` matching `pattern`, scanned as a stream (hidden files are skipped like glob does)
+def scan_files(directory: str, pattern: str):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.startswith('.') and entry.is_file() and fnmatch(entry.name, pattern):
+                yield entry.name
+
+# Create or update the metadata template of a file, written only if its content changes
+# Returns the status of the template ('created', 'updated' or 'unchanged'), whether it was backed up, and an error message if it was invalid
+def write_metadata(json_path: str, file: str, id: int, cid: str, overwrite: bool, defaults: dict):
+    token = {}
+    content = None
+    error = None
+    from_scratch = True    # Is true if 'overwrite' flag set or metadata json file is invalid
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as infile:
+            content = infile.read()
+        if not overwrite:
+            try:
+                # Read all the info from file
+                token = json.loads(content)
+                from_scratch = False
+            except json.JSONDecodeError as err:
+                error = f"Invalid metadata for {file} in {json_path} (ID #{id:03}): \n  {err}"
+
+    if from_scratch:    # metadata json doesn't exist or 'overwrite' flag set
+        # Create all new info
+        token = {
+            'image': os.path.join('ipfs://', cid),
+            'animation_url': os.path.join('ipfs://', cid),
+            'name':  defaults['name'] + f" #{id:03}",
+            'royalty_percentage': defaults['royalty_percentage'],
+            'attributes': [],
+            'properties': {}
+        }
+        if defaults['description']:
+            token['description'] = defaults['description']
+        if defaults['artist']:
+            token['artist'] = defaults['artist']
+
+    # Update CID fields
+    token['image'] = os.path.join('ipfs://', cid)
+    token['animation_url'] = os.path.join('ipfs://', cid)
+
+    output = json.dumps(token, indent=4)
+    if output == content:
+        return 'unchanged', False, error
+
+    backup = from_scratch and content is not None
+    if backup:
+        copy2(json_path, json_path + ".bak")
+
+    with open(json_path, 'w+') as f:
+        f.write(output)
+
+    return 'created' if content is None else 'updated', backup, error
+
 def main():
     load_dotenv()
 
@@ -102,74 +174,76 @@ def main():
     # Generate paths and make directories
     paths = make_directories(args)
 
-    # Get list of files to process
-    if cfg.input_file:
-        input_files = [cfg.input_file]
-    else:
-        input_files = [os.path.basename(path) for path in glob(os.path.join(cfg.input_dir, cfg.file_filter)) ]
-    
-    # Extract ID from file name for all files
-    ids = [int('0' + ''.join(filter(str.isdigit, f))) for f in input_files]
-    # IDs for files without them are generated by adding 1 to the maximum ID found
-    ids = [max(ids) + 1 + i if v == 0 else v for i, v in enumerate(ids)]
-
-    # Sort IDs and files by IDs
-    ids, input_files = list(zip(*sorted(zip(ids, input_files))))
+    if args.profile:
+        profiler.start(args.profile)
 
-    # Pre-calculate CIDs for input files
-    cids = asyncio.run(get_files_cids( [os.path.join(cfg.input_dir, file) for file in input_files] ))
+    try:
+        # Get list of files to process
+        if cfg.input_file:
+            input_files = [cfg.input_file]
+        else:
+            with profiler.phase('scan_files'):
+                input_files = list(scan_files(cfg.input_dir, cfg.file_filter))
     
-    # Output or update metadata template files
-    if args.metadata:
-        for id, cid, file in zip(ids, cids, input_files):
-            json_file = os.path.splitext(file)[0] + '.json'
-            json_path = os.path.join(paths.metadata, json_file)
-
-            token = {}
-            from_scratch = True    # Is true if 'overwrite' flag set or metadata json file is invalid
-            if not args.overwrite and os.path.exists(json_path):
-                try:
-                    # Read all the info from file
-                    with open(json_path, 'r') as infile:
-                        token = json.load(infile)
-                        from_scratch = False
-                    print(f"Updating CIDs for {file} in {json_path} (ID #{id:03})")
-                except json.JSONDecodeError as err:
-                    print(f"Invalid metadata for {file} in {json_path} (ID #{id:03}): ")
-                    print("  " + str(err))
-            if from_scratch:    # metadata json doesn't exist or 'overwrite' flag set
-                print(f'Generating new metadata for {file} to {json_path} (ID #{id:03})')
-                if os.path.exists(json_path):
-                    copy2(json_path, json_path + ".bak")
-                    print(f"  Saving backup as {json_path + '.bak'}: ")
-
-                # Create all new info
-                token = {
-                    'image': os.path.join('ipfs://', cid),
-                    'animation_url': os.path.join('ipfs://', cid),
-                    'name':  (os.getenv('COLLECTION_NAME') or 'COLLECTION_NAME') + f" #{id:03}",
-                    'royalty_percentage': os.getenv('ROYALTY_PERCENTAGE') or 0,
-                    'attributes': [],
-                    'properties': {}
-                }
-                if os.getenv('COLLECTION_DESCRIPTION'):
-                    token['description'] = os.getenv('COLLECTION_DESCRIPTION')
-                if os.getenv('ARTIST'):
-                    token['artist'] = os.getenv('ARTIST')
-        
-            # Update CID fields
-            token['image'] = os.path.join('ipfs://', cid)
-            token['animation_url'] = os.path.join('ipfs://', cid)
-
-            with open(json_path, 'w+') as f:
-                json.dump(token, f, indent=4)
-
-    # Output the metadata-cids.json file for minter
-    else:
-        print(f'Generating metadata-cids.json file in: {paths.output}')
-        with open(paths.metadata_cids, 'w+') as f:
-            all_cids = [{'ID': i, 'CID': c} for i,c in zip(ids, cids)]
-            json.dump(all_cids, f, indent=4)
+        # Extract ID from file name for all files
+        ids = [int('0' + ''.join(filter(str.isdigit, f))) for f in input_files]
+        # IDs for files without them are generated by adding 1 to the maximum ID found
+        ids = [max(ids) + 1 + i if v == 0 else v for i, v in enumerate(ids)]
+
+        # Sort IDs and files by IDs
+        ids, input_files = list(zip(*sorted(zip(ids, input_files))))
+
+        # Pre-calculate CIDs for input files
+        cid_cache = CidCache(paths.cid_cache)
+        if args.refresh_cache:
+            cid_cache.clear()
+        try:
+            cids = asyncio.run(get_files_cids( [os.path.join(cfg.input_dir, file) for file in input_files], cid_cache ))
+        finally:
+            cid_cache.close()
+        print(f"CIDs: {cid_cache.hits} cached, {cid_cache.misses} calculated")
+    
+        # Output or update metadata template files
+        if args.metadata:
+            defaults = {
+                'name': os.getenv('COLLECTION_NAME') or 'COLLECTION_NAME',
+                'royalty_percentage': os.getenv('ROYALTY_PERCENTAGE') or 0,
+                'description': os.getenv('COLLECTION_DESCRIPTION'),
+                'artist': os.getenv('ARTIST'),
+            }
+            json_paths = [os.path.join(paths.metadata, os.path.splitext(file)[0] + '.json') for file in input_files]
+
+            workers = max(1, min(os.cpu_count() or 1, len(input_files)))
+            chunksize = max(1, len(input_files) // (workers * 4))
+            with profiler.phase('write_metadata', items=len(input_files)), ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(write_metadata,
+                                            json_paths,
+                                            input_files,
+                                            ids,
+                                            cids,
+                                            [args.overwrite] * len(input_files),
+                                            [defaults] * len(input_files),
+                                            chunksize=chunksize))
+
+            counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+            backups = 0
+            for status, backup, error in results:
+                counts[status] += 1
+                backups += backup
+                if error:
+                    print(error)
+            print(f"Metadata in {paths.metadata}: {counts['created']} created, {counts['updated']} updated, {counts['unchanged']} unchanged")
+            if backups > 0:
+                print(f"  {backups} previous metadata files saved as .bak")
+
+        # Output the metadata-cids.json file for minter
+        else:
+            print(f'Generating metadata-cids.json file in: {paths.output}')
+            with profiler.phase('write_metadata_cids', items=len(cids)), open(paths.metadata_cids, 'w+') as f:
+                all_cids = [{'ID': i, 'CID': c} for i,c in zip(ids, cids)]
+                json.dump(all_cids, f, indent=4)
+    finally:
+        profiler.stop(paths.profile)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "hello_loopring")))
+
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import shutil
+import json
+import time
+
+from DataClasses import *
+from ApiMetrics import ApiMetrics
+from Journal import Journal
+from Manifest import read_manifest
+from LoopringMintService import LoopringMintService
+import minter
+import transfer
+
+# Scripts run by the shards, along with their journal
+SCRIPTS = {'mint': ("minter.py", "mint-info.jsonl"),
+           'transfer': ("transfer.py", "transfer-info.jsonl")}
+
+# Parse CLI arguments, those not known here are passed to minter.py or transfer.py
+def parse_args():
+    parser = argparse.ArgumentParser(description="Split a batch mint (--json) or a one-to-many transfer (--single with --tolist) across worker processes, "
+                                                 "arguments not listed here are passed to minter.py or transfer.py",
+                                     allow_abbrev=False)
+    parser.add_argument("command", help="Script run by the shards", choices=['mint', 'transfer'])
+    parser.add_argument("--shards", help="Number of worker processes (default: number of CPUs)", type=int)
+    parser.add_argument("--shards-dir", help="Directory of the shards, merged journal and report (default: shards/<command> next to the script)", type=str)
+    parser.add_argument("--noprompt", help="Skip all user prompts", action='store_true')
+    parser.add_argument("--resume", help="Resume every shard of the previous run", action='store_true')
+    args, script_args = parser.parse_known_args()
+    if script_args[:1] == ['--']:
+        script_args = script_args[1:]
+
+    # Arguments used to split the items, the other ones are passed as is
+    split_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    split_parser.add_argument("--workers", type=int)
+    if args.command == 'mint':
+        split_parser.add_argument("-j", "--json", type=str)
+        split_parser.add_argument("-s", "--start", type=int, default=1)
+        split_parser.add_argument("-e", "--end", type=int)
+        split_parser.add_argument("-c", "--cid", type=str)
+    else:
+        split_parser.add_argument("--single", dest="nftid", type=str)
+        split_parser.add_argument("--tolist", type=str)
+        split_parser.add_argument("--random", "--randomlist", "--list", "--to", dest="unsupported", type=str)
+    args.split, args.script_args = split_parser.parse_known_args(script_args)
+
+    # Arguments of the fee estimate of mints, also passed to the shards
+    if args.command == 'mint':
+        mint_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+        mint_parser.add_argument("--loopygen", action='store_true')
+        mint_parser.add_argument("--name", type=str)
+        args.mint, _ = mint_parser.parse_known_args(args.script_args)
+        args.mint.json = args.split.json
+
+    # Arguments of the balance check and fee estimate of transfers, also passed to the shards
+    if args.command == 'transfer':
+        transfer_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+        transfer_parser.add_argument("--amount", type=int, default=1)
+        transfer_parser.add_argument("--concurrency", type=int)
+        transfer_parser.add_argument("--loopygen", action='store_true')
+        args.transfer, _ = transfer_parser.parse_known_args(args.script_args)
+        if not args.transfer.concurrency:
+            args.transfer.concurrency = int(os.getenv("CONCURRENCY") or 16)
+
+    if not args.shards:
+        args.shards = os.cpu_count() or 1
+    assert args.shards > 0, f"Invalid argument --shards ({args.shards}), should be > 0"
+
+    # One signing process per shard, the shards are the processes using the cores
+    if args.split.workers is None:
+        args.split.workers = 1
+
+    if args.command == 'mint':
+        assert args.split.json and not args.split.cid, "Sharded mints need a manifest (--json)"
+        assert os.path.exists(args.split.json), f"Invalid path to the manifest provided for --json ({args.split.json})"
+    else:
+        # Other modes pick NFTs from one balance, which the shards cannot share
+        assert args.split.nftid and args.split.tolist and not args.split.unsupported, "Sharded transfers need --single and --tolist"
+        assert os.path.exists(args.split.tolist), f"Invalid path to list of To addresses provided for --tolist ({args.split.tolist})"
+
+    if not args.shards_dir:
+        args.shards_dir = os.path.join(os.path.dirname(__file__), "shards", args.command)
+
+    return args
+
+# Items (manifest entries or recipients) dealt round-robin into the input file of each shard, returns the number of items of each shard
+def split_items(args, shard_dirs: 'list[str]') -> 'list[int]':
+    counts = [0] * len(shard_dirs)
+    name = "manifest.jsonl" if args.command == 'mint' else "tolist.txt"
+    files = [open(os.path.join(shard_dir, name), 'w') for shard_dir in shard_dirs]
+    try:
+        for i, item in enumerate(iter_items(args)):
+            files[i % len(files)].write(item + '\n')
+            counts[i % len(files)] += 1
+    finally:
+        for f in files:
+            f.close()
+    return counts
+
+# Lines of the shard input files: manifest entries within start/end as JSON lines, or recipients
+def iter_items(args):
+    if args.command == 'mint':
+        for cid in read_manifest(args.split.json, start=args.split.start, end=args.split.end):
+            yield json.dumps(cid)
+    else:
+        with open(args.split.tolist, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+
+# Sender account, amount and token ID of the NFT to transfer in its balance, which all the shards transfer from
+async def get_transfer_balance(args) -> 'tuple[int, int, int]':
+    await LoopringMintService.open_shared_session(limit_per_host=args.transfer.concurrency)
+    try:
+        cfg, secret = await transfer.load_config(args.transfer, Struct({'transfer_config': "./transfer_config.json"}))
+        await transfer.get_user_api_key(cfg, secret)
+        nft_balance = await transfer.get_nft_balance(cfg, secret, args.transfer.concurrency)
+    finally:
+        await LoopringMintService.close_shared_session()
+    nfts = transfer.filter_nft_balance_by(nft_balance, 'nftId', args.split.nftid)
+    if len(nfts['data']) == 0:
+        sys.exit(f"NFT {args.split.nftid} not found in balance of account {cfg.fromAccount}")
+    return cfg.fromAccount, sum(nft.total for nft in nfts['data']), nfts['data'][0].tokenId
+
+# Estimated fees of `count` mints or transfers at the current offchain fee, fetched once for all the shards
+async def get_fee_estimate(args, count: int, nft_token_id: int=None) -> 'tuple[float, float, str]':
+    await LoopringMintService.open_shared_session()
+    try:
+        if args.command == 'mint':
+            paths = Struct({'config': "./config.json"})
+            if args.mint.loopygen and args.mint.name:
+                paths.traits = os.path.join("./images", args.mint.name, "traits.json")
+            cfg, secret = await minter.load_config(args.mint, paths)
+            await minter.get_user_api_key(cfg, secret)
+            offchain_parameters = await minter.get_offchain_parameters(cfg, secret)
+            return minter.estimate_batch_fees(cfg, offchain_parameters['off_chain_fee'], count)
+        else:
+            cfg, secret = await transfer.load_config(args.transfer, Struct({'transfer_config': "./transfer_config.json"}))
+            await transfer.get_user_api_key(cfg, secret)
+            offchain_parameters = await transfer.get_offchain_parameters(cfg, secret, nft_token_id)
+            return transfer.estimate_batch_fees(cfg, offchain_parameters['off_chain_fee'], count)
+    finally:
+        await LoopringMintService.close_shared_session()
+
+def shard_command(args, shard_dir: str, storage_leases: str) -> 'list[str]':
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[args.command][0])
+    command = [sys.executable, script, *args.script_args,
+               "--noprompt",
+               "--workers", str(args.split.workers),
+               "--output-dir", shard_dir,
+               "--storage-leases", storage_leases]
+    if args.command == 'mint':
+        command += ["--json", os.path.join(shard_dir, "manifest.jsonl")]
+    else:
+        command += ["--single", args.split.nftid, "--tolist", os.path.join(shard_dir, "tolist.txt")]
+    if args.resume:
+        command.append("--resume")
+    return command
+
+# Run a shard, its output is printed with the shard number and kept in `output.log` of the shard, returns its exit code
+async def run_shard(index: int, command: 'list[str]', shard_dir: str, processes: dict) -> int:
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    processes[index] = process
+    with open(os.path.join(shard_dir, "output.log"), 'a') as output:
+        async for line in process.stdout:
+            text = line.decode(errors='replace')
+            output.write(text)
+            print(f"[shard {index}] {text}", end='')
+    return await process.wait()
+
+# Results of a shard journal: the last result of each item, and the results recorded by the last run
+def read_shard_journal(command: str, path: str):
+    last_results = {}
+    run_results = []
+    for record in Journal.read(path):
+        event = record.get('event')
+        if event == 'start':
+            run_results = []
+        elif event == 'result':
+            last_results[record['id'] if command == 'mint' else record['recipient']] = record['result']
+            run_results.append(record['result'])
+    return last_results, run_results
+
+def count_results(results, names: dict) -> dict:
+    counts = {}
+    for result in results:
+        name = names.get(result, str(result))
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+# Merge the shard journals (each record with its `shard`) and API metrics, and write the report of the run
+def merge_shards(args, shard_dirs: 'list[str]', counts: 'list[int]', exit_codes: dict, elapsed: float) -> dict:
+    journal_name = SCRIPTS[args.command][1]
+    result_class = MintResult if args.command == 'mint' else TransferResult
+    names = {value: name for name, value in vars(result_class).items() if not name.startswith('_')}
+
+    report = {'command': args.command,
+              'shards': [],
+              'items': sum(counts),
+              'seconds': round(elapsed, 3)}
+    all_results = []
+    run_results = []
+    metrics = ApiMetrics()
+
+    with Journal(os.path.join(args.shards_dir, journal_name)) as merged:
+        for index, shard_dir in enumerate(shard_dirs):
+            if index not in exit_codes:
+                continue
+            journal = os.path.join(shard_dir, journal_name)
+            for record in Journal.read(journal):
+                merged.append(dict(record, shard=index))
+            shard_results, shard_run_results = read_shard_journal(args.command, journal)
+            all_results += shard_results.values()
+            run_results += shard_run_results
+            report['shards'].append({'shard': index,
+                                     'items': counts[index],
+                                     'exit_code': exit_codes[index],
+                                     'results': count_results(shard_results.values(), names)})
+
+            if os.path.exists(os.path.join(shard_dir, "api-metrics.json")):
+                with open(os.path.join(shard_dir, "api-metrics.json")) as f:
+                    metrics.merge(ApiMetrics.from_dict(json.load(f)))
+
+    report['results'] = count_results(all_results, names)
+    report['processed'] = len(run_results)  # Results recorded by this run, including failures
+    report['processed_per_sec'] = round(len(run_results) / elapsed, 2) if elapsed > 0 else None
+    metrics.dump(os.path.join(args.shards_dir, "api-metrics"))
+
+    with open(os.path.join(args.shards_dir, "report.json"), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+async def main():
+    load_dotenv()
+
+    # API endpoint, overridden to run against a local mock (see benchmarks/mock_api.py)
+    LoopringMintService.base_url = os.getenv("LOOPRING_API_URL") or LoopringMintService.base_url
+
+    # check for command line arguments
+    try:
+        args = parse_args()
+    except Exception as err:
+        sys.exit(f"Failed to initialize the shards: {err}")
+
+    # Generate paths
+    paths = Struct()
+    paths.state = os.path.join(args.shards_dir, "shards.json")
+    paths.storage_leases = os.path.join(os.path.dirname(__file__), ".cache", "storage-ids.sqlite")
+
+    nft_token_id = None     # NFT token of the transfers, from the balance check
+    if args.resume:
+        # Same shards and inputs as the previous run, each shard skips what its journal completed
+        if not os.path.exists(paths.state):
+            sys.exit(f"No shards to resume in {args.shards_dir}")
+        with open(paths.state) as f:
+            state = json.load(f)
+        assert state['command'] == args.command, f"Shards of {args.shards_dir} were run with '{state['command']}', not '{args.command}'"
+        counts = state['counts']
+        shard_dirs = [os.path.join(args.shards_dir, f"shard-{i}") for i in range(len(counts))]
+    else:
+        # Each shard only checks the balance against its own recipients: the NFTs of all of them are checked here, before splitting
+        if args.command == 'transfer':
+            recipients = sum(1 for _ in iter_items(args))
+            print("Retrieving sender's NFT balance... ", end='')
+            from_account, balance, nft_token_id = await get_transfer_balance(args)
+            print("done!")
+            if balance < recipients * args.transfer.amount:
+                sys.exit(f"Not enough matching NFTs found in balance of account {from_account} ({balance} matching, but expected {recipients * args.transfer.amount} or more)")
+
+        for name in os.listdir(args.shards_dir) if os.path.exists(args.shards_dir) else []:
+            if name.startswith("shard-"):
+                shutil.rmtree(os.path.join(args.shards_dir, name))
+        shard_dirs = [os.path.join(args.shards_dir, f"shard-{i}") for i in range(args.shards)]
+        for shard_dir in shard_dirs:
+            os.makedirs(shard_dir)
+        counts = split_items(args, shard_dirs)
+        with open(paths.state, 'w') as f:
+            json.dump({'command': args.command, 'counts': counts}, f, indent=2)
+
+    item_name = "NFTs" if args.command == 'mint' else "recipients"
+    active = [index for index, count in enumerate(counts) if count > 0]
+    if len(active) == 0:
+        sys.exit(f"No {item_name} to split across shards")
+
+    # Shards run without their own prompts, fees are approved here for all of them
+    if not args.noprompt:
+        if args.command == 'transfer' and nft_token_id is None:
+            print("Retrieving sender's NFT balance... ", end='')
+            _, _, nft_token_id = await get_transfer_balance(args)
+            print("done!")
+        print("Getting offchain fee... ", end='')
+        fee_estimate, fee_limit, fee_symbol = await get_fee_estimate(args, sum(counts), nft_token_id)
+        print("done!")
+        if not minter.prompt_yes_no(f"Estimated L2 fees for up to {sum(counts)} {item_name} (items completed by a previous run are skipped): {fee_estimate}-{fee_limit}{fee_symbol}, "
+                             f"run {len(active)} shards at the current offchain fee without further prompts, continue?", default="no"):
+            sys.exit("Aborted by user")
+
+    print(f"Running {len(active)} shards over {sum(counts)} {item_name} in {args.shards_dir}")
+    processes = {}
+    started = time.monotonic()
+    try:
+        codes = await asyncio.gather(*[run_shard(index, shard_command(args, shard_dirs[index], paths.storage_leases), shard_dirs[index], processes)
+                                       for index in active])
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+    elapsed = time.monotonic() - started
+    exit_codes = dict(zip(active, codes))
+
+    report = merge_shards(args, shard_dirs, counts, exit_codes, elapsed)
+    print(f"{report['processed']} {item_name} processed in {report['seconds']}s ({report['processed_per_sec']}/sec) by {len(active)} shards, results: {report['results']}")
+    for shard in report['shards']:
+        if shard['exit_code'] != 0:
+            print(f"Shard {shard['shard']} FAILED with exit code {shard['exit_code']}, see {os.path.join(shard_dirs[shard['shard']], 'output.log')}")
+    print(f"Merged journal, API metrics and report written to {args.shards_dir}")
+
+    if any(code != 0 for code in codes):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
@@ -12,10 +12,13 @@ import base58
 import json
 
 from DataClasses import *
-from LoopringMintService import LoopringMintService, NFTTransferEddsaSignHelper
-from hello_loopring.sdk.sig_utils.ecdsa_utils import EIP712, generateTransferEIP712Hash
-from py_eth_sig_utils import utils as sig_utils
-from py_eth_sig_utils.signing import v_r_s_to_signature
+from AccountCache import AccountCache
+from Journal import Journal
+from FeeWatcher import FeeWatcher
+from Profiler import profiler
+from LoopringMintService import LoopringMintService, StorageIdAllocator
+from StorageIdLeases import StorageIdLeases
+from SigningPool import SigningPool, sign_transfers
 
 # Verbose output
 VERBOSE = False
@@ -26,26 +29,65 @@ def plog(object, **kwds):
     if VERBOSE:
         pprint(object, **kwds)
 
+def normalize_account(account: str) -> str:
+    return str(account).strip().lower()
+
+# Lookup of an account that failed without a definite answer of the API: the account may be valid
+class AccountLookupError(RuntimeError):
+    pass
+
+# Result of a lookup of `account`, raises AccountLookupError when it failed without a definite answer of the API
+def check_lookup(lms: LoopringMintService, account: str, result):
+    if result is None and not lms.retry_policy.answered(lms.last_status):
+        raise AccountLookupError(f"Failed to look up account {account}: no answer from the API (status {lms.last_status})")
+    return result
+
 async def get_account_info(account: str):
     async with LoopringMintService() as lms:
-        account = str(account).strip().lower()
+        account = normalize_account(account)
         if account[:2] == "0x":
             address = account
-            id = await lms.getAccountId(address)
+            id = check_lookup(lms, account, await lms.getAccountId(address))
         elif account[-4:] == ".eth":
-            address = await lms.resolveENS(account)
-            id = await lms.getAccountId(address)
+            address = check_lookup(lms, account, await lms.resolveENS(account))
+            id = check_lookup(lms, account, await lms.getAccountId(address)) if address else None
         else:
             id = int(account)
-            address = await lms.getAccountAddress(id)
+            address = check_lookup(lms, account, await lms.getAccountAddress(id))
     return id, address
 
-async def retry_async(coro, *args, timeout: float=3, retries: int=3, **kwds):
-    for attempts in range(retries):
-        try:
-            return await asyncio.wait_for(coro(*args, **kwds), timeout=timeout)
-        except asyncio.TimeoutError:
-            print("Retrying... " + str(attempts))
+# Resolve accounts with at most `concurrency` lookups at once, each distinct account is looked up only once
+# Returns a dict of normalized account to (account_id, address), both None for accounts the API does not know or that are malformed
+# Lookups that fail without an answer of the API are retried with the backoff of the retry policy, and raise once its retries
+# are exhausted, instead of marking valid accounts as invalid
+async def resolve_accounts(accounts: 'list[str]', concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    retry_policy = LoopringMintService.retry_policy
+
+    async def resolve(account: str):
+        attempt = 0
+        while True:
+            async with semaphore:
+                try:
+                    return await get_account_info(account)
+                except ValueError:  # Neither an address, an ENS nor an account ID
+                    return None, None
+                except AccountLookupError:
+                    if attempt >= retry_policy.retries:
+                        raise
+            await asyncio.sleep(retry_policy.delay(attempt))
+            attempt += 1
+
+    unique_accounts = list(dict.fromkeys(normalize_account(account) for account in accounts))
+    lookups = [asyncio.ensure_future(resolve(account)) for account in unique_accounts]
+    try:
+        resolved = await asyncio.gather(*lookups)
+    except BaseException:
+        for lookup in lookups:
+            lookup.cancel()
+        await asyncio.gather(*lookups, return_exceptions=True)
+        raise
+    return dict(zip(unique_accounts, resolved))
 
 async def eternity(s: float):
     await asyncio.sleep(s)
@@ -75,7 +117,7 @@ async def load_config(args, paths: Struct):
     cfg.exchange              = "0x0BABA1Ad5bE3a5C0a66E7ac838a129Bf948f1eA4"
     
     # Resolve ENS, get account_id and ETH address
-    cfg.fromAccount, cfg.fromAddress = await retry_async(get_account_info, cfg.fromAddress, retries=3)
+    cfg.fromAccount, cfg.fromAddress = await get_account_info(cfg.fromAddress)
     assert cfg.fromAddress and cfg.fromAccount, f"Invalid from address: {cfg.fromAddress} (account ID {cfg.fromAccount})"
 
     assert secret.loopringPrivateKey, "Missing Loopring private key (LOOPRING_PRIVATE_KEY)"
@@ -110,6 +152,13 @@ def parse_args():
     parser.add_argument("--amount", help="Amount of NFTs to send to each address (only valid with --single)", type=int, default=1)
     parser.add_argument("--test", help="Skips the transfer step", action='store_true')
     parser.add_argument("--noprompt", help="Skip all user prompts", action='store_true')
+    parser.add_argument("--resume", help="Resume the previous transfers, skipping the recipients already served", action='store_true')
+    parser.add_argument("--refresh-accounts", help="Clear the cached ENS and account ID resolutions", action='store_true')
+    parser.add_argument("--workers", help="Number of signing processes (0 to sign in the main process)", type=int)
+    parser.add_argument("--profile", help="Print the time spent in each phase at exit, with a function profile (cprofile) or the memory allocations (tracemalloc)", nargs='?', const='time', choices=['time', 'cprofile', 'tracemalloc'])
+    parser.add_argument("--output-dir", help="Directory of the journal, API metrics and profile (default: next to the script)", type=str)
+    parser.add_argument("--storage-leases", metavar="PATH", help="SQLite file to lease storage ID ranges from, shared by the processes running on the same account (see sharded.py)", type=str)
+    parser.add_argument("--concurrency", help="Number of concurrent API requests (e.g. to resolve --tolist addresses)", type=int)
     parser.add_argument("-V", "--verbose", help="Verbose output", action='store_true')
     parser.add_argument('--loopygen', help=argparse.SUPPRESS, action='store_true')
 
@@ -148,6 +197,16 @@ def parse_args():
     if args.tolist:
         assert os.path.exists(args.tolist), f"Invalid path to list of To addresses provided for --tolist ({args.tolist})"
 
+    # Concurrent API requests
+    if not args.concurrency:
+        args.concurrency = int(os.getenv("CONCURRENCY") or 16)
+    assert args.concurrency > 0, f"Invalid argument --concurrency ({args.concurrency}), should be > 0"
+
+    # Signing processes
+    if args.workers is None:
+        args.workers = int(os.getenv("SIGNING_WORKERS") or os.cpu_count() or 1)
+    assert args.workers >= 0, f"Invalid argument --workers ({args.workers}), should be >= 0"
+
     # Test mode
     if args.test:
         print('Test mode enabled: Transfers will be skipped and no fees will incur.')
@@ -236,100 +295,99 @@ async def get_offchain_parameters(cfg, secret, nftTokenId):
 
     return parameters
 
-async def get_nft_balance(cfg, secret) -> NftBalance:
+# Current offchain fee of a transfer in the fee token, None if it could not be obtained
+async def get_offchain_fee(cfg, secret, token_address: str):
     async with LoopringMintService() as lms:
-        info = {}
-        # Getting the NFT balance
-        nft_balance = await lms.getUserNftBalance(apiKey=secret.loopringApiKey, accountId=cfg.fromAccount)
-        log(f"NFT balance: {json.dumps(nft_balance, indent=2)}")
-        if nft_balance is None:
-            sys.exit("Failed to obtain nft balance")
+        off_chain_fee = await lms.getOffChainFee(apiKey=secret.loopringApiKey, accountId=cfg.fromAccount, requestType=11, tokenAddress=token_address)
+    if off_chain_fee is None:
+        return None
+    return int(off_chain_fee['fees'][cfg.maxFeeTokenId]['fee'])
+
+# NFT balance of the sender, each page is added to the index as it arrives rather than kept as NftInfo dicts
+async def get_nft_balance(cfg, secret, concurrency: int) -> IndexedNftBalance:
+    async with LoopringMintService() as lms:
+        nft_balance = IndexedNftBalance()
+        async for nft_balance_page in lms.iterUserNftBalancePages(apiKey=secret.loopringApiKey,
+                                                                  accountId=cfg.fromAccount,
+                                                                  limit=int(os.getenv("NFT_BALANCE_PAGE_SIZE") or 50),
+                                                                  concurrency=concurrency):
+            if VERBOSE:     # Not formatted otherwise, pages can be large
+                log(f"NFT balance page: {json.dumps(nft_balance_page, indent=2)}")
+            nft_balance.extend(nft_balance_page['data'])
     
     return nft_balance
 
-def filter_nft_balance_by(balance: NftBalance, key: str, values: any) -> NftBalance:
-    # Check inputs
-    if len(balance['data']) == 0:
-        return NftBalance(totalNum=0, data=[])
-    assert key in balance['data'][0].keys(), f"Error filtering NFT balance: Invalid key {key}"
-
+def filter_nft_balance_by(balance: IndexedNftBalance, key: str, values: any) -> NftBalance:
     # Convert single elements to list
     if type(values) != type(list()):
         values = [values]
 
-    # Define filter and sorting lambdas
-    if key in ['tokenAddress', 'nftId', 'nftData']: # For hex strings, compare the underlying integer
-        values = [int(v, 16) for v in values]
-        filter_func = lambda t: int(t[key], 16) in values           # Filter out the values of `key` that are not in `values`
-        sorting_func = lambda t: values.index(int(t[key], 16))      # Sort by the order in `values`
-    else:   # For other types (str, int), compare directly
-        filter_func = lambda t: t[key] in values
-        sorting_func = lambda t: values.index(t[key])
-
-
-    filtered_data = list(filter(filter_func, balance['data']))
-    sorted_data = sorted(filtered_data, key=sorting_func)
-    return NftBalance(totalNum=len(sorted_data), data=sorted_data)
+    return balance.filter_by(key, values)
 
 # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L1020
-async def get_hashes_and_sign(cfg, secret, tokenId: int, amount: int, toAddress: str, toAccount: int, offchain_parameters: dict, info: dict):
-    # Generate the poseidon hash for the remaining data
-    # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L899
-    inputs = [
-        int(cfg.exchange, 16),
-        cfg.fromAccount,  # fromAccountId
-        toAccount,        # toAccountId
-        tokenId,
-        amount,
-        cfg.maxFeeTokenId,
-        int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']) ), # Apply max fee slippage
-        # int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']),
-        int(toAddress, 16),
-        0,
-        0,
-        cfg.validUntil,
-        offchain_parameters['storage_id']['offchainId']
-    ]
-    hasher = NFTTransferEddsaSignHelper(private_key=secret.loopringPrivateKey)
-    nft_poseidon_hash = hasher.hash(inputs)
-    plog(inputs)
-    log("Hashed NFT transfer payload: 0x{0:0{1}x}".format(nft_poseidon_hash, 64))
-    info['nft_poseidon_hash'] = "0x{0:0{1}x}".format(nft_poseidon_hash, 64)
-
-    eddsa_signature = hasher.sign(inputs)
-    log(f"Signed NFT payload hash: {eddsa_signature}")
-    info['eddsa_signature'] = eddsa_signature
-
-    # Generate the ECDSA signature
-    EIP712.init_env(name="Loopring Protocol",
-                    version="3.6.0",
-                    chainId=1,
-                    verifyingContract="0x0BABA1Ad5bE3a5C0a66E7ac838a129Bf948f1eA4")
-
-    message = generateTransferEIP712Hash(req={
-        'payerAddr': cfg.fromAddress,
-        'payeeAddr': toAddress,
-        'token': {
-            'volume': str(amount),
-            'tokenId': tokenId
-        },
-        'maxFee': {
-            'tokenId': cfg.maxFeeTokenId,
-            'volume': int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']) ) # Apply max fee slippage
-        },
-        'validUntil': cfg.validUntil,
-        'storageId': offchain_parameters['storage_id']['offchainId']
-    })
-
-    # print(f"{message=}")
-    eth_pkey = int(secret.metamaskPrivateKey, 16).to_bytes(32, byteorder='big')
-    v, r, s = sig_utils.ecsign(message, eth_pkey)
-    ecdsa_signature = "0x" + bytes.hex(v_r_s_to_signature(v, r, s)) + "02"
-    # print(f"{ecdsa_signature=}")
-
-    return eddsa_signature, ecdsa_signature
-
-async def transfer_nft(cfg, secret,  amount: int, toAccount: int, toAddress: str, nftInfo: NftInfo, eddsa_signature: str, ecdsa_signature: str, offchain_parameters: dict, test_mode: bool, info: dict):
+# Hash and sign the transfers of `jobs` at once across the signing processes, each of the NFT at the same place in `nft_infos`
+# Sets the poseidon hash and EdDSA signature of each job, returns their ECDSA signatures
+async def get_hashes_and_sign(cfg, signing_pool: SigningPool, jobs: 'list[TransferJob]', nft_infos: 'list[NftEntry]', amount: int, offchain_parameters: dict) -> 'list[str]':
+    # Same for every transfer of the run
+    exchange = int(cfg.exchange, 16)
+    maxFeeTokenId = cfg.maxFeeTokenId
+    maxFeeAmount = int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][maxFeeTokenId]['fee']) )   # Apply max fee slippage
+    validUntil = cfg.validUntil
+
+    items = []
+    for job, nft_info in zip(jobs, nft_infos):
+        toAddress = job.to_address
+        tokenId = nft_info.tokenId
+
+        # Inputs of the poseidon hash for the remaining data
+        # https://github.com/Loopring/loopring_sdk/blob/692d372165b5ea0d760e33e177d9003cc0dfb0f7/src/api/sign/sign_tools.ts#L899
+        inputs = [
+            exchange,
+            cfg.fromAccount,  # fromAccountId
+            job.to_account,   # toAccountId
+            tokenId,
+            amount,
+            maxFeeTokenId,
+            maxFeeAmount,
+            int(toAddress, 16),
+            0,
+            0,
+            validUntil,
+            job.storage_id
+        ]
+        plog(inputs)
+
+        # Request of the ECDSA signature
+        eip712_request = {
+            'payerAddr': cfg.fromAddress,
+            'payeeAddr': toAddress,
+            'token': {
+                'volume': str(amount),
+                'tokenId': tokenId
+            },
+            'maxFee': {
+                'tokenId': maxFeeTokenId,
+                'volume': maxFeeAmount
+            },
+            'validUntil': validUntil,
+            'storageId': job.storage_id
+        }
+        items.append((inputs, eip712_request))
+
+    # Hash and sign off the event loop
+    signatures = await signing_pool.map(sign_transfers, items)
+
+    ecdsa_signatures = []
+    for job, (nft_poseidon_hash, eddsa_signature, ecdsa_signature) in zip(jobs, signatures):
+        log("Hashed NFT transfer payload: 0x{0:0{1}x}".format(nft_poseidon_hash, 64))
+        job.nft_poseidon_hash = "0x{0:0{1}x}".format(nft_poseidon_hash, 64)
+        log(f"Signed NFT payload hash: {eddsa_signature}")
+        job.eddsa_signature = eddsa_signature
+        ecdsa_signatures.append(ecdsa_signature)
+
+    return ecdsa_signatures
+
+async def transfer_nft(cfg, secret,  amount: int, nftInfo: NftEntry, eddsa_signature: str, ecdsa_signature: str, offchain_parameters: dict, test_mode: bool, job: TransferJob):
     async with LoopringMintService() as lms:
         if test_mode:
             return TransferResult.TESTMODE, None
@@ -339,34 +397,219 @@ async def transfer_nft(cfg, secret,  amount: int, toAccount: int, toAddress: str
             exchange=cfg.exchange,
             fromAccountId=cfg.fromAccount,
             fromAddress=cfg.fromAddress,
-            toAccountId=toAccount,
-            toAddress=toAddress,
+            toAccountId=job.to_account,
+            toAddress=job.to_address,
             amount=amount,
             validUntil=cfg.validUntil,
-            storageId=offchain_parameters['storage_id']['offchainId'],
+            storageId=job.storage_id,
             maxFeeTokenId=cfg.maxFeeTokenId,
             maxFeeAmount=int( (1 + cfg.feeSlippage) * int(offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]['fee']) ),
             memo=cfg.memo,
-            nftInfo=nftInfo,
+            nftInfo=nftInfo.to_dict(),
             counterFactualNftInfo=offchain_parameters['counterfactual_nft_info'],
             eddsaSignature=eddsa_signature,
             ecdsaSignature=ecdsa_signature
         )
         log(f"Nft Transfer reponse: {nft_transfer_response}")
-        info['nft_transfer_response'] = nft_transfer_response
+        job.nft_transfer_response = nft_transfer_response
 
     if nft_transfer_response is None:   # Something failed
-        mint_code = lms.last_error['resultInfo']['code']
+        mint_code = (lms.last_error or {}).get('resultInfo', {}).get('code')
         if mint_code == 114002: # Invalid fee amount
             return TransferResult.FEE_INVALID, nft_transfer_response
+        if lms.retry_policy.maybe_processed(lms.last_status):
+            return TransferResult.UNKNOWN, nft_transfer_response
     elif lms.last_status == 200:    # Transfer succeeded
         return TransferResult.SUCCESS, nft_transfer_response
 
+    # Rejected by the API (4xx): not processed
     return TransferResult.FAILED, nft_transfer_response
 
+# Rebuild the state of the previous transfers from their journal: the NFTs, initial weights, recipients, mode and amount of the run,
+# the recipients served (position -> picked index) and the transfers submitted without a known result (position -> record)
+def read_transfer_journal(path: str) -> Struct:
+    state = Struct({'nfts': None, 'weights': None, 'recipients': None, 'invalid_tos': [], 'mode': None, 'amount': None, 'served': {}, 'pending': {}})
+    offchain_parameters = None  # Parameters the following transfers were signed with
+
+    for record in Journal.read(path):
+        event = record.get('event')
+        if event == 'recipients':
+            state.nfts = dict(record['nfts'], data=[NftEntry.from_dict(nft) for nft in record['nfts']['data']])
+            state.weights = record['weights']
+            state.recipients = record['recipients']
+            state.invalid_tos = record['invalid_tos']
+            state.mode = record.get('mode')
+            state.amount = record.get('amount')
+        elif event == 'offchain_parameters':
+            offchain_parameters = record['offchain_parameters']
+        elif event == 'submitted':
+            state.pending[record['recipient']] = dict(record, offchain_parameters=offchain_parameters)
+        elif event == 'result':
+            state.pending.pop(record['recipient'], None)
+            if record['result'] == TransferResult.SUCCESS:
+                state.served[record['recipient']] = record['index']
+
+    return state
+
+# Sequential transfers to the recipients at `positions`, each picking an NFT of `nfts` by `mode` and `weights` (updated as NFTs are picked)
+# Transfers in `pending` (position -> journal record) are submitted again as signed, the others get a storage ID from `storage_ids`
+# and are signed ahead of their submission, `chunk_size` at once per signing process
+# Submission waits while `fee_watcher` is paused, transfers rejected for their fee are submitted again as signed once it resumes
+# Transfers without a known outcome stay pending: no result is journaled and their storage id is kept, so that `--resume`
+# sends them again unchanged (the storage id ensures that each is processed at most once) instead of a new transfer
+# A pending transfer the API rejects when sent again is settled as failed
+async def transfer_batch(cfg, secret, signing_pool: SigningPool, storage_ids: StorageIdAllocator, recipients: list, positions: 'list[int]', nfts: dict, weights: 'list[int]', pending: dict, mode: int, amount: int, offchain_parameters: dict, test_mode: bool, journal: Journal, fee_watcher: FeeWatcher, chunk_size: int = 16):
+    chunk_size = chunk_size * max(1, signing_pool.workers)
+    signed_transfers = asyncio.Queue(maxsize=chunk_size)    # (job, offchain parameters, ECDSA signature) signed ahead, waiting to be submitted
+    unknown = 0
+
+    # Pick the NFT of each transfer of `chunk` (before any await: NFTs are picked in the order of the recipients),
+    # then assign their storage ids and sign them all at once
+    async def sign_chunk(chunk: 'list[int]') -> list:
+        jobs = []
+        for position in chunk:
+            job = TransferJob(position, *recipients[position])
+            jobs.append(job)
+
+            if position in pending:
+                # Submitted by the previous run without a known result: send the exact same transfer again,
+                # its storage id ensures that it is processed at most once
+                transfer = pending[position]
+                job.index = transfer['index']
+                job.nftId = nfts['data'][job.index].nftId
+                job.storage_id = transfer['storage_id']
+                job.eddsa_signature = transfer['eddsa_signature']
+                continue
+
+            log("Picking from weights:", weights)
+
+            if mode == TransferMode.SINGLE:
+                index = 0
+            elif mode == TransferMode.RANDOM:
+                # Pick random NFT ID by index
+                index = random.choices(range(nfts['totalNum']), weights)[0]
+                weights[index] -= 1  # Amount of that NFT is one less for subsequent random choice
+            elif mode == TransferMode.ORDERED: # Using `weights` list as the quantity remaining of each NFT
+                # Pick NFT ID sequentially (next NFT ID with weight > 0)
+                index = next(i for i,w in enumerate(weights) if w > 0)
+                weights[index] -= 1  # Amount of that NFT is one less for subsequent transfer
+
+            log("Picked:", index)
+            plog(nfts['data'][index])
+
+            job.index = index
+            job.nftId = nfts['data'][index].nftId
+
+        new_jobs = [job for job in jobs if job.recipient not in pending]
+        nft_infos = [nfts['data'][job.index] for job in new_jobs]
+
+        # Assign the next storage id of each NFT token
+        for job, nft_info in zip(new_jobs, nft_infos):
+            job.storage_id = await storage_ids.next(nft_info.tokenId)
+
+        # Generate the Eddsa and Ecdsa Signatures
+        ecdsa_signatures = iter(await get_hashes_and_sign(cfg, signing_pool, new_jobs, nft_infos, amount, offchain_parameters))
+
+        return [(job, pending[job.recipient]['offchain_parameters'], pending[job.recipient]['ecdsa_signature']) if job.recipient in pending
+                else (job, offchain_parameters, next(ecdsa_signatures))
+                for job in jobs]
+
+    async def sign_transfers_ahead():
+        pending_chunk = None    # Signed while the previous chunk is being submitted
+        try:
+            for i in range(0, len(positions), chunk_size):
+                signed_chunk, pending_chunk = pending_chunk, asyncio.ensure_future(sign_chunk(positions[i:i + chunk_size]))
+                if signed_chunk is not None:
+                    for transfer in await signed_chunk:
+                        await signed_transfers.put(transfer)
+
+            if pending_chunk is not None:
+                for transfer in await pending_chunk:
+                    await signed_transfers.put(transfer)
+        finally:
+            if pending_chunk is not None:   # Not left signing when signing or submission failed
+                pending_chunk.cancel()
+                await asyncio.gather(pending_chunk, return_exceptions=True)
+
+        await signed_transfers.put(None)    # Stop the submitter
+
+    async def submit_transfers():
+        nonlocal unknown
+        i = 0
+        while (transfer := await signed_transfers.get()) is not None:
+            job, transfer_parameters, ecdsa_signature = transfer
+            position = job.recipient
+            nft_info = nfts['data'][job.index]
+
+            # On disk before the transfer is sent, to never send another transfer to this recipient
+            if position not in pending:
+                with profiler.phase('journal_sync'):
+                    journal.append(dict(job.to_dict(), event='submitted', ecdsa_signature=ecdsa_signature), sync=True)
+
+            # Submit the nft transfer, again with the same storage id and signatures while it is rejected for its fee
+            while True:
+                await fee_watcher.wait()
+                with profiler.phase('transfer_nft'):
+                    transfer_result, response = await transfer_nft(cfg,
+                                                                   secret,
+                                                                   amount=amount,
+                                                                   nftInfo=nft_info,
+                                                                   eddsa_signature=job.eddsa_signature,
+                                                                   ecdsa_signature=ecdsa_signature,
+                                                                   offchain_parameters=transfer_parameters,
+                                                                   test_mode=test_mode,
+                                                                   job=job)
+                if transfer_result != TransferResult.FEE_INVALID:
+                    break
+                print(f"{i+1}/{len(positions)} {position+1}: Transfer rejected due to invalid fee, retrying when fees are lower (to: {job.to_address}, nftId: {nft_info.nftId})")
+                fee_watcher.exceeded()
+            fee_watcher.accepted()
+            i += 1
+
+            if transfer_result == TransferResult.UNKNOWN:
+                print(f"{i}/{len(positions)} {position+1}: Transfer outcome UNKNOWN, left pending to be sent again unchanged with --resume (to: {job.to_address}, nftId: {nft_info.nftId}, storage id: {job.storage_id})")
+                unknown += 1
+                journal.append(dict(job.to_dict(), event='unknown', result=transfer_result), sync=True)
+                continue
+
+            journal.append(dict(job.to_dict(), event='result', result=transfer_result, hash=response['hash'] if response else None))
+
+            if transfer_result == TransferResult.SUCCESS:
+                print(f"{i}/{len(positions)} {position+1}: Successful Transfer! (tx hash: {response['hash']}, to: {job.to_address}, nftId: {nft_info.nftId})")
+            elif transfer_result == TransferResult.FAILED and position in pending:
+                # Sent again and rejected by the API: settled as failed, its storage id may have been used by the transfer of the previous run
+                print(f"{i}/{len(positions)} {position+1}: Transfer sent again FAILED, check whether the transfer of the previous run went through before resuming (to: {job.to_address}, nftId: {nft_info.nftId}, storage id: {job.storage_id})")
+                await storage_ids.reconcile(nft_info.tokenId)
+            elif transfer_result == TransferResult.FAILED:
+                print(f"{i}/{len(positions)} {position+1}: Transfer FAILED... (to: {job.to_address}, nftId: {nft_info.nftId})")
+                # Storage id may have been rejected, re-sync that token with the API
+                storage_ids.release(nft_info.tokenId, job.storage_id)
+                await storage_ids.reconcile(nft_info.tokenId)
+            elif transfer_result == TransferResult.TESTMODE:
+                print(f"{i}/{len(positions)} {position+1}: Skipping transfer (test mode) (to: {job.to_address}, nftId: {nft_info.nftId})")
+                if position not in pending:
+                    storage_ids.release(nft_info.tokenId, job.storage_id)
+
+    # Signing stops when a submission fails and submission when signing fails
+    tasks = [asyncio.ensure_future(sign_transfers_ahead()), asyncio.ensure_future(submit_transfers())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()   # Raises the failure, if any
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if unknown > 0:
+        print(f"{unknown} transfers have no known outcome, run again with --resume to send them again unchanged")
+
 async def main():
     load_dotenv()
 
+    # API endpoint, overridden to run against a local mock (see benchmarks/mock_api.py)
+    LoopringMintService.base_url = os.getenv("LOOPRING_API_URL") or LoopringMintService.base_url
+
     # check for command line arguments
     try:
         args = parse_args()
@@ -375,182 +618,217 @@ async def main():
     
     # Generate paths
     paths = Struct()
-    paths.transfer_info = os.path.join(os.path.dirname(__file__), "transfer-info.json")
+    output_dir = args.output_dir or os.path.dirname(__file__)
+    paths.transfer_info = os.path.join(output_dir, "transfer-info.jsonl")
+    paths.account_cache = os.path.join(os.path.dirname(__file__), ".cache", "accounts.sqlite")
+    paths.metrics = os.path.join(output_dir, "api-metrics")  # .prom and .json
+    paths.profile = os.path.join(output_dir, "transfer-profile")  # .json and .pstats
     paths.transfer_config = "./transfer_config.json"
 
     if not os.path.exists(os.path.dirname(paths.transfer_info)):
         os.makedirs(os.path.dirname(paths.transfer_info))
 
-    transfer_info = []
-    transfer_info.append({'args': vars(args)})
+    # State of the previous transfers
+    if args.resume:
+        previous = read_transfer_journal(paths.transfer_info)
+        if previous.recipients is None:
+            sys.exit(f"No transfers to resume in {paths.transfer_info}")
+        # The NFTs and recipients come from the journal, the transfers must pick and send them the same way
+        if previous.mode is not None and (previous.mode != args.mode or previous.amount != args.amount):
+            sys.exit(f"Cannot resume with another transfer mode or amount than the previous run (mode {previous.mode}, amount {previous.amount})")
+
+    journal = Journal(paths.transfer_info, append=args.resume)
+    journal.append({'event': 'start', 'args': vars(args)})
 
     approved_fees_prompt = args.noprompt
+    fee_watcher = None
+    storage_leases = None
+
+    if args.profile:
+        profiler.start(args.profile)
+
+    # API metrics are written on exit, and on demand with `kill -USR1 <pid>`
+    LoopringMintService.metrics.dump_on_signal(asyncio.get_running_loop(), paths.metrics)
 
     try:
-        cfg, secret = await load_config(args, paths)
+        # One pooled session for every request of the run
+        await LoopringMintService.open_shared_session(keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE") or 30),
+                                                      limit_per_host=args.concurrency,
+                                                      dns_cache_ttl=int(os.getenv("DNS_CACHE_TTL") or 300),
+                                                      warmup=1)
+
+        # Persistent cache of ENS and account ID resolutions
+        LoopringMintService.account_cache = AccountCache(paths.account_cache, ens_ttl=float(os.getenv("ENS_CACHE_TTL") or 86400))
+        if args.refresh_accounts:
+            LoopringMintService.account_cache.clear()
+
+        with profiler.phase('load_config'):
+            cfg, secret = await load_config(args, paths)
         log("config dump:")
         plog(cfg)
-        transfer_info.append({'cfg': cfg})
+        journal.append({'event': 'config', 'cfg': cfg})
 
         # Get user API key
         print("Getting user API key... ", end='')
-        await get_user_api_key(cfg, secret)
+        with profiler.phase('get_user_api_key'):
+            await get_user_api_key(cfg, secret)
         print("done!")
 
-        # Prepare to addresses
-        if args.tolist:
-            with open(args.tolist, 'r') as f:
-                tos = [line.strip() for line in f]
-        elif args.to:
-            tos = [args.to]
-
-        # Prepare NFT IDs from source and filter based on sender balance
-        print("Retrieving sender's NFT balance... ", end='')
-        nft_balance = await get_nft_balance(cfg, secret)
-        print("done!")
-        if args.mode == TransferMode.SINGLE:
-            # Verify that single NFT ID is in the sender balance
-            nfts = filter_nft_balance_by(nft_balance, 'nftId', args.nftid)
-        else:   # RANDOM or ORDERED
-            if args.random_contract:
-                # Filter those not from that contract address/collection
-                nfts = filter_nft_balance_by(nft_balance, 'tokenAddress', args.random_contract)
-            elif args.random_list or args.ordered_list:
-                # Get list of CIDs or NFT IDs from file, verify they are in the sender balance    
-                with open(args.random_list or args.ordered_list, 'r') as f:
-                    cids = [line.strip() for line in f.readlines()]
-                    cids = list(set(cids))  # Remove duplicate lines
-                nft_ids = ["0x" + base58.b58decode(cid).hex()[4:] if cid[:2] == "Qm" else cid for cid in cids]  # CID to NFT ID hex-string: base58 to hex and drop first 2 bytes (always 1220h)
-                nfts = filter_nft_balance_by(nft_balance, 'nftId', nft_ids)
-
-        log(nfts['totalNum'])
-        plog(nfts)
-        transfer_info.append({'nfts': nfts})
-
-        # Weights based off the amount of each NFT
-        weights = [int(t['total']) for t in nfts['data']]
-        total_amount = sum(weights)
-        log(weights, total_amount)
-        transfer_info.append({'weights': weights})
-        transfer_info.append({'total_amount': total_amount})
-
-        # Make sure they have at least as many NFTs as to addresses
-        if total_amount < (len(tos) * args.amount):
-            sys.exit(f"Not enough matching NFTs found in balance of account {cfg.fromAccount} ({total_amount} matching, but expected {(len(tos) * args.amount)} or more)")
-
-        # Filter tos
-        skipped_tos = []
-        filtered_tos = []
-        for to in tos:
-            info = {'to': to, 'invalid': True}
-
-            valid_to = True
-
-            try: 
-                to_account, to_address = await retry_async(get_account_info, to, retries=3)
-                if not to_account or not to_address:
-                    valid_to = False
-            except:
-                valid_to = False
-            
-            if not valid_to:
-                transfer_info.append(info)
-                print(f"Skipping invalid to address: {to}")
-                skipped_tos.append(to)
-                continue
-
-            filtered_tos.append((to_account, to_address))
-            info['invalid'] = False
-            info['to_account'] = to_account
-            info['to_address'] = to_address
-
-            transfer_info.append(info)
-
-        if len(filtered_tos) == 0:
-            sys.exit(f"No valid to address found, no one to transfer to...")
+        if args.resume:
+            # Reuse the NFTs and recipients of the previous run, without scanning the balance or resolving addresses again
+            nfts = previous.nfts
+            recipients = previous.recipients
+            skipped_tos = previous.invalid_tos
+            served = previous.served
+            pending = previous.pending
+
+            # Weights minus the NFTs already sent (or maybe sent)
+            weights = list(previous.weights)
+            if args.mode != TransferMode.SINGLE:
+                for index in [*served.values(), *[transfer['index'] for transfer in pending.values()]]:
+                    weights[index] -= 1
+            log(weights)
+
+            print(f"Resuming: {len(served)}/{len(recipients)} recipients already served, {len(pending)} transfers to confirm")
+        else:
+            # Prepare to addresses
+            if args.tolist:
+                with open(args.tolist, 'r') as f:
+                    tos = [line.strip() for line in f]
+            elif args.to:
+                tos = [args.to]
+
+            # Prepare NFT IDs from source and filter based on sender balance
+            print("Retrieving sender's NFT balance... ", end='')
+            with profiler.phase('get_nft_balance'):
+                nft_balance = await get_nft_balance(cfg, secret, args.concurrency)
+            print("done!")
+            if args.mode == TransferMode.SINGLE:
+                # Verify that single NFT ID is in the sender balance
+                nfts = filter_nft_balance_by(nft_balance, 'nftId', args.nftid)
+            else:   # RANDOM or ORDERED
+                if args.random_contract:
+                    # Filter those not from that contract address/collection
+                    nfts = filter_nft_balance_by(nft_balance, 'tokenAddress', args.random_contract)
+                elif args.random_list or args.ordered_list:
+                    # Get list of CIDs or NFT IDs from file, verify they are in the sender balance    
+                    with open(args.random_list or args.ordered_list, 'r') as f:
+                        cids = [line.strip() for line in f.readlines()]
+                        cids = list(set(cids))  # Remove duplicate lines
+                    nft_ids = ["0x" + base58.b58decode(cid).hex()[4:] if cid[:2] == "Qm" else cid for cid in cids]  # CID to NFT ID hex-string: base58 to hex and drop first 2 bytes (always 1220h)
+                    nfts = filter_nft_balance_by(nft_balance, 'nftId', nft_ids)
+
+            log(nfts['totalNum'])
+            plog(nfts)
+
+            # Weights based off the amount of each NFT
+            weights = [t.total for t in nfts['data']]
+            total_amount = sum(weights)
+            log(weights, total_amount)
+
+            # Make sure they have at least as many NFTs as to addresses
+            if total_amount < (len(tos) * args.amount):
+                sys.exit(f"Not enough matching NFTs found in balance of account {cfg.fromAccount} ({total_amount} matching, but expected {(len(tos) * args.amount)} or more)")
+
+            # Filter tos
+            print(f"Resolving {len(tos)} to addresses... ", end='')
+            with profiler.phase('resolve_accounts', items=len(tos)):
+                resolved_tos = await resolve_accounts(tos, args.concurrency)
+            print("done!")
+
+            skipped_tos = []
+            recipients = []     # (to, to_account, to_address) of valid tos, a recipient is identified by its position
+            for to in tos:
+                to_account, to_address = resolved_tos[normalize_account(to)]
+                valid_to = bool(to_account and to_address)
+
+                if not valid_to:
+                    print(f"Skipping invalid to address: {to}")
+                    skipped_tos.append(to)
+                    continue
+
+                recipients.append((to, to_account, to_address))
+
+            if len(recipients) == 0:
+                sys.exit(f"No valid to address found, no one to transfer to...")
+
+            served = {}
+            pending = {}
+            journal.append({'event': 'recipients', 'nfts': nfts, 'weights': weights, 'total_amount': total_amount, 'recipients': recipients, 'invalid_tos': skipped_tos, 'mode': args.mode, 'amount': args.amount}, sync=True)
+
+        # Transfers left pending are confirmed first, before any new storage id is assigned
+        positions = list(pending) + [position for position in range(len(recipients)) if position not in served and position not in pending]
+        if len(positions) == 0:
+            print("All recipients were already served, nothing to transfer")
+            sys.exit(0)
 
         # Get storage id, token address and offchain fee
         print("Getting offchain parameters... ", end='')
-        offchain_parameters = await get_offchain_parameters(cfg, secret, nfts['data'][0]['tokenId'])
-        transfer_info.append({'offchain_parameters': offchain_parameters})
+        with profiler.phase('get_offchain_parameters'):
+            offchain_parameters = await get_offchain_parameters(cfg, secret, nfts['data'][0].tokenId)
+        journal.append({'event': 'offchain_parameters', 'offchain_parameters': offchain_parameters})
         print("done!")
 
         # Estimate fees and get user approval
         if not approved_fees_prompt:
-            cfg.feeEstimate, cfg.feeLimit, cfg.feeSymbol =estimate_batch_fees(cfg, offchain_parameters['off_chain_fee'], len(filtered_tos))
+            cfg.feeEstimate, cfg.feeLimit, cfg.feeSymbol =estimate_batch_fees(cfg, offchain_parameters['off_chain_fee'], len(positions))
             log("--------")
-            approved_fees_prompt = prompt_yes_no(f"Estimated L2 fees for transfering NFTs to {len(filtered_tos)} addresses: {cfg.feeEstimate}-{cfg.feeLimit}{cfg.feeSymbol}, continue?", default="no")
-            transfer_info.append({'fee_approval': approved_fees_prompt, 'feeEstimate': cfg.feeEstimate, 'feeLimit': cfg.feeLimit, 'feeSymbol': cfg.feeSymbol})
+            approved_fees_prompt = prompt_yes_no(f"Estimated L2 fees for transfering NFTs to {len(positions)} addresses: {cfg.feeEstimate}-{cfg.feeLimit}{cfg.feeSymbol}, continue?", default="no")
+            journal.append({'event': 'fee_approval', 'fee_approval': approved_fees_prompt, 'feeEstimate': cfg.feeEstimate, 'feeLimit': cfg.feeLimit, 'feeSymbol': cfg.feeSymbol})
             if not approved_fees_prompt: 
                 sys.exit("Aborted by user")
-        approved_off_chain_fee = offchain_parameters['off_chain_fee']
-        
-        # NFT transfer sequence
-        for i, (to_account, to_address) in enumerate(filtered_tos):
-            info = {'to_account': to_account, 'to_address': to_address}
-
-            log("Picking from weights:", weights)
-
-            if args.mode == TransferMode.SINGLE:
-                nft_info = nfts['data'][0]
-                index = 0
-            elif args.mode == TransferMode.RANDOM:
-                # Pick random NFT ID by index
-                index = random.choices(range(nfts['totalNum']), weights)[0]
-                weights[index] -= 1  # Amount of that NFT is one less for subsequent random choice
-                nft_info = nfts['data'][index]
-            elif args.mode == TransferMode.ORDERED: # Using `weights` list as the quantity remaining of each NFT
-                # Pick NFT ID sequentially (next NFT ID with weight > 0)
-                index = next(i for i,w in enumerate(weights) if w > 0)
-                weights[index] -= 1  # Amount of that NFT is one less for subsequent transfer
-                nft_info = nfts['data'][index]
 
-            log("Picked:", index)
-            plog(nft_info)
-
-            info['index'] = index
-            info['nftId'] = nft_info['nftId']
-
-            # Get storage id, token address, but conserve off_chain_fee (they have been accepted by user)
-            offchain_parameters = await get_offchain_parameters(cfg, secret, nft_info['tokenId'])
-            offchain_parameters['off_chain_fee'] = approved_off_chain_fee
-
-            # Generate Eddsa Signature
-            eddsa_signature, ecdsa_signature = await get_hashes_and_sign(cfg, secret, nft_info['tokenId'], args.amount, to_address, to_account, offchain_parameters=offchain_parameters, info=info)
-
-            # Submit the nft transfer
-            transfer_result, response = await transfer_nft(cfg,
-                                                           secret,
-                                                           amount=args.amount,
-                                                           toAccount=to_account,
-                                                           toAddress=to_address,
-                                                           nftInfo=nft_info,
-                                                           eddsa_signature=eddsa_signature,
-                                                           ecdsa_signature=ecdsa_signature,
-                                                           offchain_parameters=offchain_parameters,
-                                                           test_mode=args.test,
-                                                           info=info)
-            
-            if transfer_result == TransferResult.SUCCESS:
-                print(f"{i+1}/{len(filtered_tos)} {i+1}: Successful Transfer! (tx hash: {response['hash']}, to: {to_address}, nftId: {nft_info['nftId']})")
-                offchain_parameters['storage_id']['offchainId'] += 2
-            elif transfer_result == TransferResult.FAILED:
-                print(f"{i+1}/{len(filtered_tos)} {i+1}: Transfer FAILED... (to: {to_address}, nftId: {nft_info['nftId']})")
-            elif transfer_result == TransferResult.FEE_INVALID: # Invalid fees, exit cleanly
-                print(f"{i+1}/{len(filtered_tos)} {i+1}: Transfer FAILED due to invalid fee... (to: {to_address}, nftId: {nft_info['nftId']})")
-                print(f"Fees increased above {cfg.feeLimit}{cfg.feeSymbol} limit, aborting...")
-                sys.exit(1)
-            elif transfer_result == TransferResult.TESTMODE:
-                print(f"{i+1}/{len(filtered_tos)} {i+1}: Skipping transfer (test mode) (to: {to_address}, nftId: {nft_info['nftId']})")
+        # Storage ids are allocated locally for each NFT token, token address and approved off_chain_fee are reused for the whole run
+        # The storage id fetched above may be consumed by a pending transfer, it is only used as a seed without pending transfers
+        # Storage ids are leased in ranges with the other processes of the account if shared
+        if args.storage_leases:
+            storage_leases = StorageIdLeases(args.storage_leases)
+        storage_ids = StorageIdAllocator(secret.loopringApiKey, cfg.fromAccount, leases=storage_leases, lease_size=int(os.getenv("STORAGE_ID_LEASE_SIZE") or 100))
+        if len(pending) == 0:
+            storage_ids.seed(nfts['data'][0].tokenId, offchain_parameters['storage_id']['offchainId'])
+
+        # Transfers are paused while the offchain fee is above the approved max fee they are signed with
+        approved_fee = offchain_parameters['off_chain_fee']['fees'][cfg.maxFeeTokenId]
+        fee_watcher = FeeWatcher(lambda: get_offchain_fee(cfg, secret, offchain_parameters['counterfactual_nft']['tokenAddress']),
+                                 max_fee=int( (1 + cfg.feeSlippage) * int(approved_fee['fee']) ),
+                                 interval=float(os.getenv("FEE_POLL_INTERVAL") or 30),
+                                 decimals=token_decimals[approved_fee['token']],
+                                 symbol=approved_fee['token'],
+                                 on_change=lambda paused, fee: journal.append({'event': 'fee_paused' if paused else 'fee_resumed', 'fee': fee}))
 
-            transfer_info.append(info)
+        # NFT transfer sequence
+        fee_watcher.start()
+        with SigningPool(args.workers, keys={'loopringPrivateKey': secret.loopringPrivateKey, 'metamaskPrivateKey': secret.metamaskPrivateKey}) as signing_pool:
+            await transfer_batch(cfg,
+                                 secret,
+                                 signing_pool,
+                                 storage_ids,
+                                 recipients=recipients,
+                                 positions=positions,
+                                 nfts=nfts,
+                                 weights=weights,
+                                 pending=pending,
+                                 mode=args.mode,
+                                 amount=args.amount,
+                                 offchain_parameters=offchain_parameters,
+                                 test_mode=args.test,
+                                 journal=journal,
+                                 fee_watcher=fee_watcher)
 
         if len(skipped_tos) > 0:
             print(f"Skipped {len(skipped_tos)} invalid to addresses:")
             print('\n'.join(skipped_tos))
     finally:
-        with open(paths.transfer_info, 'w+') as f:
-            json.dump(transfer_info, f, indent=4)
+        if fee_watcher is not None:
+            await fee_watcher.stop()
+        await LoopringMintService.close_shared_session()
+        LoopringMintService.metrics.dump(paths.metrics)
+        profiler.stop(paths.profile)
+        if LoopringMintService.account_cache is not None:
+            LoopringMintService.account_cache.close()
+        if storage_leases is not None:
+            storage_leases.close()
+        journal.close()
 
 if __name__ == '__main__':
     loop = asyncio.new_event_loop()